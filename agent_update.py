@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Keeps an agent's ~/panda at the tip of the agent branch without disturbing builds that are using it.
+
+Replaces the 'git pull origin agent' of update_agent.sh:
+
+    python agent_update.py            # what ~/update_agent.sh runs now
+    python agent_update.py --force    # ignore the backoff after failed attempts
+
+The remote ref is checked with a single ls-remote, and nothing else happens while it hasn't moved. When it has, the
+branch is fetched into the local mirror (see gitsync.py) and checked out into a new directory named after the commit
+under ~/.panda-versions, and ~/panda, a symlink, is swapped over to it with a rename. A build that started in the old
+tree keeps reading it; the next build gets the new one. The last few versions are kept.
+
+When the remote can't be reached the updater backs off exponentially, so an agent that is offline for a while isn't
+hammering the server (or the logs) every time it is run.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import time
+
+from os.path import basename, dirname, exists, expanduser, isdir, islink, join
+
+import build_gc
+import engine
+import gitsync
+import metrics
+
+default_url = 'https://backflipstudios.kilnhg.com/Code/Repositories/Group/panda.git'
+default_branch = 'agent'
+default_path = '~/panda'
+
+versions_dir = '~/.panda-versions'
+state_name = '.update_state.json'
+
+# Versions kept besides the current one, for builds that are still running in them.
+keep_versions = 3
+
+# Seconds to wait after the first failed attempt, doubling with every further failure up to max_backoff.
+base_backoff = 60
+max_backoff = 6 * 3600
+
+
+def git(args):
+    return engine.run(['git'] + args).returncode
+
+
+def remote_head(url, branch):
+    # The commit the branch points at on the remote, or None when it can't be reached.
+    try:
+        result = engine.run(['git', 'ls-remote', url, 'refs/heads/{}'.format(branch)], capture=True, echo=False,
+                            timeout=120)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    fields = result.output.split()
+    # An empty answer means the branch doesn't exist, which retrying won't fix either.
+    if not fields:
+        return ''
+    # Anything but a commit id (a proxy's error page, a credential prompt's leftovers) is no answer either; it would
+    # otherwise end up naming a version directory.
+    return fields[0] if re.match(r'^[0-9a-f]{40}$', fields[0]) else None
+
+
+def current_version(path):
+    # The commit ~/panda points at: the name of its version directory, or the HEAD of a plain working tree.
+    if islink(path):
+        return basename(os.readlink(path).rstrip('/'))
+    if gitsync.is_repository(path):
+        result = engine.run(['git', '-C', path, 'rev-parse', 'HEAD'], capture=True, echo=False)
+        if result.returncode == 0:
+            return result.output.strip()
+    return None
+
+
+def load_state(root):
+    try:
+        with open(join(root, state_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(root, state):
+    temp_path = join(root, state_name + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(temp_path, join(root, state_name))
+
+
+def backoff(failures):
+    # Exponential, with jitter so a fleet that lost the server at the same moment doesn't come back in lockstep.
+    delay = min(max_backoff, base_backoff * 2 ** (failures - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def swap(path, target):
+    # Points the symlink at path to target in one rename. A plain working tree left by an older provisioning run is
+    # moved into the versions directory first; that one time there is a moment with no ~/panda at all.
+    if exists(path) and not islink(path):
+        legacy = join(dirname(target), 'legacy-{}'.format(int(time.time())))
+        os.rename(path, legacy)
+    temp_link = '{}.{}.tmp'.format(path, os.getpid())
+    if islink(temp_link):
+        os.remove(temp_link)
+    os.symlink(target, temp_link)
+    os.rename(temp_link, path)
+
+
+def prune(root, current, run=git):
+    versions = [join(root, name) for name in os.listdir(root) if not name.startswith('.') and
+                isdir(join(root, name)) and join(root, name) != current]
+    versions.sort(key=lambda version: os.lstat(version).st_mtime, reverse=True)
+    # A build can outlive several updates; the version it is running in stays until it is done.
+    busy = build_gc.busy_workspaces(root)
+    for version in versions[keep_versions:]:
+        if basename(version) in busy:
+            print('Keeping {}: a process is still running in it.'.format(version))
+            continue
+        shutil.rmtree(version, ignore_errors=True)
+
+    # Versions cloned with --shared by older updaters get their own copy of the objects they borrow from the mirror.
+    for version in [current] + versions[:keep_versions]:
+        alternates = join(version, '.git', 'objects', 'info', 'alternates')
+        if exists(alternates) and run(['-C', version, 'repack', '-a', '-d', '-q']) == 0:
+            os.remove(alternates)
+
+
+def update(url=default_url, branch=default_branch, path=default_path, mode=gitsync.MIRROR, force=False, run=git):
+    """Brings path to the tip of url's branch and returns 0, or the exit code of the step that failed.
+
+    run executes a git command (given without the leading 'git') and returns its exit code. Unless force is set, an
+    attempt within the backoff period after a failure returns 0 straight away.
+    """
+    path = expanduser(path)
+    root = expanduser(versions_dir)
+    if not isdir(root):
+        os.makedirs(root)
+
+    state = load_state(root)
+    now = time.time()
+    if not force and state.get('retry_at', 0) > now:
+        print('Skipping update: {} was unreachable {} time(s), next attempt in {:.0f}s.'.format(
+            url, state.get('failures', 0), state['retry_at'] - now))
+        return 0
+
+    # The time of the last successful check outlives failures, for the metrics.
+    success = dict((key, state[key]) for key in ('last_success',) if key in state)
+    head = remote_head(url, branch)
+    if head is None:
+        failures = state.get('failures', 0) + 1
+        delay = backoff(failures)
+        save_state(root, dict(success, failures=failures, retry_at=now + delay))
+        print('ERROR: Could not reach {}; backing off for {:.0f}s.'.format(url, delay))
+        return 1
+    if state.get('failures'):
+        save_state(root, success)
+    if not head:
+        print('ERROR: Branch {} does not exist on {}.'.format(branch, url))
+        return 1
+
+    if current_version(path) == head and islink(path):
+        save_state(root, {'last_success': now})
+        print('{} is up to date at {}.'.format(path, head[:12]))
+        return 0
+
+    print('Updating {} to {}...'.format(path, head[:12]))
+    for args in gitsync.mirror_steps(url, branch, mode):
+        ret = run(args)
+        if ret != 0:
+            return ret
+
+    target = join(root, head)
+    if not isdir(target):
+        staging = join(root, '.staging-{}'.format(head))
+        if exists(staging):
+            shutil.rmtree(staging)
+        for args in gitsync.clone_steps(url, head, staging):
+            ret = run(args)
+            if ret != 0:
+                shutil.rmtree(staging, ignore_errors=True)
+                return ret
+        if not isdir(staging):
+            print('ERROR: Checking out {} did not create {}.'.format(head[:12], staging))
+            return 1
+        try:
+            os.rename(staging, target)
+        except OSError as e:
+            print('ERROR: Could not move {} to {}: {}'.format(staging, target, e))
+            shutil.rmtree(staging, ignore_errors=True)
+            return 1
+
+    swap(path, target)
+    prune(root, target, run)
+    save_state(root, {'last_success': now})
+    return 0
+
+
+def export_metrics(metrics_dir):
+    state = load_state(expanduser(versions_dir))
+    metrics.write(metrics_dir, 'agent_update', [
+        ('panda_agent_update_last_success_timestamp_seconds', 'gauge',
+         'When update_agent.sh last found ~/panda up to date or updated it.',
+         [({}, state['last_success'])] if 'last_success' in state else []),
+        ('panda_agent_update_consecutive_failures', 'gauge', 'Attempts to reach the remote that failed in a row.',
+         [({}, state.get('failures', 0))])
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update ~/panda to the tip of the agent branch.')
+    parser.add_argument('--url', help='Repository to update from.', default=default_url, required=False)
+    parser.add_argument('--branch', help='Branch to track (default: agent).', default=default_branch, required=False)
+    parser.add_argument('--path', help='Checkout to keep up to date (default: ~/panda).', default=default_path,
+                        required=False)
+    parser.add_argument('--force', help='Try now even if the updater is backing off after a failure.',
+                        action='store_true', required=False)
+    parser.add_argument('--metrics-dir', help='Write Prometheus metrics about updates to this node-exporter textfile '
+                        'directory.', required=False)
+    args = parser.parse_args()
+
+    ret = update(args.url, args.branch, args.path, force=args.force)
+    if args.metrics_dir:
+        export_metrics(args.metrics_dir)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""Content-addressed artifact cache shared by the package managers, either on-box or served to the fleet.
+
+Downloads are routed through a small HTTP server backed by an ArtifactStore. Two request styles are understood:
+
+    GET http://host/path    forward proxy requests (android update sdk --proxy-host ... -s)
+    GET /host/path          mirror requests for <upstream_scheme>://host/path (Homebrew, pip, gem)
+
+Run 'python artifact_cache.py serve --bind 0.0.0.0' on one machine and pass --cache-url to dev.py/panda.py on the
+others, or pass --cache DIR to run a private cache for the duration of a single run. The server listens on localhost
+unless told otherwise, since anyone who can reach it can use it as a proxy.
+
+Packages, bottles and SDK archives never change at a given url and are kept until they are evicted. Indexes that are
+updated in place (RubyGems' spec indexes, the Android repository manifests) are kept too, but are revalidated with
+the upstream once they are older than index_ttl, and served stale only when the upstream can't be reached.
+"""
+import BaseHTTPServer
+import SocketServer
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from os.path import exists, expanduser, getsize, isdir, join
+from urlparse import urlparse
+
+# Scheme used to reach upstream hosts for mirror style requests. Point it at 'http' to test against a local stand-in.
+upstream_scheme = 'https'
+
+default_max_size = 50 * 1024 ** 3
+
+pypi_host = 'pypi.org'
+rubygems_host = 'rubygems.org'
+
+# Urls whose content changes over time, and seconds a cached copy of one is served before asking the upstream again.
+mutable_patterns = [re.compile(pattern) for pattern in [
+    r'/(?:latest_|prerelease_)?specs\.[\d.]+(?:\.gz)?$',
+    r'/(?:versions|names|info/[^/]+)$',
+    r'/api/v\d+/',
+    r'\.xml$',
+    r'\?'
+]]
+index_ttl = 600
+
+# Base URL of the cache for this run, or None when downloads go straight to the internet.
+cache_url = None
+
+_store = None
+
+size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    # '50G' -> 53687091200
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', str(value).strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError('Invalid size: {}'.format(value))
+    return int(float(match.group(1)) * size_units[match.group(2)])
+
+
+def is_mutable(url):
+    return any(pattern.search(url) for pattern in mutable_patterns)
+
+
+class ArtifactStore(object):
+    def __init__(self, root, max_size=default_max_size):
+        self.root = expanduser(root)
+        self.max_size = max_size
+        self.index_path = join(self.root, 'index.json')
+        self.lock = threading.Lock()
+        # Hits only touch atimes and counters; they are written with the next eviction or by flush().
+        self.dirty = False
+
+        if not isdir(join(self.root, 'blobs')):
+            os.makedirs(join(self.root, 'blobs'))
+
+        self.index = {'urls': {}, 'blobs': {}, 'stats': {}}
+        try:
+            with open(self.index_path) as f:
+                self.index.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+
+        for key in ('hits', 'misses', 'evictions', 'bytes_served', 'bytes_fetched'):
+            self.index['stats'].setdefault(key, 0)
+
+    def blob_path(self, digest):
+        return join(self.root, 'blobs', digest[:2], digest)
+
+    def get(self, url, stale=False):
+        # Returns (path, content_type) for a cached url, or None. An index older than index_ttl is only returned with
+        # stale=True.
+        with self.lock:
+            entry = self.index['urls'].get(url)
+            if entry is None or not exists(self.blob_path(entry['digest'])):
+                return None
+            if not stale and is_mutable(url) and time.time() - entry.get('fetched', 0) > index_ttl:
+                return None
+            blob = self.index['blobs'][entry['digest']]
+            blob['atime'] = time.time()
+            stats = self.index['stats']
+            stats['hits'] += 1
+            stats['bytes_served'] += blob['size']
+            self.dirty = True
+            return self.blob_path(entry['digest']), entry.get('content_type')
+
+    def validators(self, url):
+        # Headers that make a request for a cached index conditional, so an unchanged one isn't downloaded again.
+        with self.lock:
+            entry = self.index['urls'].get(url)
+            if entry is None or not exists(self.blob_path(entry['digest'])):
+                return {}
+            headers = {}
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            return headers
+
+    def revalidated(self, url):
+        # The upstream confirmed the cached copy is current (304 Not Modified).
+        with self.lock:
+            entry = self.index['urls'].get(url)
+            if entry is not None:
+                entry['fetched'] = time.time()
+        return self.get(url, stale=True)
+
+    def put(self, url, stream, content_type=None, headers=None):
+        # Streams the artifact into the store, hashing as it goes, and returns its path. Identical content fetched
+        # from different urls is stored once.
+        sha = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(64 * 1024)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        digest = sha.hexdigest()
+        with self.lock:
+            path = self.blob_path(digest)
+            if not isdir(join(self.root, 'blobs', digest[:2])):
+                os.makedirs(join(self.root, 'blobs', digest[:2]))
+            if exists(path):
+                os.remove(temp_path)
+            else:
+                os.rename(temp_path, path)
+
+            self.index['blobs'][digest] = {'size': size, 'atime': time.time()}
+            entry = {'digest': digest, 'content_type': content_type, 'fetched': time.time()}
+            if headers is not None and is_mutable(url):
+                entry['etag'] = headers.getheader('ETag')
+                entry['last_modified'] = headers.getheader('Last-Modified')
+            self.index['urls'][url] = entry
+            stats = self.index['stats']
+            stats['misses'] += 1
+            stats['bytes_fetched'] += size
+            self._evict(keep=digest)
+            self._save()
+            return path
+
+    def fetch(self, url):
+        cached = self.get(url)
+        if cached is not None:
+            return cached[0]
+        response = urllib2.urlopen(url)
+        try:
+            return self.put(url, response, response.info().gettype(), response.info())
+        finally:
+            response.close()
+
+    def total_size(self):
+        return sum(blob['size'] for blob in self.index['blobs'].values())
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.index['stats'])
+            stats['size'] = self.total_size()
+            stats['artifacts'] = len(self.index['blobs'])
+            return stats
+
+    def _evict(self, keep=None):
+        # Drop least recently used blobs until the store fits within max_size again.
+        total = self.total_size()
+        for digest, blob in sorted(self.index['blobs'].items(), key=lambda item: item[1]['atime']):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            if exists(self.blob_path(digest)):
+                os.remove(self.blob_path(digest))
+            del self.index['blobs'][digest]
+            for url in [u for u, entry in self.index['urls'].items() if entry['digest'] == digest]:
+                del self.index['urls'][url]
+            total -= blob['size']
+            self.index['stats']['evictions'] += 1
+
+    def flush(self):
+        # Writes what hits changed since the index was last saved.
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _save(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(temp_path, self.index_path)
+        self.dirty = False
+
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def upstream_url(self):
+        if self.path.startswith('http://') or self.path.startswith('https://'):
+            return self.path
+        path = self.path.lstrip('/')
+        if not path or '/' not in path:
+            return None
+        return '{}://{}'.format(upstream_scheme, path)
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            return self.send_body(json.dumps(self.server.store.stats()), 'application/json')
+
+        url = self.upstream_url()
+        if url is None:
+            return self.send_error(404)
+
+        store = self.server.store
+        cached = store.get(url)
+        if cached is not None:
+            return self.send_file(*cached)
+
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=store.validators(url)))
+        except urllib2.HTTPError as e:
+            cached = store.revalidated(url) if e.code == 304 else None
+            if cached is not None:
+                return self.send_file(*cached)
+            return self.send_error(e.code)
+        except (urllib2.URLError, IOError) as e:
+            # An index that may be out of date is still better than none while the upstream is unreachable.
+            cached = store.get(url, stale=True)
+            if cached is not None:
+                return self.send_file(*cached)
+            return self.send_error(502, str(e))
+
+        try:
+            content_type = response.info().gettype()
+            if content_type == 'text/html':
+                # Index pages (pip's simple index, directory listings) change over time, so they are passed through
+                # with absolute links rewritten to go through the cache rather than stored.
+                return self.send_body(self.rewrite_links(response.read()), content_type)
+            path = store.put(url, response, content_type, response.info())
+        finally:
+            response.close()
+        self.send_file(path, content_type)
+
+    def rewrite_links(self, html):
+        # Use the address the client reached us on so links also work for other machines in the fleet.
+        host = self.headers.get('Host')
+        base_url = 'http://' + host if host else self.server.base_url
+        return re.sub(r'(href=["\'])https?://', r'\1{}/'.format(base_url), html)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type or 'application/octet-stream')
+        self.send_header('Content-Length', str(getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheHandler)
+        self.store = store
+        host, port = self.server_address
+        self.base_url = 'http://{}:{}'.format('127.0.0.1' if host in ('', '0.0.0.0') else host, port)
+
+
+def start(cache_dir, max_size=default_max_size):
+    # Runs a private cache on a loopback port for the rest of this process and returns its url.
+    global _store
+    _store = ArtifactStore(cache_dir, max_size)
+    server = CacheServer(('127.0.0.1', 0), _store)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.base_url
+
+
+def configure(cache_dir=None, url=None, max_size=default_max_size):
+    # Points every package manager spawned from now on at the cache. Homebrew and pip read their mirrors from the
+    # environment; gem and the Android SDK manager get theirs from manager_args().
+    global cache_url
+    if url:
+        cache_url = url.rstrip('/')
+    elif cache_dir:
+        cache_url = start(cache_dir, max_size)
+    else:
+        return
+
+    print('Routing downloads through artifact cache at {}...'.format(cache_url))
+    os.environ['HOMEBREW_ARTIFACT_DOMAIN'] = cache_url
+    os.environ['PIP_INDEX_URL'] = '{}/{}/simple/'.format(cache_url, pypi_host)
+    os.environ['PIP_TRUSTED_HOST'] = urlparse(cache_url).hostname
+
+
+def manager_args(manager):
+    # Extra command line arguments that send a manager's downloads through the cache.
+    if cache_url is None:
+        return []
+    if manager == 'gem':
+        return ['--clear-sources', '--source', '{}/{}/'.format(cache_url, rubygems_host)]
+    if manager == 'android':
+        parsed = urlparse(cache_url)
+        return ['--proxy-host', parsed.hostname, '--proxy-port', str(parsed.port or 80), '--no-https']
+    return []
+
+
+def stats():
+    if _store is not None:
+        return _store.stats()
+    if cache_url is not None:
+        try:
+            return json.load(urllib2.urlopen(cache_url + '/_stats', timeout=5))
+        except (urllib2.URLError, IOError, ValueError):
+            pass
+    return None
+
+
+def report():
+    # Called at the end of a run, which is also when a private cache's index gets saved.
+    if _store is not None:
+        _store.flush()
+    cache_stats = stats()
+    if cache_stats:
+        print('Artifact cache: {hits} hit(s), {misses} miss(es), {evictions} eviction(s), '
+              '{bytes_served} bytes served from cache, {bytes_fetched} bytes fetched upstream.'.format(**cache_stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Artifact cache server for the Panda Build System agents.')
+    parser.add_argument('command', choices=['serve', 'stats'])
+    parser.add_argument('-d', '--dir', help='Cache directory', default='~/.artifact_cache', required=False)
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8080, required=False)
+    parser.add_argument('-b', '--bind', help='Address to listen on (default: 127.0.0.1). Use 0.0.0.0 to serve other '
+                        'machines; the cache will proxy requests for anyone who can reach it.', default='127.0.0.1',
+                        required=False)
+    parser.add_argument('-s', '--max-size', help='Maximum cache size, e.g. 50G', type=parse_size,
+                        default=default_max_size, required=False)
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.dir, args.max_size)
+    if args.command == 'stats':
+        print(json.dumps(store.stats(), indent=2, sort_keys=True))
+        return 0
+
+    server = CacheServer((args.bind, args.port), store)
+    print('Serving artifact cache {} on {}:{}...'.format(store.root, args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Batched single-invocation installs for brew, pip and gem."""
+import re
+
+import artifact_cache
+import engine
+import history
+
+# Set to False (--no-batch) to install every entry with its own invocation of the package manager.
+enabled = True
+
+# Lines of batch output kept for failure attribution.
+attribution_lines = 5000
+
+# Patterns that pull the name of a failed package out of a manager's output.
+failure_patterns = {
+    'brew': [
+        re.compile(r'No available formula (?:with the name |for )"?([\w@+./-]+)"?'),
+        re.compile(r'^Error: ([\w@+./-]+): ', re.M),
+        re.compile(r'^Error: [Ff]ormula "?([\w@+./-]+)"? ', re.M)
+    ],
+    'pip': [
+        re.compile(r'Could not find a version that satisfies the requirement ([^\s(]+)'),
+        re.compile(r'No matching distribution found for ([^\s(]+)'),
+        re.compile(r'Failed building wheel for ([^\s(]+)'),
+        re.compile(r'Running setup\.py install for ([^\s(]+?)(?: \.\.\.)? error'),
+        re.compile(r'Command "[^"]*?/pip-build-[^/]+/([^/"]+)/')
+    ],
+    'gem': [
+        re.compile(r"Could not find a valid gem '([^']+)'"),
+        re.compile(r'Error installing ([\w.-]+):')
+    ]
+}
+
+# Brew doesn't always name the formula on its error line, so remember which formula it was working on.
+progress_patterns = {
+    'brew': re.compile(r'^==> Installing (?:dependencies for )?([\w@+./-]+)', re.M)
+}
+
+
+def entry_args(entry):
+    # Brew and gem entries are strings ('xcodeproj -v 0.19.2'), pip entries are argument lists.
+    return entry.split() if isinstance(entry, basestring) else list(entry)
+
+
+def package_name(arg):
+    # Reduce a requirement or formula reference to a comparable name: 'pycrypto==2.6' -> 'pycrypto',
+    # 'devbfs/formulas/backflip-brew-tools' -> 'backflip-brew-tools', 'mercurial_keyring' -> 'mercurial-keyring'.
+    name = re.split(r'[<>=!~\[;@ ]', arg, 1)[0]
+    return name.split('/')[-1].lower().replace('_', '-')
+
+
+def is_batchable(entry):
+    # Options such as 'gem install xcodeproj -v 0.19.2' apply to the whole command line, so those entries are always
+    # installed on their own.
+    return not any(arg.startswith('-') for arg in entry_args(entry))
+
+
+def install_args(manager, entries):
+    args = [manager, 'install']
+    for entry in entries:
+        args.extend(entry_args(entry))
+    return args + artifact_cache.manager_args(manager)
+
+
+def run(args):
+    # Failure attribution needs more of the output than the runner keeps by default.
+    result = engine.run(args, tail=attribution_lines)
+    return result.returncode, result.tail_text
+
+
+def attribute_failures(manager, entries, output):
+    # Returns the entries named in the failure output, or None when the failure can't be pinned on any of them.
+    names = {}
+    for entry in entries:
+        for arg in entry_args(entry):
+            names[package_name(arg)] = entry
+
+    found = set()
+    for pattern in failure_patterns.get(manager, []):
+        for match in pattern.finditer(output):
+            found.add(package_name(match.group(1)))
+
+    progress = progress_patterns.get(manager)
+    if progress is not None and re.search(r'^Error:', output, re.M):
+        current = None
+        for line in output.splitlines():
+            match = progress.match(line)
+            if match:
+                current = package_name(match.group(1))
+            elif line.startswith('Error:') and current is not None:
+                found.add(current)
+
+    failed = [entry for entry in entries if any(names.get(name) is entry for name in found)]
+    return failed or None
+
+
+def longest_first(manager, entries):
+    # Managers install the packages of a command line in order, so the ones expected to take longest go first. The sort
+    # is stable: packages with the same estimate keep their manifest order.
+    return sorted(entries, key=lambda entry: -history.package_estimate(manager, package_name(entry_args(entry)[0])))
+
+
+def batch_install(manager, entries, install, fail_on_error, quiet=False):
+    # Installs entries with a single invocation of the manager, longest first. Entries that failed are handed to
+    # install(), the per-package installer, which reports or prompts exactly as an unbatched run would. Returns the
+    # entries that could not be installed.
+    entries = longest_first(manager, entries)
+    batch = [entry for entry in entries if is_batchable(entry)] if enabled else []
+    if len(batch) < 2:
+        batch = []
+
+    retry = [entry for entry in entries if entry not in batch]
+
+    if batch:
+        ret, output = run(install_args(manager, batch))
+        if ret != 0:
+            failed = attribute_failures(manager, batch, output)
+            if failed is None:
+                failed = batch
+            elif manager == 'pip':
+                # pip resolves the whole command line before installing anything, so one bad requirement means
+                # nothing went in. Install the rest as a batch again without the culprits.
+                remaining = [entry for entry in batch if entry not in failed]
+                if remaining and run(install_args(manager, remaining))[0] != 0:
+                    failed = batch
+
+            print('\nWARNING: Batched {} install failed for: {}. Retrying individually.'.format(
+                manager, ', '.join(' '.join(entry_args(entry)) for entry in failed)))
+            retry.extend(failed)
+
+    retry = [entry for entry in entries if entry in retry]
+    return [entry for entry in retry if install(entry, fail_on_error, quiet) != 0]
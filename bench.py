@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""Offline benchmark of dev.py and panda.py against simulated package managers.
+
+Each scenario runs one of the setup scripts end to end in a scratch home directory with fake brew, pip, gem, xcrun,
+java, git, which and android commands first on PATH, and fake python and ruby in a scratch HOMEBREW_PREFIX. The fakes
+answer the queries the scripts make (inventories, the SDK listing, interpreter paths) with canned output, sleep for a
+configurable latency, print a configurable amount of output and fail at a configurable rate, and log every invocation
+so the number of processes spawned can be counted.
+
+    python bench.py                          # every scenario once
+    python bench.py -r 3 dev panda-agent     # three runs each; runs after the first reuse the home directory
+    python bench.py --latency 0.5 --latency brew=2 --failure-rate 0.1
+
+The report lists wall time, the number of tool processes, peak memory (RSS of the script itself) and the exit code
+of each run. Nothing touches the network or the real package managers, so it runs on any Linux or Mac box.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from os.path import abspath, dirname, exists, join
+
+repo_path = dirname(abspath(__file__))
+
+tools = ['brew', 'pip', 'gem', 'xcrun', 'java', 'git', 'which', 'android']
+
+# Interpreters dev.py expects to find in the Homebrew prefix's bin directory, ahead of the system ones.
+prefix_tools = ['python', 'ruby']
+
+# name -> (script, arguments). Every run is quiet so a failure never waits on a prompt.
+scenarios = [
+    ('dev', ('dev.py', ['-q'])),
+    ('panda-agent', ('panda.py', ['-q', '-a'])),
+    ('panda-all', ('panda.py', ['-q', '-e', '-a', '-b', '-w', '-i']))
+]
+
+# Canned answers to the queries the scripts make. The inventories start out empty so the first run installs
+# everything; installs are remembered in the scratch directory so later runs see them as installed.
+sdk_listing = '''id: 1 or "tools"
+     Type: Tool
+     Desc: Android SDK Tools, revision 24.1.2
+----------
+id: 2 or "platform-tools"
+     Type: PlatformTool
+     Desc: Android SDK Platform-tools, revision 22
+----------
+id: 3 or "build-tools-22.0.1"
+     Type: BuildTool
+     Desc: Android SDK Build-tools, revision 22.0.1
+----------
+id: 4 or "build-tools-21.1.2"
+     Type: BuildTool
+     Desc: Android SDK Build-tools, revision 21.1.2
+----------
+id: 5 or "android-22"
+     Type: Platform
+     Desc: Android SDK Platform 5.1.1
+           Revision 2
+----------
+id: 6 or "android-21"
+     Type: Platform
+     Desc: Android SDK Platform 5.0.1
+           Revision 2
+----------
+id: 7 or "addon-amazon_fire_phone_addon-amazon-19"
+     Type: Addon
+     Desc: By Amazon
+           Fire Phone SDK Addon
+           Revision 3
+----------
+id: 8 or "extra-amazon-buildtools"
+     Type: Extra
+     Desc: By Amazon
+           Amazon Build Tools, revision 1
+'''
+
+fake_tool_script = '''#!{python}
+import sys
+sys.path.insert(0, {repo!r})
+import bench
+sys.exit(bench.fake_tool({tool!r}, sys.argv[1:]))
+'''
+
+
+class Config(object):
+    def __init__(self, latency=None, output_lines=20, failure_rate=0.0, seed=None):
+        # tool -> seconds; the '*' entry applies to tools without their own.
+        self.latency = latency or {'*': 0.05}
+        self.output_lines = output_lines
+        self.failure_rate = failure_rate
+        self.seed = seed
+
+    def latency_for(self, tool):
+        return self.latency.get(tool, self.latency.get('*', 0))
+
+    def to_json(self):
+        return json.dumps({'latency': self.latency, 'output_lines': self.output_lines,
+                           'failure_rate': self.failure_rate, 'seed': self.seed})
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**json.loads(text))
+
+
+def parse_latency(spec):
+    # '0.5' sets the default, 'brew=2' a single tool.
+    tool, _, seconds = spec.rpartition('=')
+    try:
+        return tool or '*', float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected SECONDS or TOOL=SECONDS, got {}'.format(spec))
+
+
+def _state_path(name):
+    return join(os.environ['BENCH_ROOT'], name)
+
+
+def _read_installed(manager):
+    # [(name, version)]
+    try:
+        with open(_state_path('installed.' + manager)) as f:
+            return [tuple(line.split()) for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def _add_installed(manager, names, version='1.0'):
+    with open(_state_path('installed.' + manager), 'a') as f:
+        for name in names:
+            f.write('{} {}\n'.format(name, version))
+
+
+def _package_names(args):
+    # Positional arguments of an install command, minus option values such as gem's '-v 0.19.2'.
+    names = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in ('-v', '--version', '--source', '--proxy-host', '--proxy-port', '-t'):
+            skip = True
+        elif not arg.startswith('-'):
+            names.append(arg.split('==')[0])
+    return names
+
+
+def _query(tool, args):
+    # Returns the output of a read-only query, or None when args is not one.
+    if tool == 'brew' and args[:1] == ['list']:
+        return ''.join('{} {}\n'.format(name, version) for name, version in _read_installed('brew'))
+    if tool == 'brew' and args[:1] == ['--version']:
+        return 'Homebrew 0.9.5\n'
+    if tool == 'pip' and args[:1] == ['freeze']:
+        return ''.join('{}=={}\n'.format(name, version) for name, version in _read_installed('pip'))
+    if tool == 'gem' and args[:1] == ['list']:
+        installed = _read_installed('gem')
+        return '\n*** LOCAL GEMS ***\n\n' + ''.join('{} ({})\n'.format(name, version) for name, version in installed)
+    if tool == 'android' and args[:1] == ['list']:
+        return sdk_listing
+    if tool == 'git' and args[:1] == ['ls-remote']:
+        return '{}\t{}\n'.format(hashlib.sha1(args[-1]).hexdigest(), args[-1])
+    if tool == 'which':
+        return '/usr/local/bin/{}\n'.format(args[0] if args else '')
+    if tool == 'xcrun':
+        return 'Apple LLVM version 6.0 (clang-600.0.57)\n'
+    if tool == 'java':
+        return 'java version "1.8.0_31"\n'
+    return None
+
+
+def _install_sdk_components(components):
+    # Lays down the source.properties files dev.py looks for to decide what is already installed.
+    sdk = os.environ['ANDROID_HOME']
+    for component in components:
+        properties = {}
+        if component in ('tool', 'platform-tool'):
+            path = join(sdk, component + 's')
+            properties['Pkg.Revision'] = '24.1.2' if component == 'tool' else '22'
+        elif component.startswith('android-'):
+            path = join(sdk, 'platforms', component)
+        elif component.startswith('build-tools-'):
+            path = join(sdk, 'build-tools', component[len('build-tools-'):])
+        elif component.startswith('extra-'):
+            path = join(sdk, 'extras', *component[len('extra-'):].split('-', 1))
+        elif component.startswith('addon-'):
+            name, vendor, api = component[len('addon-'):].rsplit('-', 2)
+            path = join(sdk, 'add-ons', component)
+            properties.update({'Addon.NameId': name, 'Addon.VendorId': vendor, 'AndroidVersion.ApiLevel': api})
+        else:
+            continue
+        if not exists(path):
+            os.makedirs(path)
+        with open(join(path, 'source.properties'), 'w') as f:
+            for key, value in sorted(properties.items()):
+                f.write('{}={}\n'.format(key, value))
+
+
+def fake_tool(tool, args):
+    config = Config.from_json(os.environ['BENCH_CONFIG'])
+    with open(_state_path('calls'), 'a') as f:
+        f.write(json.dumps([tool] + args) + '\n')
+
+    time.sleep(config.latency_for(tool))
+
+    output = _query(tool, args)
+    if output is not None:
+        sys.stdout.write(output)
+        return 0
+
+    # With a seed, a given command fails the same way on every run.
+    rng = random.Random('{}:{}:{}'.format(config.seed, tool, args) if config.seed is not None else None)
+    for i in range(config.output_lines):
+        sys.stdout.write('==> {} {}: step {}/{}\n'.format(tool, args[0] if args else '', i + 1, config.output_lines))
+    sys.stdout.flush()
+
+    if rng.random() < config.failure_rate:
+        names = _package_names(args[1:])
+        sys.stdout.write('Error: simulated failure installing {}\n'.format(' '.join(names) or tool))
+        return 1
+
+    if tool in ('brew', 'pip', 'gem') and args[:1] == ['install']:
+        pinned = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg in ('-v', '--version')]
+        _add_installed(tool, _package_names(args[1:]), pinned[0] if pinned else '1.0')
+    elif tool == 'android' and args[:2] == ['update', 'sdk'] and '-t' in args:
+        _install_sdk_components(args[args.index('-t') + 1].split(','))
+    elif tool == 'git' and args[:1] in (['clone'], ['init']):
+        # The last positional argument is the new repository: 'clone [options] URL PATH', 'init --bare PATH'.
+        path = [arg for arg in args[1:] if not arg.startswith('-')][-1:]
+        git_dir = path[0] if '--bare' in args else join(path[0], '.git') if path else None
+        if git_dir and not exists(git_dir):
+            os.makedirs(git_dir)
+    return 0
+
+
+class Workspace(object):
+    # Scratch directory holding the fake tools, the home directory the script runs in and the state of the fakes.
+    def __init__(self, root, config):
+        self.root = root
+        self.config = config
+        self.bin = join(root, 'bin')
+        self.home = join(root, 'home')
+        self.sdk = join(root, 'sdk')
+        self.prefix = join(root, 'prefix')
+        for path in (self.bin, join(self.home, 'Library'), self.sdk, join(self.prefix, 'bin')):
+            os.makedirs(path)
+        for directory, names in ((self.bin, tools), (join(self.prefix, 'bin'), prefix_tools)):
+            for tool in names:
+                path = join(directory, tool)
+                with open(path, 'w') as f:
+                    f.write(fake_tool_script.format(python=sys.executable, repo=repo_path, tool=tool))
+                os.chmod(path, 0755)
+
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'HOME': self.home,
+            'ANDROID_HOME': self.sdk,
+            'HOMEBREW_PREFIX': self.prefix,
+            'PATH': os.pathsep.join([self.bin, join(self.prefix, 'bin'), '/usr/local/bin', '/usr/bin', '/bin']),
+            'BENCH_ROOT': self.root,
+            'BENCH_CONFIG': self.config.to_json()
+        })
+        return env
+
+    def calls(self):
+        try:
+            with open(join(self.root, 'calls')) as f:
+                return [json.loads(line) for line in f]
+        except IOError:
+            return []
+
+    def reset_calls(self):
+        if exists(join(self.root, 'calls')):
+            os.remove(join(self.root, 'calls'))
+
+
+class Measurement(object):
+    def __init__(self, scenario, run, wall, calls, peak_rss, returncode):
+        self.scenario = scenario
+        self.run = run
+        self.wall = wall
+        self.calls = calls
+        self.peak_rss = peak_rss
+        self.returncode = returncode
+
+    @property
+    def processes(self):
+        return len(self.calls)
+
+    def per_tool(self):
+        counts = {}
+        for call in self.calls:
+            counts[call[0]] = counts.get(call[0], 0) + 1
+        return counts
+
+
+def _max_rss_bytes(rusage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on the Mac.
+    return rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+
+def run_scenario(workspace, name, script, script_args, run, log):
+    workspace.reset_calls()
+    args = [sys.executable, join(repo_path, script)] + script_args
+    start = time.time()
+    process = subprocess.Popen(args, cwd=workspace.home, env=workspace.env(), stdin=open(os.devnull),
+                               stdout=log, stderr=subprocess.STDOUT)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall = time.time() - start
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return Measurement(name, run, wall, workspace.calls(), _max_rss_bytes(rusage), returncode)
+
+
+def report(measurements):
+    print('{:<14} {:>4} {:>9} {:>10} {:>9} {:>5}  {}'.format('scenario', 'run', 'wall', 'processes', 'peak RSS',
+                                                             'exit', 'processes per tool'))
+    for m in measurements:
+        per_tool = ' '.join('{}={}'.format(tool, count) for tool, count in sorted(m.per_tool().items()))
+        print('{:<14} {:>4} {:>8.2f}s {:>10} {:>7.1f}MB {:>5}  {}'.format(m.scenario, m.run, m.wall, m.processes,
+                                                                         m.peak_rss / (1024.0 * 1024), m.returncode,
+                                                                         per_tool))
+
+
+def main():
+    names = [name for name, _ in scenarios]
+    parser = argparse.ArgumentParser(description='Benchmark dev.py and panda.py against simulated package managers.')
+    parser.add_argument('scenario', help='Scenarios to run (default: all of {})'.format(', '.join(names)), nargs='*')
+    parser.add_argument('-r', '--runs', help='Runs per scenario. Runs after the first reuse the same home directory, '
+                        'so they measure the already-provisioned case.', type=int, default=1, required=False)
+    parser.add_argument('--latency', help='Seconds each fake command takes, or TOOL=SECONDS for one tool. '
+                        'May be repeated (default: 0.05).', type=parse_latency, action='append', default=[],
+                        required=False)
+    parser.add_argument('--output-lines', help='Lines of output printed by each fake install (default: 20).',
+                        type=int, default=20, required=False)
+    parser.add_argument('--failure-rate', help='Fraction of fake installs that fail (default: 0).', type=float,
+                        default=0.0, required=False)
+    parser.add_argument('--seed', help='Seed for the simulated failures, to make them repeatable.', required=False)
+    parser.add_argument('--keep', help='Keep the scratch directories and print where they are.', action='store_true',
+                        required=False)
+    parser.add_argument('-v', '--verbose', help='Show the output of the scripts.', action='store_true',
+                        required=False)
+    parser.add_argument('--json', help='Also write the measurements to this file as JSON.', required=False)
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenario if name not in names]
+    if unknown:
+        parser.error('Unknown scenario {}, expected one of {}'.format(', '.join(unknown), ', '.join(names)))
+
+    latency = {'*': 0.05}
+    latency.update(dict(args.latency))
+    config = Config(latency, args.output_lines, args.failure_rate, args.seed)
+
+    measurements = []
+    for name, (script, script_args) in scenarios:
+        if args.scenario and name not in args.scenario:
+            continue
+        root = tempfile.mkdtemp(prefix='bench-{}-'.format(name))
+        try:
+            workspace = Workspace(root, config)
+            with open(join(root, 'output.log'), 'w') as log:
+                for run in range(1, args.runs + 1):
+                    print('Running {} ({}/{})...'.format(name, run, args.runs))
+                    measurement = run_scenario(workspace, name, script, script_args, run,
+                                               None if args.verbose else log)
+                    measurements.append(measurement)
+        finally:
+            if args.keep:
+                print('Kept {}'.format(root))
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+    print('')
+    report(measurements)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([{'scenario': m.scenario, 'run': m.run, 'wall': m.wall, 'processes': m.processes,
+                        'per_tool': m.per_tool(), 'peak_rss': m.peak_rss, 'exit': m.returncode}
+                       for m in measurements], f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Garbage collector for the Bamboo build directory.
+
+Replaces the weekly 'rm -fr ./*' of clear_build_dir.sh. Only as many workspaces are removed as it takes to bring disk
+usage back under a threshold, least recently used first, so the checkouts that are still being built stay warm:
+
+    python build_gc.py              # collect if the disk is fuller than --high percent, down to --low percent
+    python build_gc.py --status     # show the workspaces by plan and branch, and what would be evicted
+    python build_gc.py --dry-run
+
+Workspaces idle for longer than --max-age-days are removed whatever the disk usage. Workspaces with anything in them
+modified within the last --min-idle-hours, or that a running process has as its working directory (a build may be
+running in them), never are. Each workspace is renamed out of the way first, so Bamboo never sees a half deleted
+checkout, and the renamed directories are deleted in parallel.
+
+panda.py -a installs a LaunchAgent that runs it every ten minutes from wherever panda.py was run. A run with the disk
+below the threshold and nothing past its age limit returns without walking the build dir.
+"""
+import argparse
+import fcntl
+import json
+import os
+import re
+import sys
+import time
+
+from os.path import expanduser, isdir, join
+
+import engine
+
+default_build_dir = '~/bamboo-agent-home/xml-data/build-dir'
+
+# Index of workspace sizes, kept in the build dir so sizes are only recomputed for workspaces that have been used.
+index_name = '.gc_index.json'
+lock_name = '.gc.lock'
+trash_prefix = '.gc-trash-'
+
+# Bamboo names a job's workspace PROJECT-PLAN-JOB; branch plans append the branch number to the plan key.
+workspace_pattern = re.compile(r'^(?P<project>[A-Z][A-Z0-9]*)-(?P<plan>[A-Z][A-Z0-9]*?)(?P<branch>\d*)-'
+                               r'(?P<job>[A-Z][A-Z0-9]*)$')
+
+
+class Workspace(object):
+    def __init__(self, name, path, last_used, size=None):
+        self.name = name
+        self.path = path
+        self.last_used = last_used
+        self.size = size
+        match = workspace_pattern.match(name)
+        if match:
+            self.plan = '{}-{}'.format(match.group('project'), match.group('plan'))
+            self.branch = match.group('branch') or None
+        else:
+            self.plan = name
+            self.branch = None
+
+
+def disk_usage(path):
+    # (used fraction, bytes available to this user, total bytes)
+    stat = os.statvfs(path)
+    total = stat.f_blocks * stat.f_frsize
+    free = stat.f_bfree * stat.f_frsize
+    available = stat.f_bavail * stat.f_frsize
+    used = total - free
+    # Reserved blocks are unusable to the agent, so usage is measured against what it can actually fill.
+    usable = used + available
+    return (float(used) / usable if usable else 0.0), available, usable
+
+
+def last_used(path):
+    # A build touches the workspace directory or one of its top level entries (the checkout, build output, logs).
+    latest = os.lstat(path).st_mtime
+    try:
+        for name in os.listdir(path):
+            try:
+                latest = max(latest, os.lstat(join(path, name)).st_mtime)
+            except OSError:
+                pass
+    except OSError:
+        pass
+    return latest
+
+
+def used_since(path, since):
+    # Whether anything in the tree was modified after since. Long builds may only write deep inside the workspace, so
+    # this walks all of it, stopping at the first recent entry.
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                if os.lstat(join(root, name)).st_mtime >= since:
+                    return True
+            except OSError:
+                pass
+    return False
+
+
+def busy_workspaces(build_dir):
+    # Names of the workspaces that some process is running in.
+    directories = set()
+    if isdir('/proc'):
+        for pid in os.listdir('/proc'):
+            if pid.isdigit():
+                try:
+                    directories.add(os.readlink(join('/proc', pid, 'cwd')))
+                except OSError:
+                    pass
+    else:
+        try:
+            result = engine.run(['lsof', '-w', '-a', '-d', 'cwd', '-Fn'], capture=True, echo=False)
+        except OSError:
+            result = None
+        if result is not None:
+            directories.update(line[1:] for line in result.output.splitlines() if line.startswith('n'))
+
+    prefix = os.path.realpath(build_dir) + os.sep
+    return set(directory[len(prefix):].split(os.sep)[0] for directory in directories if directory.startswith(prefix))
+
+
+def directory_size(path):
+    # Bytes allocated on disk, which is what deleting the directory gives back.
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def load_index(build_dir):
+    try:
+        with open(join(build_dir, index_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_index(build_dir, workspaces):
+    index = dict((w.name, {'last_used': w.last_used, 'size': w.size}) for w in workspaces if w.size is not None)
+    temp_path = join(build_dir, index_name + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(temp_path, join(build_dir, index_name))
+
+
+def scan(build_dir, sized=True):
+    # Workspaces in the build dir, least recently used first. Sizes come from the index unless the workspace has been
+    # used since it was last measured.
+    index = load_index(build_dir)
+    workspaces = []
+    for name in os.listdir(build_dir):
+        path = join(build_dir, name)
+        if name.startswith('.') or not isdir(path) or os.path.islink(path):
+            continue
+        workspace = Workspace(name, path, last_used(path))
+        entry = index.get(name)
+        if entry and entry.get('last_used') == workspace.last_used:
+            workspace.size = entry.get('size')
+        elif sized:
+            workspace.size = directory_size(path)
+        workspaces.append(workspace)
+    workspaces.sort(key=lambda w: w.last_used)
+    return workspaces
+
+
+def select(workspaces, needed, max_age, min_idle, now=None, busy=()):
+    # Least recently used workspaces past min_idle until needed bytes are covered, plus everything older than max_age.
+    # Workspaces in busy, or with anything inside used within min_idle, are left alone.
+    now = now or time.time()
+    victims = []
+    freed = 0
+    for workspace in workspaces:
+        idle = now - workspace.last_used
+        if idle < min_idle or workspace.name in busy:
+            continue
+        if freed < needed or (max_age and idle > max_age):
+            if used_since(workspace.path, now - min_idle):
+                continue
+            victims.append(workspace)
+            freed += workspace.size or 0
+    return victims
+
+
+def remove(build_dir, workspaces, jobs):
+    # Renames every victim out of the way first, then deletes them all at once, along with anything left over from a
+    # collection that was interrupted.
+    trash = [join(build_dir, name) for name in os.listdir(build_dir) if name.startswith(trash_prefix)]
+    for workspace in workspaces:
+        path = join(build_dir, '{}{}-{}'.format(trash_prefix, workspace.name, int(time.time())))
+        try:
+            os.rename(workspace.path, path)
+        except OSError as e:
+            print('WARNING: Could not remove {}: {}'.format(workspace.path, e))
+            continue
+        trash.append(path)
+
+    deletions = engine.Engine(limits={'rm': jobs})
+    return engine.gather(deletions.submit(['rm', '-rf', path], echo=False) for path in trash).result()
+
+
+def format_size(size):
+    if size is None:
+        return '?'
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '{:.0f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}T'.format(size)
+
+
+def status(workspaces, victims, now=None):
+    now = now or time.time()
+    plans = {}
+    for workspace in workspaces:
+        plans.setdefault(workspace.plan, []).append(workspace)
+
+    evicted = set(w.name for w in victims)
+    for plan in sorted(plans):
+        members = plans[plan]
+        print('{} ({}, {} workspace(s))'.format(plan, format_size(sum(w.size or 0 for w in members)), len(members)))
+        for workspace in sorted(members, key=lambda w: w.last_used, reverse=True):
+            print('  {:<40} {:>7}  idle {:>6.1f}h  {}{}'.format(
+                workspace.name, format_size(workspace.size), (now - workspace.last_used) / 3600,
+                'branch {}'.format(workspace.branch) if workspace.branch else 'main',
+                '  <- evict' if workspace.name in evicted else ''))
+
+
+def collect(build_dir, high, low, max_age, min_idle, jobs, dry_run=False, show_status=False):
+    usage, available, usable = disk_usage(build_dir)
+    over = usage * 100 >= high
+    if not over and not max_age and not show_status:
+        return 0
+
+    # Nothing to measure unless space is needed: the age limit only needs the last used times.
+    workspaces = scan(build_dir, sized=over or show_status)
+    oldest = workspaces[0].last_used if workspaces else time.time()
+    if not over and not show_status and time.time() - oldest <= max_age:
+        return 0
+
+    needed = max(0, int(usable * (usage - low / 100.0))) if over else 0
+    victims = select(workspaces, needed, max_age, min_idle, busy=busy_workspaces(build_dir))
+
+    print('Disk {:.0f}% used ({} free); {} workspace(s) in {}.'.format(usage * 100, format_size(available),
+                                                                       len(workspaces), build_dir))
+    if show_status:
+        status(workspaces, victims)
+    save_index(build_dir, [w for w in workspaces if w not in victims])
+
+    if not victims:
+        if over:
+            print('WARNING: Nothing left to evict; every workspace has been used in the last {:.1f}h.'.format(
+                min_idle / 3600.0))
+        return 0
+
+    # Workspaces evicted only for their age may not have been measured.
+    sizes = [w.size for w in victims]
+    freed = ', {}'.format(format_size(sum(sizes))) if None not in sizes else ''
+    print('{} {} workspace(s){}: {}'.format('Would evict' if dry_run or show_status else 'Evicting', len(victims),
+                                            freed, ', '.join(w.name for w in victims)))
+    if dry_run or show_status:
+        return 0
+
+    results = remove(build_dir, victims, jobs)
+    failed = [result for result in results if result.returncode != 0]
+    usage, available, _ = disk_usage(build_dir)
+    print('Disk {:.0f}% used ({} free).'.format(usage * 100, format_size(available)))
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evict least recently used Bamboo workspaces under disk pressure.')
+    parser.add_argument('-d', '--build-dir', help='Bamboo build directory (default: {}).'.format(default_build_dir),
+                        default=default_build_dir, required=False)
+    parser.add_argument('--high', help='Collect once the disk is this full, in percent (default: 85).', type=float,
+                        default=85, required=False)
+    parser.add_argument('--low', help='Collect until the disk is this full, in percent (default: 70).', type=float,
+                        default=70, required=False)
+    parser.add_argument('--max-age-days', help='Also evict workspaces idle for longer than this (default: 14, 0 for '
+                        'no limit).', type=float, default=14, required=False)
+    parser.add_argument('--min-idle-hours', help='Never evict workspaces used more recently than this (default: 1).',
+                        type=float, default=1, required=False)
+    parser.add_argument('-j', '--jobs', help='Workspaces deleted at the same time (default: 4).', type=int, default=4,
+                        required=False)
+    parser.add_argument('-n', '--dry-run', help='Show what would be evicted without deleting anything.',
+                        action='store_true', required=False)
+    parser.add_argument('--status', help='List the workspaces by plan and branch, marking what would be evicted.',
+                        action='store_true', required=False)
+    args = parser.parse_args()
+
+    if args.low > args.high:
+        parser.error('--low must not be above --high')
+
+    build_dir = expanduser(args.build_dir)
+    if not isdir(build_dir):
+        print('Build dir {} does not exist; nothing to collect.'.format(build_dir))
+        return 0
+
+    # launchd may start a collection while the previous one is still deleting.
+    with open(join(build_dir, lock_name), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            print('Another collection is already running.')
+            return 0
+        return collect(build_dir, args.high, args.low, args.max_age_days * 86400, args.min_idle_hours * 3600,
+                       args.jobs, args.dry_run, args.status)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,52 +1,29 @@
 #!/usr/bin/env python
 import argparse
-import re
+import os
 import sys
-import subprocess
-
-from os import chdir, getcwd, mkdir
-from os.path import expanduser, isdir, join
-
-brew_packages = [
-    "mercurial",
-    "google-app-engine",
-    "android-sdk",
-    "android-ndk",
-    "ant",
-    "git",
-    "perforce",
-    "heroku-toolbelt",
-    "vorbis-tools",
-    "fontforge",
-    "webp",
-    "backflip-brew-tools"
-]
-
-homebrew_taps = [
-    "homebrew/versions",
-    "homebrew/binary",
-    "homebrew/dupes",
-    "devbfs/homebrew-formulas"
-]
-
-pip_packages = [
-    ["docutils"],
-    ["keyring"],
-    ["mercurial_keyring"],
-    ["pycrypto==2.6"],
-    ["boto"],
-    ["simplejson"],
-    ["sphinx"],
-    ["sphinxcontrib-googleanalytics"]
-]
-
-gem_packages = [
-    "json",
-    "open4",
-    "rest_client",
-    "facter",
-    "systemu"
-]
+
+import artifact_cache
+import batching
+import engine
+import history
+import inventory
+import journal
+import manifest
+import metrics
+import policy
+import preflight
+import renderer
+import retries
+import runner
+import scheduler
+import sdk_catalog
+import tracing
+
+from glob import glob
+from os.path import expanduser, isfile, join
+
+logger = runner.logger
 
 repositories_cfg = '''count=1
 src00=https\://s3.amazonaws.com/android-sdk-manager/redist/addon.xml
@@ -54,39 +31,22 @@ src00=https\://s3.amazonaws.com/android-sdk-manager/redist/addon.xml
 
 
 def communicate(args, exit_on_error=True, **kwargs):
-    input_data = kwargs['input'] if 'input' in kwargs else None
-
-    p = subprocess.Popen(args,
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                         cwd=(kwargs['cwd'] if 'cwd' in kwargs else None))
-
-    stdout_data, stderr_data = p.communicate(input=input_data)
+    result = engine.run(args, input=kwargs.get('input'), cwd=kwargs.get('cwd'), capture=True, echo=False)
 
-    if p.returncode != 0:
+    if result.returncode != 0:
         logger.error(' '.join(args))
-        logger.error('{}'.format(stderr_data.rstrip()))
+        logger.error('{}'.format(result.tail_text.rstrip()))
 
         if exit_on_error:
             sys.exit(1)
         else:
-            return stderr_data
-
-    return stdout_data.strip()
-
+            return result.tail_text
 
-def call(args):
-    ret = subprocess.call(args)
-    return ret
+    return result.output.strip()
 
 
-def ask_or_exit(ret):
-    while True:
-        choice = raw_input("Continue? (y/n): ")
-        if choice == "y" or choice == "Y":
-            break
-        elif choice == "n" or choice == "N":
-            print("Aborting.")
-            sys.exit(ret)
+def call(args, **kwargs):
+    return engine.run(args, input=kwargs.get('input'), cwd=kwargs.get('cwd')).returncode
 
 
 def install_call(args, fail_on_error, quiet=False):
@@ -95,164 +55,299 @@ def install_call(args, fail_on_error, quiet=False):
         print("\nERROR: Failed to install package: {}".format(args))
         if fail_on_error:
             sys.exit(ret)
-        elif not quiet:
-            ask_or_exit(ret)
+        ret = policy.handle_failure(args, ret, lambda: call(args), prompt=not quiet)
+    return ret
 
 
 def brew_install(package_name, fail_on_error, quiet=False):
-    install_call(["brew", "install"] + package_name.split(), fail_on_error, quiet)
+    return install_call(["brew", "install"] + package_name.split(), fail_on_error, quiet)
 
 
 def pip_install(package_props, fail_on_error, quiet=False):
-    install_call(["pip", "install"] + package_props, fail_on_error, quiet)
+    return install_call(["pip", "install"] + package_props, fail_on_error, quiet)
 
 
 def gem_install(package_name, fail_on_error, quiet=False):
-    install_call(["gem", "install"] + package_name.split(), fail_on_error, quiet)
+    return install_call(["gem", "install"] + package_name.split() + artifact_cache.manager_args("gem"), fail_on_error,
+                        quiet)
 
 
-def validate_path():
-    p1 = subprocess.Popen(["/usr/bin/env"], stdout=subprocess.PIPE, shell=False)
-    p2 = subprocess.Popen(["grep", "PATH"], stdin=p1.stdout, stdout=subprocess.PIPE, shell=False)
-
-    path, error = p2.communicate()
-    if p2.returncode != 0:
-        return False
+def brew_install_all(package_names, fail_on_error, quiet=False):
+    package_names = inventory.missing("brew", package_names)
+    return batching.batch_install("brew", package_names, brew_install, fail_on_error, quiet)
 
-    if path is None:
-        return False
 
-    idx1 = path.find("/usr/local/bin")
-    idx2 = path.find("/usr/bin")
+def pip_install_all(package_props_list, fail_on_error, quiet=False):
+    package_props_list = inventory.missing("pip", package_props_list)
+    return batching.batch_install("pip", package_props_list, pip_install, fail_on_error, quiet)
 
-    if idx1 > idx2:
-        return False
 
-    return True
+def gem_install_all(package_names, fail_on_error, quiet=False):
+    package_names = inventory.missing("gem", package_names)
+    return batching.batch_install("gem", package_names, gem_install, fail_on_error, quiet)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Developer machine setup script..")
     parser.add_argument("-q", "--quiet", help="Quiet mode. Suppresses error messages from most failed installations.",
                         action="store_true", required=False)
+    parser.add_argument("--no-batch", help="Install packages one at a time instead of one batch per package manager.",
+                        action="store_true", required=False)
+    parser.add_argument("-f", "--force", help="Install packages even if they are already installed.",
+                        action="store_true", required=False)
+    parser.add_argument("--from-scratch", help="Ignore the journal of a previous interrupted run and redo every step.",
+                        action="store_true", required=False)
+    parser.add_argument("--cache", help="Route downloads through a local artifact cache kept in this directory.",
+                        required=False)
+    parser.add_argument("--cache-url", help="Route downloads through a shared artifact cache server.", required=False)
+    parser.add_argument("--cache-size", help="Maximum size of the local artifact cache, e.g. 50G.",
+                        type=artifact_cache.parse_size, default=artifact_cache.default_max_size, required=False)
+    parser.add_argument("--timeout", help="Terminate any single command that runs for longer than this many seconds.",
+                        type=int, required=False)
+    parser.add_argument("--deadline", help="Terminate the run if it takes longer than this many seconds in total.",
+                        type=int, required=False)
+    parser.add_argument("--on-failure", help="What to do when a step fails (default: prompt, or continue with -q).",
+                        choices=policy.policies, required=False)
+    parser.add_argument("--policy", help="Failure policy for a profile and/or package manager, e.g. brew=retry or "
+                        "agent.*=continue. May be repeated.", type=policy.parse_rule, action="append", default=[],
+                        required=False)
+    parser.add_argument("--trace", help="Append a timing trace of the run to this file (default: ~/.dev_trace.jsonl).",
+                        default="~/.dev_trace.jsonl", required=False)
+    parser.add_argument("--no-trace", help="Don't record a timing trace.", action="store_true", required=False)
+    parser.add_argument("--retries", help="Extra attempts for network commands that fail with a timeout or a "
+                        "connection error (default: 3, 0 for none).", type=int, default=retries.attempts,
+                        required=False)
+    parser.add_argument("--history", help="Durations of past runs, used to start the longest work first and "
+                        "estimate time left (default: ~/.dev_history.json).", default="~/.dev_history.json",
+                        required=False)
+    parser.add_argument("--metrics-dir", help="Write Prometheus metrics for the run to this node-exporter textfile "
+                        "directory.", required=False)
+    parser.add_argument("--manifest", help="Package manifest to install from (default: manifest.json next to this "
+                        "script).", default=manifest.default_path, required=False)
     args = parser.parse_args()
 
-    clang = communicate(["xcrun", "clang", "--version"])
-    if clang is None:
-        print("ERROR: Xcode command line tools are not installed. "
-              "Please install the command line tools before continuing.")
+    runner.configure_log("~/.dev.log")
+    runner.command_timeout = args.timeout
+    runner.set_deadline(args.deadline)
+    retries.attempts = args.retries
+    if not args.no_trace:
+        tracing.configure(args.trace, "dev")
+    history.load(args.history)
+    if args.metrics_dir:
+        metrics.configure(args.metrics_dir, "dev")
+    policy.configure(args.on_failure or (policy.CONTINUE if args.quiet else None), args.policy)
+
+    batching.enabled = not args.no_batch
+    inventory.enabled = not args.force
+    artifact_cache.configure(args.cache, args.cache_url, args.cache_size)
+
+    try:
+        plan = manifest.load_plan(args.manifest, ["dev"], "~/.dev_plan.json")
+    except (IOError, ValueError) as e:
+        print("ERROR: Could not load the manifest: {}".format(e))
         return 1
 
-    brew = communicate(["brew", "--version"])
-    if brew is None:
-        print("ERROR: Homebrew was not found. Please install homebrew first:\n\n"
-              "ruby -e \"$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/master/install)\"\n\n"
-              "Don't forget to run brew doctor and resolve any issues before continuing.\n\n")
+    if plan.converged and not args.force and not args.from_scratch:
+        print("Nothing to do: the manifest hasn't changed since the last successful run. Use -f to check anyway.")
+        return 0
+
+    probes = [
+        preflight.Probe("xcode", ["xcrun", "clang", "--version"], watch=["/var/db/xcode_select_link"],
+                        help="Xcode command line tools are not installed. "
+                             "Please install the command line tools before continuing."),
+        preflight.Probe("homebrew", ["brew", "--version"],
+                        help="Homebrew was not found. Please install homebrew first:\n\n"
+                             "ruby -e \"$(curl -fsSL "
+                             "https://raw.githubusercontent.com/Homebrew/install/master/install)\"\n\n"
+                             "Don't forget to run brew doctor and resolve any issues before continuing.\n"),
+        preflight.Probe("java", ["java", "-version"],
+                        help="Please install java before continuing:\n\n"
+                             "http://support.apple.com/kb/DL1572?viewlocale=en_US\n"),
+        preflight.Probe("path", check=preflight.check_path_order,
+                        help="/usr/bin occurs before /usr/local/bin.\n\n"
+                             "Here is a one-liner:\n\necho export PATH=\"/usr/local/bin:$PATH\" >> ~/.bash_profile\n")
+    ]
+    if not preflight.run(probes):
         return 1
 
-    java = communicate(["java", "-version"])
-    if java is None:
-        print("ERROR: Please install java before continuing:\n\n"
-              "http://support.apple.com/kb/DL1572?viewlocale=en_US\n\n")
+    journal.load(expanduser("~/.dev_journal"), args.from_scratch)
+
+    brew_packages = plan.entries("dev", "brew")
+
+    schedule = scheduler.Scheduler()
+    # Updating Homebrew, checking it and adding taps are only worth it when there is a formula to install.
+    taps = []
+    if inventory.missing("brew", ["python", "ruby"] + brew_packages):
+        schedule.add("brew-update", brew_update, manager="brew")
+        schedule.add("brew-doctor", brew_doctor, manager="brew", deps=["brew-update"])
+
+        taps = [schedule.add("tap:" + tap, brew_tap, tap, manager="brew", deps=["brew-doctor"])
+                for tap in plan.entries("dev", "taps")]
+
+    schedule.add("brew:python", brew_install_all, ["python"], True, manager="brew", deps=taps)
+    schedule.add("brew:ruby", brew_install_all, ["ruby"], True, manager="brew", deps=taps)
+    schedule.add("check:python", validate_interpreter, "python", deps=["brew:python"])
+    schedule.add("check:ruby", validate_interpreter, "ruby", deps=["brew:ruby"])
+
+    pip_packages = plan.entries("dev", "pip")
+    gem_packages = plan.entries("dev", "gem")
+    schedule.add("brew:packages", brew_install_all, brew_packages, False, args.quiet, manager="brew", deps=taps,
+                 inputs=brew_packages)
+    schedule.add("pip:packages", pip_install_all, pip_packages, False, args.quiet, manager="pip",
+                 deps=["check:python"], inputs=pip_packages)
+    schedule.add("gem:packages", gem_install_all, gem_packages, False, args.quiet, manager="gem",
+                 deps=["check:ruby"], inputs=gem_packages)
+
+    # The SDK manager itself comes from the android-sdk formula.
+    schedule.add("android-sdk", install_android_sdk_packages, manager="android", deps=["brew:packages"])
+
+    # Only a run that got to the end can count as a success; SystemExit, Ctrl-C and errors leave this unset.
+    completed = False
+    try:
+        schedule.run()
+        completed = True
+    finally:
+        artifact_cache.report()
+        retries.report()
+        failed = policy.report()
+        tracing.finish()
+        history.save()
+        metrics.export(completed and not failed)
+
+    if failed:
         return 1
 
-    if not validate_path():
-        print("ERROR: /usr/bin occurs before /usr/local/bin.\n\n"
-              "Here is a one-liner:\n\necho export PATH=\"/usr/local/bin:$PATH\" >> ~/.bash_profile\n")
-        return 1
+    # Steps skipped at the prompt are tried again by the next run.
+    if not policy.skipped():
+        manifest.mark_converged(plan, "~/.dev_plan.json")
+    return 0
 
+
+def brew_update():
     print("Updating Homebrew...")
     ret = call(["brew", "update"])
     if ret != 0:
         print("WARNING: brew update returned response: {}".format(ret))
-        ask_or_exit(ret)
+        ret = policy.handle_failure(["brew", "update"], ret, lambda: call(["brew", "update"]))
+    return ret
 
+
+def brew_doctor():
     ret = call(["brew", "doctor"])
     if ret != 0:
         print("WARNING: brew doctor returned error response. Please resolve all issues before continuing.")
-        ask_or_exit(ret)
-
-    print("Adding additional homebrew taps...")
-    for tap in homebrew_taps:
-        ret = call(["brew", "tap", tap])
-        if ret != 0:
-            print("WARNING: brew tap {} returned response: {}".format(tap, ret))
-            ask_or_exit(ret)
-
-    print("Installing python...")
-    brew_install("python", True)
-
-    print("Installing ruby...")
-    brew_install("ruby", True)
+        ret = policy.handle_failure(["brew", "doctor"], ret, lambda: call(["brew", "doctor"]))
+    return ret
 
-    path = communicate(["which", "python"])
-    if path is None or path != "/usr/local/bin/python":
-        print("ERROR: Python environment is not configured properly. "
-              "Ensure that /usr/local/bin is listed before /usr/bin in your PATH.")
-        return 1
 
-    path = communicate(["which", "ruby"])
-    if path is None or path != "/usr/local/bin/ruby":
-        print("ERROR: Ruby environment is not configured properly. "
-              "Ensure that /usr/local/bin is listed before /usr/bin in your PATH.")
-        return 1
+def brew_tap(tap):
+    print("Adding homebrew tap {}...".format(tap))
+    ret = call(["brew", "tap", tap])
+    if ret != 0:
+        print("WARNING: brew tap {} returned response: {}".format(tap, ret))
+        ret = policy.handle_failure(["brew", "tap", tap], ret, lambda: call(["brew", "tap", tap]))
+    return ret
 
-    print("Installing BREW packages...")
-    for brew_package in brew_packages:
-        brew_install(brew_package, False, args.quiet)
 
-    print("Installing PIP packages...")
-    for pip_package in pip_packages:
-        pip_install(pip_package, False, args.quiet)
+def validate_interpreter(name):
+    # The Homebrew interpreter must come first on PATH. HOMEBREW_PREFIX is set for brew installed somewhere other
+    # than /usr/local.
+    bin_dir = join(os.environ.get("HOMEBREW_PREFIX", "/usr/local"), "bin")
+    path = preflight.which(name)
+    if path != join(bin_dir, name):
+        print("ERROR: {} environment is not configured properly. "
+              "Ensure that {} is listed before /usr/bin in your PATH.".format(name.capitalize(), bin_dir))
+        sys.exit(1)
 
-    print("Installing GEM packages...")
-    for gem_package in gem_packages:
-        gem_install(gem_package, False, args.quiet)
 
-    install_android_sdk_packages()
+def install_android_sdk_packages():
+    create_repositories_cfg()
+    catalog = sdk_catalog.load(list_sdk_packages, repositories_cfg)
 
-    return 0
+    # Only hand the SDK manager what isn't already on disk, and do it in a single update so the repository manifests
+    # are fetched and the licenses accepted once.
+    sdk_path = sdk_catalog.get_android_sdk_path()
+    components = [component for component in get_android_sdk_components(catalog)
+                  if not is_sdk_component_installed(sdk_path, component, catalog)]
+    if not components:
+        print('All Android SDK components are up to date.')
+        return
 
+    install_packages_by_name(components)
 
-def install_android_sdk_packages():
-    create_repositories_cfg()
-    packages = list_sdk_packages()
 
-    # Install the latest Android SDK tools.
-    install_package_by_name('tool')
+def get_android_sdk_components(catalog):
+    components = [
+        # The latest Android SDK tools.
+        'tool',
 
-    # Install the latest Android SDK Platform-tools.
-    install_package_by_name('platform-tool')
+        # The latest Android SDK Platform-tools.
+        'platform-tool'
+    ]
 
-    # Install all versions of the SDK starting with API 10 (Gingerbread 2.3.3).
-    for x in range(10, get_latest_sdk_version(packages) + 1):
-        install_package_by_name('android-{}'.format(x))
+    # All versions of the SDK starting with API 10 (Gingerbread 2.3.3).
+    components += ['android-{}'.format(x) for x in range(10, get_latest_sdk_version(catalog) + 1)]
 
-    # Install the latest Build tools.
-    install_package_by_name('build-tools-{}'.format(get_latest_build_tools_version(packages)))
+    # The latest Build tools.
+    components.append(get_latest_build_tools(catalog))
 
-    # Install version 21.1.2 of the Build tools. This is a workaround for zipalign and other build tools that did not
-    # update their path to use the latest version of the build tools.
+    # Version 21.1.2 of the Build tools. This is a workaround for zipalign and other build tools that did not update
+    # their path to use the latest version of the build tools.
     # Remove this after they fix this issue.
-    install_package_by_name('build-tools-21.1.2')
-
-    # Install the Fire Phone SDK. This is needed to build DragonVale Amazon.
-    install_fire_phone_sdk(packages)
+    components.append('build-tools-21.1.2')
+
+    # The Fire Phone SDK. This is needed to build DragonVale Amazon.
+    components.append(get_latest_fire_phone_sdk(catalog))
+
+    # The Fire Phone Build Tools. Also for DV Amazon.
+    components.append('extra-amazon-buildtools')
+
+    return components
+
+
+def is_sdk_component_installed(sdk_path, component, catalog):
+    if component in ('tool', 'platform-tool'):
+        # These track the latest release, so they are only current if the installed revision matches the catalog.
+        package_id = component + 's'
+        properties = sdk_catalog.read_source_properties(join(sdk_path, package_id, 'source.properties'))
+        installed = properties.get('Pkg.Revision')
+        if installed is None:
+            return False
+        available = catalog.get(package_id)
+        if available is None or available.revision is None:
+            return True
+        return sdk_catalog.version_key(installed) >= sdk_catalog.version_key(available.revision)
+
+    if component.startswith('android-'):
+        return isfile(join(sdk_path, 'platforms', component, 'source.properties'))
+
+    if component.startswith('build-tools-'):
+        return isfile(join(sdk_path, 'build-tools', component[len('build-tools-'):], 'source.properties'))
+
+    if component.startswith('extra-'):
+        vendor, path = component[len('extra-'):].split('-', 1)
+        return isfile(join(sdk_path, 'extras', vendor, path, 'source.properties'))
+
+    if component.startswith('addon-'):
+        # Add-on directory names don't always follow the package id, so match on the properties instead.
+        # addon-<name>-<vendor>-<api level>
+        name, vendor, api = component[len('addon-'):].rsplit('-', 2)
+        for addon in glob(join(sdk_path, 'add-ons', '*', 'source.properties')):
+            properties = sdk_catalog.read_source_properties(addon)
+            if (properties.get('Addon.NameId') == name and properties.get('Addon.VendorId') == vendor and
+                    properties.get('AndroidVersion.ApiLevel') == api):
+                return True
+        return False
 
-    # Install the Fire Phone Build Tools. Also for DV Amazon.
-    install_package_by_name('extra-amazon-buildtools')
+    return False
 
 
 def create_repositories_cfg():
     # This is a workaround to the fact that there is no way to define user-defined sites for android through the
     # command line. We create a file called repositories.cfg in ~/.android which we point to Amazon so we can install
     # the Fire Phone SDK and Build Tools.
-    dot_android_path = expanduser('~/.android')
-    if not isdir(dot_android_path):
-        mkdir(dot_android_path)
-
-    with open(join(dot_android_path, 'repositories.cfg'), 'w') as f:
-        f.write(repositories_cfg)
+    renderer.render('~/.android/repositories.cfg', repositories_cfg)
+    renderer.commit()
 
 
 def list_sdk_packages():
@@ -264,11 +359,11 @@ def list_sdk_packages():
         '-a',
         '-e'
     ]
-    return communicate(args)
+    return communicate(args + artifact_cache.manager_args('android'))
 
 
-def install_package_by_name(filter_name):
-    print 'Installing {}.'.format(filter_name)
+def install_packages_by_name(filter_names):
+    print 'Installing {}.'.format(', '.join(filter_names))
     args = [
         'android',
         'update',
@@ -276,26 +371,26 @@ def install_package_by_name(filter_name):
         '-u',
         '-a',
         '-t',
-        filter_name
+        ','.join(filter_names)
     ]
-    print communicate(args, input="y")
+    # The SDK manager asks once for every license the batch needs; answering once per component covers them all.
+    if call(args + artifact_cache.manager_args('android'), input="y\n" * len(filter_names)) != 0:
+        logger.error(' '.join(args))
+        sys.exit(1)
 
 
-def get_latest_build_tools_version(packages):
+def get_latest_build_tools(catalog):
     # Build tools doesn't have its own filter so we have to find the latest version ourselves.
-    return re.search('(?<="build-tools-)\d+\.\d+\.\d+', packages).group()
+    return catalog.latest_build_tools().id
 
 
-def get_latest_sdk_version(packages):
-    # Search through the output to find the latest version of the sdk.
-    # This matches any number of digits only if it's preceded by the string '"android-'.
-    return int(re.search('(?<="android-)\d+', packages).group())
+def get_latest_sdk_version(catalog):
+    return catalog.latest_platform_api()
 
 
-def install_fire_phone_sdk(packages):
+def get_latest_fire_phone_sdk(catalog):
     # Get the latest version of the Fire Phone SDK.
-    version = re.search('(?<="addon-amazon_fire_phone_addon-amazon-)\d+', packages).group()
-    install_package_by_name('addon-amazon_fire_phone_addon-amazon-' + version)
+    return catalog.latest_addon('addon-amazon_fire_phone_addon-amazon-').id
 
 
 if __name__ == '__main__':
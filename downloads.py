@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+"""Resumable, checksum-verified downloads of large artifacts over parallel byte ranges.
+
+Homebrew fetches a formula's archive in a single request, so a connection dropped halfway through a multi-gigabyte
+Xcode, Unity or NDK archive starts it over from the first byte. panda.py -a runs a download stage before the agent's
+brew installs: every archive of at least min_size is fetched in chunk_size ranges over several connections into
+<file>.part, and the ranges that are complete are recorded next to it in <file>.part.json, so an interrupted
+download carries on where it stopped, in this run or the next one. Completed ranges are hashed in order while the
+rest are still downloading, and the file is only moved to the path 'brew --cache' names once it matches the
+formula's sha256; brew install then finds it there and skips its own download.
+
+    python downloads.py fetch URL DEST [--sha256 HEX]
+    python downloads.py serve DIR --drop-rate 0.3    # local stand-in that cuts connections, for trying it out
+
+Servers that ignore range requests (the artifact cache among them) get a single stream, restarted on failure.
+"""
+import BaseHTTPServer
+import Queue
+import SocketServer
+import argparse
+import hashlib
+import httplib
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib2
+
+from os.path import dirname, exists, expanduser, getsize, isdir, isfile, join
+
+import artifact_cache
+import engine
+import inventory
+
+# Connections per download (--download-jobs).
+jobs = 4
+
+# Archives smaller than this are left for brew to fetch itself.
+min_size = 100 * 1024 ** 2
+
+chunk_size = 32 * 1024 ** 2
+block_size = 256 * 1024
+
+# Attempts at a range without making any progress before the download is given up.
+attempts = 6
+
+# Seconds a connection may sit without receiving anything.
+timeout = 60
+
+_transient_errors = (urllib2.URLError, IOError, socket.error, httplib.HTTPException)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Remote(object):
+    def __init__(self, url, size, ranges, validator):
+        # url: where the request ended up after redirects. validator: ETag or Last-Modified, so a partial file is
+        # only resumed against the same version of the artifact.
+        self.url = url
+        self.size = size
+        self.ranges = ranges
+        self.validator = validator
+
+
+def probe(url):
+    # A one byte range request answers whether ranges are supported and how big the file is.
+    request = urllib2.Request(url, headers={'Range': 'bytes=0-0'})
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except _transient_errors as e:
+        raise DownloadError('Could not reach {}: {}'.format(url, e))
+    try:
+        info = response.info()
+        validator = info.getheader('ETag') or info.getheader('Last-Modified')
+        if response.getcode() == 206:
+            match = re.match(r'^bytes 0-0/(\d+)$', (info.getheader('Content-Range') or '').strip())
+            if match:
+                return Remote(response.geturl(), int(match.group(1)), True, validator)
+        length = info.getheader('Content-Length')
+        return Remote(response.geturl(), int(length) if length else None, False, validator)
+    finally:
+        response.close()
+
+
+def _backoff(failures):
+    return min(30, 2 ** failures) * random.uniform(0.5, 1.0)
+
+
+def _fetch_range(remote, part_path, start, end):
+    # Writes bytes start..end (inclusive) into the part file at the same offset, reconnecting from the last byte
+    # received when the connection drops.
+    offset = start
+    failures = 0
+    with open(part_path, 'r+b') as f:
+        while offset <= end:
+            reached = offset
+            try:
+                request = urllib2.Request(remote.url, headers={'Range': 'bytes={}-{}'.format(offset, end)})
+                response = urllib2.urlopen(request, timeout=timeout)
+                try:
+                    if response.getcode() != 206:
+                        raise DownloadError('{} stopped honouring range requests'.format(remote.url))
+                    f.seek(offset)
+                    while offset <= end:
+                        data = response.read(min(block_size, end + 1 - offset))
+                        if not data:
+                            break
+                        f.write(data)
+                        offset += len(data)
+                finally:
+                    response.close()
+                if offset <= end:
+                    raise IOError('connection closed after {} of {} bytes'.format(offset - start, end + 1 - start))
+            except _transient_errors as e:
+                failures = 1 if offset > reached else failures + 1
+                if failures >= attempts:
+                    raise DownloadError('{}: {}'.format(remote.url, e))
+                time.sleep(_backoff(failures))
+
+
+def _fetch_whole(remote, part_path):
+    # No ranges: one stream, hashed as it arrives and started over after a failure.
+    failures = 0
+    while True:
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            response = urllib2.urlopen(remote.url, timeout=timeout)
+            try:
+                with open(part_path, 'wb') as f:
+                    while True:
+                        data = response.read(block_size)
+                        if not data:
+                            break
+                        sha.update(data)
+                        f.write(data)
+                        size += len(data)
+            finally:
+                response.close()
+            if remote.size is not None and size != remote.size:
+                raise IOError('connection closed after {} of {} bytes'.format(size, remote.size))
+            return sha.hexdigest()
+        except _transient_errors as e:
+            failures += 1
+            if failures >= attempts:
+                raise DownloadError('{}: {}'.format(remote.url, e))
+            time.sleep(_backoff(failures))
+
+
+def _load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_state(state_path, state):
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(temp_path, state_path)
+
+
+def _fetch_chunks(remote, part_path, state_path, state):
+    # Downloads the missing chunks on up to `jobs` connections while this thread hashes the completed ones in order,
+    # reading them back while they are still in the page cache. Returns the sha256 of the whole file.
+    size = state['size']
+    chunks = [(start, min(start + state['chunk_size'], size) - 1) for start in range(0, size, state['chunk_size'])]
+    done = set(state['done'])
+
+    pending = Queue.Queue()
+    for i in range(len(chunks)):
+        if i not in done:
+            pending.put(i)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                _fetch_range(remote, part_path, *chunks[i])
+                finished.put((i, None))
+            except Exception as e:
+                finished.put((i, e))
+
+    outstanding = pending.qsize()
+    for _ in range(min(jobs, outstanding)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    sha = hashlib.sha256()
+    hashed = 0
+    error = None
+    with open(part_path, 'rb') as f:
+        while True:
+            while hashed < len(chunks) and hashed in done:
+                start, end = chunks[hashed]
+                f.seek(start)
+                remaining = end + 1 - start
+                while remaining:
+                    data = f.read(min(block_size, remaining))
+                    sha.update(data)
+                    remaining -= len(data)
+                hashed += 1
+            if not outstanding:
+                break
+
+            try:
+                i, e = finished.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            outstanding -= 1
+            if e is not None:
+                # Let the ranges already in flight finish and be recorded, but start no more.
+                error = error or e
+                while True:
+                    try:
+                        pending.get_nowait()
+                        outstanding -= 1
+                    except Queue.Empty:
+                        break
+                continue
+            done.add(i)
+            state['done'] = sorted(done)
+            _save_state(state_path, state)
+
+    if error is not None:
+        raise error
+    return sha.hexdigest()
+
+
+def download(url, dest, sha256=None):
+    """Downloads url to dest and returns its sha256.
+
+    Raises DownloadError when the server can't be reached, stops answering, or the file doesn't match sha256. A
+    partial download is kept for the next attempt unless it turned out to be corrupt.
+    """
+    dest = expanduser(dest)
+    part_path = dest + '.part'
+    state_path = part_path + '.json'
+    if dirname(dest) and not isdir(dirname(dest)):
+        os.makedirs(dirname(dest))
+
+    remote = probe(url)
+    if remote.ranges and remote.size:
+        state = _load_state(state_path)
+        fresh = {'url': url, 'size': remote.size, 'validator': remote.validator, 'chunk_size': chunk_size}
+        if any(state.get(key) != value for key, value in fresh.items()) or not isfile(part_path) or \
+                getsize(part_path) != remote.size:
+            state = dict(fresh, done=[])
+            with open(part_path, 'wb') as f:
+                f.truncate(remote.size)
+            _save_state(state_path, state)
+        elif state['done']:
+            print('Resuming {}: {} of {} MB already downloaded.'.format(
+                url, min(len(state['done']) * chunk_size, remote.size) // 1024 ** 2, remote.size // 1024 ** 2))
+        digest = _fetch_chunks(remote, part_path, state_path, state)
+    else:
+        digest = _fetch_whole(remote, part_path)
+
+    if sha256 and digest != sha256.lower():
+        for path in (part_path, state_path):
+            if exists(path):
+                os.remove(path)
+        raise DownloadError('Checksum mismatch for {}: expected {}, got {}.'.format(url, sha256.lower(), digest))
+
+    os.rename(part_path, dest)
+    if exists(state_path):
+        os.remove(state_path)
+    return digest
+
+
+def source_url(url):
+    # Through the artifact cache when there is one, in its mirror style (http://cache/host/path).
+    if artifact_cache.cache_url is None:
+        return url
+    return '{}/{}'.format(artifact_cache.cache_url, url.split('://', 1)[-1])
+
+
+def formula_download(name):
+    # (url, sha256, cache path) of a formula's archive according to brew, or None when brew can't say.
+    info = engine.run(['brew', 'info', '--json=v1', name], capture=True, echo=False)
+    cache = engine.run(['brew', '--cache', name], capture=True, echo=False)
+    if info.returncode != 0 or cache.returncode != 0:
+        return None
+    try:
+        stable = json.loads(info.output)[0]['urls']['stable']
+    except (ValueError, IndexError, KeyError, TypeError):
+        return None
+    if not stable.get('url') or not cache.output.strip():
+        return None
+    return stable['url'], stable.get('checksum'), cache.output.strip()
+
+
+def prefetch_formulas(package_names):
+    # Downloads the archives of the formulas that aren't installed yet into Homebrew's cache. Returns the names whose
+    # download failed; brew install still tries those itself.
+    failed = []
+    for name in inventory.missing('brew', package_names):
+        name = name.split()[0]
+        found = formula_download(name)
+        if found is None:
+            continue
+        url, sha256, cache_path = found
+        if exists(cache_path):
+            continue
+        try:
+            remote = probe(source_url(url))
+            if remote.size is not None and remote.size < min_size:
+                continue
+            print('Downloading {} ({} MB)...'.format(name, remote.size // 1024 ** 2 if remote.size else '?'))
+            download(source_url(url), cache_path, sha256)
+        except (DownloadError, OSError) as e:
+            print('WARNING: Could not download {}; leaving it to brew: {}'.format(name, e))
+            failed.append(name)
+    return failed
+
+
+class FlakyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves files with range support, cutting a share of the responses off partway through.
+    def do_GET(self):
+        path = join(self.server.root, self.path.lstrip('/').split('?')[0])
+        if '..' in self.path or not isfile(path):
+            return self.send_error(404)
+        size = getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                return self.send_error(416)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('ETag', '"{}-{}"'.format(size, int(os.stat(path).st_mtime)))
+        self.end_headers()
+
+        length = end + 1 - start
+        if length > 1 and random.random() < self.server.drop_rate:
+            length = random.randint(0, length - 1)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while length:
+                data = f.read(min(block_size, length))
+                if not data:
+                    break
+                self.wfile.write(data)
+                length -= len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FlakyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, drop_rate):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FlakyHandler)
+        self.root = root
+        self.drop_rate = drop_rate
+
+
+def main():
+    global jobs, chunk_size
+    parser = argparse.ArgumentParser(description='Resumable parallel downloads, and a flaky server to try them on.')
+    subparsers = parser.add_subparsers(dest='command')
+    fetch = subparsers.add_parser('fetch', help='Download a file.')
+    fetch.add_argument('url')
+    fetch.add_argument('dest')
+    fetch.add_argument('--sha256', help='Expected checksum.', required=False)
+    fetch.add_argument('-j', '--jobs', help='Connections (default: 4).', type=int, default=jobs, required=False)
+    fetch.add_argument('--chunk-size', help='Bytes per range, e.g. 32M.', type=artifact_cache.parse_size,
+                       default=chunk_size, required=False)
+    serve = subparsers.add_parser('serve', help='Serve a directory, dropping connections at random.')
+    serve.add_argument('dir')
+    serve.add_argument('-p', '--port', help='Port to listen on (default: 8081).', type=int, default=8081,
+                       required=False)
+    serve.add_argument('--drop-rate', help='Share of responses cut off partway (default: 0.3).', type=float,
+                       default=0.3, required=False)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = FlakyServer(('127.0.0.1', args.port), expanduser(args.dir), args.drop_rate)
+        print('Serving {} on port {}, dropping {:.0%} of responses...'.format(args.dir, args.port, args.drop_rate))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    jobs = args.jobs
+    chunk_size = args.chunk_size
+    start = time.time()
+    try:
+        digest = download(args.url, args.dest, args.sha256)
+    except DownloadError as e:
+        print('ERROR: {}'.format(e))
+        return 1
+    print('{}  {} ({:.1f}s)'.format(digest, args.dest, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
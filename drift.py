@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+"""Drift detection for provisioned agents, read straight from the filesystem without running brew, pip or gem.
+
+After every successful run panda.py records a baseline in ~/.panda_baseline.json: the installed versions of each
+package in its plan, read from the version directories in the Cellar, the dist-info and egg-info metadata in
+site-packages and the gem specifications; the revision of each Android SDK package from its source.properties; and a
+hash of each configuration file it rendered. Checking an agent against it takes a few hundred stat and listdir calls:
+
+    python panda.py -a --verify    # compare with the baseline and hand only what drifted to the installers
+    python drift.py verify         # just report; exits 1 when something drifted
+    python drift.py watch          # report drift as it happens
+
+Packages added since the baseline aren't drift; packages removed, or replaced by another version, are.
+
+The watcher is woken by inotify where the kernel has it and otherwise polls the modification times of the
+directories involved, which is cheap enough to do every second.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import re
+import select
+import sys
+import time
+
+from collections import namedtuple
+from distutils.sysconfig import get_python_lib
+from glob import glob
+from os.path import dirname, expanduser, isdir, join, realpath
+
+import batching
+import inventory
+import manifest
+import preflight
+import sdk_catalog
+
+default_baseline_path = '~/.panda_baseline.json'
+
+# Seconds between checks when the watcher has to poll.
+poll_interval = 1.0
+
+# What changed for one package, SDK component or configuration file. expected and found are version lists, revisions
+# or hashes; found is None when the item is gone.
+Drift = namedtuple('Drift', ['kind', 'name', 'expected', 'found'])
+
+_dist_pattern = re.compile(r'^(.+?)-(\d[^-]*?)(?:-py\d[\d.]*)?(?:-[^-]+)?\.(?:dist-info|egg-info)$')
+_gemspec_pattern = re.compile(r'^(.+?)-(\d[\w.]*)(?:-[^-].*)?\.gemspec$')
+
+
+def brew_prefix():
+    # Where brew itself lives, found without asking it.
+    if os.environ.get('HOMEBREW_PREFIX'):
+        return os.environ['HOMEBREW_PREFIX']
+    brew = preflight.which('brew')
+    return dirname(dirname(realpath(brew))) if brew else '/usr/local'
+
+
+def gem_dirs(prefix):
+    candidates = [os.environ.get('GEM_HOME')] + glob(join(prefix, 'lib', 'ruby', 'gems', '*')) + \
+        glob('/Library/Ruby/Gems/*')
+    return [directory for directory in candidates if directory and isdir(join(directory, 'specifications'))]
+
+
+def locations():
+    # The directories a scan reads, found the same way every time.
+    prefix = brew_prefix()
+    return {'cellar': join(prefix, 'Cellar'), 'site-packages': get_python_lib(), 'gems': gem_dirs(prefix),
+            'android': sdk_catalog.get_android_sdk_path()}
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def read_brew(cellar, names):
+    # {formula: [versions]} from Cellar/<formula>/<version>.
+    return dict((name, sorted(version for version in _listdir(join(cellar, name)) if not version.startswith('.')))
+                for name in names)
+
+
+def read_pip(site_packages, names):
+    found = dict((name, []) for name in names)
+    for entry in _listdir(site_packages):
+        match = _dist_pattern.match(entry)
+        if match:
+            name = batching.package_name(match.group(1))
+            if name in found:
+                found[name].append(match.group(2))
+    return dict((name, sorted(versions)) for name, versions in found.items())
+
+
+def read_gem(directories, names):
+    found = dict((name, []) for name in names)
+    for directory in directories:
+        for entry in _listdir(join(directory, 'specifications')):
+            match = _gemspec_pattern.match(entry)
+            if match:
+                name = batching.package_name(match.group(1))
+                if name in found:
+                    found[name].append(match.group(2))
+    return dict((name, sorted(set(versions))) for name, versions in found.items())
+
+
+def read_android(sdk_path):
+    # {'platforms/android-21': '2', ...} for every package in the SDK, which keeps a source.properties at depth 2 or 3.
+    found = {}
+    for pattern in ('*/*/source.properties', '*/*/*/source.properties'):
+        for path in glob(join(sdk_path, pattern)):
+            component = os.path.relpath(dirname(path), sdk_path)
+            found[component] = sdk_catalog.read_source_properties(path).get('Pkg.Revision')
+    return found
+
+
+def file_hash(path):
+    try:
+        with open(expanduser(path), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def entry_names(manager, entry):
+    # Package names an entry installs: the first word for brew and gem ('xcodeproj -v 0.19.2'), every requirement for
+    # pip.
+    args = batching.entry_args(entry)
+    if manager == 'pip':
+        return [batching.package_name(inventory.requirement_spec(arg)[0]) for arg in args if not arg.startswith('-')]
+    return [batching.package_name(args[0])]
+
+
+def expected_names(plan):
+    # {manager: [package names]} for the brew, pip and gem entries of the plan.
+    names = {}
+    for step in plan.steps:
+        if step['manager'] in ('brew', 'pip', 'gem'):
+            for entry in step['entries']:
+                names.setdefault(step['manager'], set()).update(entry_names(step['manager'], entry))
+    return dict((manager, sorted(values)) for manager, values in names.items())
+
+
+def scan(names, configs, where=None):
+    # The state of the given packages and configuration files, plus the whole Android SDK.
+    where = where or locations()
+    return {
+        'brew': read_brew(where['cellar'], names.get('brew', [])),
+        'pip': read_pip(where['site-packages'], names.get('pip', [])),
+        'gem': read_gem(where['gems'], names.get('gem', [])),
+        'android': read_android(where['android']),
+        'configs': dict((path, file_hash(path)) for path in configs)
+    }
+
+
+def fingerprint(state):
+    return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+
+
+def _names(state):
+    return dict((manager, sorted(state.get(manager, {}))) for manager in ('brew', 'pip', 'gem'))
+
+
+def save_baseline(baseline_path, plan, configs, unrepaired=()):
+    """Records the state on disk as the baseline, after a successful run.
+
+    Configuration files from the previous baseline are kept even when this run didn't render them, and unrepaired
+    Drift items keep their expected value, so a run that couldn't put something back doesn't make it the new normal.
+    """
+    previous = load_baseline(baseline_path)
+    if previous is not None:
+        configs = list(configs) + previous['state'].get('configs', {}).keys()
+    state = scan(expected_names(plan), sorted(set(configs)))
+    for item in unrepaired:
+        state[item.kind][item.name] = item.expected
+    baseline = {'digest': plan.digest, 'created': time.time(), 'fingerprint': fingerprint(state), 'state': state}
+    path = expanduser(baseline_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def load_baseline(baseline_path):
+    try:
+        with open(expanduser(baseline_path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def compare(expected, found):
+    # Drift in found relative to expected, both as returned by scan().
+    drifted = []
+    for kind in ('brew', 'pip', 'gem'):
+        for name, versions in sorted(expected.get(kind, {}).items()):
+            current = found.get(kind, {}).get(name, [])
+            if versions and not set(versions) <= set(current):
+                drifted.append(Drift(kind, name, versions, current or None))
+    for kind in ('android', 'configs'):
+        for name, value in sorted(expected.get(kind, {}).items()):
+            current = found.get(kind, {}).get(name)
+            # Not every SDK package records a revision, but a missing one has drifted all the same.
+            if (value is not None and current != value) or (kind == 'android' and name not in found.get(kind, {})):
+                drifted.append(Drift(kind, name, value, current))
+    return drifted
+
+
+def check(baseline):
+    # (current state, drift) against a loaded baseline.
+    state = scan(_names(baseline['state']), sorted(baseline['state'].get('configs', {})))
+    if fingerprint(state) == baseline['fingerprint']:
+        return state, []
+    return state, compare(baseline['state'], state)
+
+
+def _describe(value, none='missing'):
+    # An expected value of None is an SDK package without a revision.
+    if value is None:
+        return none
+    if isinstance(value, list):
+        return ', '.join(value)
+    return value[:12] if len(value) == 40 else value
+
+
+def report(drifted):
+    if not drifted:
+        print('No drift: everything matches the baseline.')
+        return
+    print('{} item(s) drifted from the baseline:'.format(len(drifted)))
+    for item in drifted:
+        print('  {:<8} {:<40} expected {}, found {}'.format(item.kind, item.name, _describe(item.expected, 'installed'),
+                                                           _describe(item.found)))
+
+
+def seed_inventory(state):
+    # Hands the scanned versions to the inventory so the installers don't query the managers again.
+    for manager in ('brew', 'pip', 'gem'):
+        inventory.seed(manager, dict((name, versions) for name, versions in state[manager].items() if versions))
+
+
+def restrict(plan, drifted):
+    # A copy of the plan with only the entries that install drifted packages (and every tap, which brew needs to
+    # find them).
+    names = set((item.kind, item.name) for item in drifted)
+    steps = []
+    for step in plan.steps:
+        if step['manager'] == 'taps':
+            entries = step['entries']
+        else:
+            entries = [entry for entry in step['entries']
+                       if any((step['manager'], name) in names for name in entry_names(step['manager'], entry))]
+        if entries:
+            steps.append(dict(step, entries=entries))
+    return manifest.Plan(plan.digest, plan.profiles, steps)
+
+
+def sdk_filter(sdk_path, component):
+    # The 'android update sdk -t' filter that installs an SDK package again, or None for one it can't name.
+    kind, _, rest = component.partition('/')
+    if kind == 'platforms':
+        return rest
+    if kind == 'build-tools':
+        return 'build-tools-' + rest
+    if kind == 'extras' and '/' in rest:
+        return 'extra-' + rest.replace('/', '-')
+    if kind == 'system-images' and '/' in rest:
+        platform, abi = rest.split('/', 1)
+        return 'sys-img-{}-{}'.format(abi, platform)
+    if kind == 'add-ons':
+        # addon-<name>-<vendor>-<api level>, which the directory is usually, but not always, named after.
+        properties = sdk_catalog.read_source_properties(join(sdk_path, component, 'source.properties'))
+        if 'Addon.NameId' in properties:
+            return 'addon-{}-{}-{}'.format(properties['Addon.NameId'], properties.get('Addon.VendorId'),
+                                           properties.get('AndroidVersion.ApiLevel'))
+        return rest if rest.startswith('addon-') else None
+    return None
+
+
+class Watcher(object):
+    # Blocks in wait() until something under the watched directories changes. inotify on Linux, polling elsewhere.
+    IN_EVENTS = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # modify, attrib, close_write, moves, create, delete
+
+    def __init__(self):
+        self.paths = set()
+        self.mtimes = {}
+        self.fd = None
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is not None and hasattr(libc, 'inotify_init'):
+            self.libc = libc
+            self.fd = libc.inotify_init()
+            if self.fd < 0:
+                self.fd = None
+
+    def watch(self, paths):
+        for path in paths:
+            if path in self.paths or not os.path.exists(path):
+                continue
+            if self.fd is not None:
+                # Paths from the baseline are unicode, which ctypes would pass as wide characters.
+                name = path.encode(sys.getfilesystemencoding()) if isinstance(path, unicode) else path
+                self.libc.inotify_add_watch(self.fd, name, self.IN_EVENTS)
+            self.paths.add(path)
+        self.mtimes = self._mtimes()
+
+    def _mtimes(self):
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def wait(self):
+        if self.fd is not None:
+            select.select([self.fd], [], [])
+            # A package install is a burst of events; let it settle before looking.
+            time.sleep(0.5)
+            while select.select([self.fd], [], [], 0)[0]:
+                os.read(self.fd, 65536)
+            return
+        while True:
+            time.sleep(poll_interval)
+            mtimes = self._mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                return
+
+
+def watched_paths(state, where):
+    paths = [where['cellar'], where['site-packages'], where['android']]
+    paths += [join(where['cellar'], name) for name in state['brew']]
+    paths += [join(directory, 'specifications') for directory in where['gems']]
+    paths += [join(where['android'], dirname(component)) for component in state['android']]
+    paths += [join(where['android'], component) for component in state['android']]
+    paths += [dirname(expanduser(path)) for path in state['configs']]
+    paths += [expanduser(path) for path in state['configs']]
+    return paths
+
+
+def watch(baseline):
+    where = locations()
+    watcher = Watcher()
+    print('Watching for drift ({})... Ctrl-C to stop.'.format('inotify' if watcher.fd is not None else 'polling'))
+    reported = set()
+    while True:
+        state, drifted = check(baseline)
+        current = set((item.kind, item.name) for item in drifted)
+        stamp = time.strftime('%H:%M:%S')
+        for item in drifted:
+            if (item.kind, item.name) not in reported:
+                print('{} drifted  {:<8} {} (expected {}, found {})'.format(stamp, item.kind, item.name,
+                                                                           _describe(item.expected, 'installed'),
+                                                                           _describe(item.found)))
+        for kind, name in sorted(reported - current):
+            print('{} restored {:<8} {}'.format(stamp, kind, name))
+        reported = current
+        sys.stdout.flush()
+        watcher.watch(watched_paths(baseline['state'], where))
+        watcher.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare this agent with the baseline of its last successful run.')
+    parser.add_argument('command', choices=['verify', 'watch'])
+    parser.add_argument('-b', '--baseline', help='Baseline to compare with (default: {}).'.format(
+        default_baseline_path), default=default_baseline_path, required=False)
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print('ERROR: No baseline at {}; run panda.py once first.'.format(args.baseline))
+        return 2
+
+    if args.command == 'watch':
+        try:
+            watch(baseline)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    start = time.time()
+    _, drifted = check(baseline)
+    report(drifted)
+    print('Checked in {:.0f}ms.'.format((time.time() - start) * 1000))
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""Concurrent execution engine for provisioning commands.
+
+Commands are submitted to the engine and come back as Futures, so new provisioning steps can start several commands
+at once and compose their results with then() and gather() rather than managing threads themselves. Every command
+runs through runner.run() under a per-tool semaphore, and cancel() stops the whole run: running commands are
+terminated and anything submitted afterwards fails with Cancelled. The synchronous helpers used by the scripts
+(call, communicate, install_call) go through run(), which submits and waits.
+"""
+import threading
+
+from os.path import basename
+
+import retries
+import runner
+
+# Maximum number of commands per tool running at once. Homebrew, pip, gem and the SDK manager take locks on the state
+# they manage, so they run one command at a time; other tools are limited by default_tool_limit.
+tool_limits = {
+    'brew': 1,
+    'pip': 1,
+    'gem': 1,
+    'android': 1
+}
+
+default_tool_limit = 8
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Future(object):
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_error(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if timeout is None:
+            # Wait in short slices so the main thread stays responsive to Ctrl-C.
+            while not self._done.wait(0.1):
+                pass
+        elif not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a command to finish')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def then(self, func):
+        # Returns a Future for func(result) that runs once this one completes; errors propagate down the chain.
+        chained = Future()
+
+        def complete(future):
+            if future._error is not None:
+                chained.set_error(future._error)
+                return
+            try:
+                value = func(future._result)
+            except BaseException as e:
+                chained.set_error(e)
+                return
+            if isinstance(value, Future):
+                value.add_done_callback(lambda inner: chained._finish(inner._result, inner._error))
+            else:
+                chained.set_result(value)
+
+        self.add_done_callback(complete)
+        return chained
+
+
+def gather(futures):
+    # A Future for the list of results, failing with the first error.
+    futures = list(futures)
+    combined = Future()
+    if not futures:
+        combined.set_result([])
+        return combined
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def complete(future):
+        if future._error is not None:
+            combined.set_error(future._error)
+            return
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            combined.set_result([f._result for f in futures])
+
+    for future in futures:
+        future.add_done_callback(complete)
+    return combined
+
+
+class Engine(object):
+    def __init__(self, limits=None):
+        self.limits = dict(tool_limits)
+        if limits:
+            self.limits.update(limits)
+        self.cancelled = False
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, tool):
+        with self._lock:
+            if tool not in self._semaphores:
+                self._semaphores[tool] = threading.Semaphore(self.limits.get(tool, default_tool_limit))
+            return self._semaphores[tool]
+
+    def submit(self, args, **kwargs):
+        # Starts args in the background and returns a Future for its runner.Result. Accepts runner.run()'s keyword
+        # arguments.
+        future = Future()
+        if self.cancelled:
+            future.set_error(Cancelled(' '.join(args)))
+            return future
+
+        def attempt():
+            with self._semaphore(basename(args[0])):
+                if self.cancelled:
+                    raise Cancelled(' '.join(args))
+                return runner.run(args, **kwargs)
+
+        def work():
+            # Network commands that fail transiently are retried, outside the tool's semaphore while waiting.
+            try:
+                future.set_result(retries.run(args, attempt, kwargs.get('capture', False)))
+            except BaseException as e:
+                future.set_error(e)
+
+        thread = threading.Thread(target=work, name=' '.join(args))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def run(self, args, **kwargs):
+        try:
+            return self.submit(args, **kwargs).result()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        self.cancelled = True
+        runner.terminate_all()
+
+
+engine = Engine()
+
+submit = engine.submit
+run = engine.run
+cancel = engine.cancel
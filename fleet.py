@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""Runs panda.py on a fleet of agents at once.
+
+    python fleet.py hosts.txt -j 8 -- -a
+
+The inventory lists one host per line as [user@]host[:port]; blank lines and '#' comments are ignored. Everything
+after '--' is passed to panda.py on each host. The setup scripts are copied to ~/.panda-setup on every host over the
+same SSH connection the run then uses, at most --jobs hosts are provisioned at a time, and a table of results is
+printed at the end. Each host's output is kept in ~/.fleet/logs/<host>.log.
+
+Hosts named local or local:NAME are stand-ins that run on this machine, each with its own home directory under
+~/.fleet/local, so a fleet run can be tried out without any agents.
+"""
+import argparse
+import os
+import pipes
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from glob import glob
+from os.path import abspath, basename, dirname, exists, expanduser, join
+
+import scheduler
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+repo_path = dirname(abspath(__file__))
+
+# Directory on each host, relative to its home directory, that the setup scripts are copied into.
+remote_dir = '.panda-setup'
+
+log_dir = '~/.fleet/logs'
+local_root = '~/.fleet/local'
+
+# Output lines shown on the console while a host runs (everything goes to its log).
+progress_prefixes = ('Installing', 'Cloning', 'Updating', 'Skipping', 'Resuming', 'ERROR', 'WARNING', 'FAILED')
+
+# Scripts that stay on this machine.
+local_only = ('fleet.py', 'bench.py')
+
+# Data files the setup scripts read.
+data_files = ['manifest.json']
+
+SSH_PORT = 22
+
+
+class Host(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.user = None
+        self.port = SSH_PORT
+        address = spec
+        if '@' in address:
+            self.user, address = address.split('@', 1)
+        self.local = address == 'local' or address.startswith('local:')
+        if not self.local and ':' in address:
+            address, port = address.rsplit(':', 1)
+            self.port = int(port)
+        self.address = address
+
+    @property
+    def name(self):
+        return self.address
+
+
+def load_inventory(path):
+    hosts = []
+    with open(expanduser(path)) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                hosts.append(Host(line))
+    names = [host.name for host in hosts]
+    duplicates = set(name for name in names if names.count(name) > 1)
+    if duplicates:
+        raise ValueError('Duplicate hosts in {}: {}'.format(path, ', '.join(sorted(duplicates))))
+    return hosts
+
+
+class LocalTransport(object):
+    # Stand-in host: commands run through sh on this machine, with HOME pointing at a directory of the host's own
+    # (laid out like a Mac home directory, which panda.py expects).
+    def __init__(self, host):
+        self.home = join(expanduser(local_root), host.address.replace(':', '_'))
+        if not exists(join(self.home, 'Library')):
+            os.makedirs(join(self.home, 'Library'))
+
+    def put(self, local_path, remote_path):
+        target = join(self.home, remote_path)
+        if not exists(dirname(target)):
+            os.makedirs(dirname(target))
+        shutil.copy(local_path, target)
+
+    def run(self, command, on_line):
+        env = dict(os.environ, HOME=self.home)
+        process = subprocess.Popen(['sh', '-c', command], cwd=self.home, env=env, stdin=open(os.devnull),
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        for line in iter(process.stdout.readline, b''):
+            on_line(line)
+        return process.wait()
+
+    def close(self):
+        pass
+
+
+class SSHTransport(object):
+    # One SSH connection per host; the file copies and the run are separate channels on it.
+    def __init__(self, host, accept_new_host_keys=False, connect_timeout=30):
+        if paramiko is None:
+            raise RuntimeError('paramiko is required to reach {}: pip install paramiko'.format(host.spec))
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy() if accept_new_host_keys
+                                                else paramiko.RejectPolicy())
+        self.client.connect(host.address, port=host.port, username=host.user, timeout=connect_timeout)
+        self.client.get_transport().set_keepalive(30)
+        self._sftp = None
+
+    def put(self, local_path, remote_path):
+        if self._sftp is None:
+            self._sftp = self.client.open_sftp()
+        directory = dirname(remote_path)
+        if directory:
+            try:
+                self._sftp.stat(directory)
+            except IOError:
+                self._sftp.mkdir(directory)
+        self._sftp.put(local_path, remote_path)
+
+    def run(self, command, on_line):
+        channel = self.client.get_transport().open_session()
+        channel.set_combined_stderr(True)
+        # A login shell, so the run sees the same PATH (/usr/local/bin first) as it would by hand.
+        channel.exec_command('bash -lc {}'.format(pipes.quote(command)))
+        for line in channel.makefile('r'):
+            on_line(line)
+        return channel.recv_exit_status()
+
+    def close(self):
+        if self._sftp is not None:
+            self._sftp.close()
+        self.client.close()
+
+
+class ConnectionPool(object):
+    # Keeps the connection to each host open for the whole fleet run so every step on it reuses one session.
+    def __init__(self, accept_new_host_keys=False):
+        self.accept_new_host_keys = accept_new_host_keys
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        with self._lock:
+            transport = self._transports.get(host.spec)
+        if transport is None:
+            transport = LocalTransport(host) if host.local else SSHTransport(host, self.accept_new_host_keys)
+            with self._lock:
+                self._transports[host.spec] = transport
+        return transport
+
+    def close_all(self):
+        with self._lock:
+            transports = self._transports.values()
+            self._transports = {}
+        for transport in transports:
+            try:
+                transport.close()
+            except Exception:
+                pass
+
+
+class HostResult(object):
+    def __init__(self, host):
+        self.host = host
+        self.status = 'pending'
+        self.returncode = None
+        self.start = None
+        self.end = None
+        self.failures = []
+        self.error = None
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return None
+        return (self.end or time.time()) - self.start
+
+
+class Fleet(object):
+    def __init__(self, hosts, panda_args, jobs=8, accept_new_host_keys=False, verbose=False):
+        self.hosts = hosts
+        self.panda_args = panda_args
+        self.jobs = jobs
+        self.verbose = verbose
+        self.pool = ConnectionPool(accept_new_host_keys)
+        self.results = dict((host.spec, HostResult(host)) for host in hosts)
+        self._finished = 0
+
+    def command(self):
+        # Quiet with the continue policy: nobody is there to answer a prompt, and the failures come back in the table.
+        args = ['python', 'panda.py', '-q', '--on-failure', 'continue'] + self.panda_args
+        return 'cd {} && {}'.format(remote_dir, ' '.join(pipes.quote(arg) for arg in args))
+
+    def _print(self, host, message):
+        with scheduler.console_lock:
+            print('[{}] {}'.format(host.name, message))
+
+    def provision(self, host):
+        # Runs as a scheduler task. Errors are recorded on the host's result rather than raised, so one unreachable
+        # agent doesn't stop the rest of the fleet.
+        result = self.results[host.spec]
+        result.start = time.time()
+        result.status = 'running'
+        self._print(host, 'Starting.')
+
+        log_path = join(expanduser(log_dir), '{}.log'.format(host.name.replace(':', '_')))
+        try:
+            with open(log_path, 'w') as log:
+                def on_line(line):
+                    log.write(line)
+                    text = line.rstrip()
+                    if text.startswith('  FAILED '):
+                        result.failures.append(text.strip()[len('FAILED '):])
+                    if self.verbose or text.startswith(progress_prefixes):
+                        self._print(host, text)
+
+                transport = self.pool.get(host)
+                scripts = [path for path in glob(join(repo_path, '*.py')) if basename(path) not in local_only]
+                for path in sorted(scripts) + [join(repo_path, name) for name in data_files]:
+                    transport.put(path, '{}/{}'.format(remote_dir, basename(path)))
+                result.returncode = transport.run(self.command(), on_line)
+            result.status = 'ok' if result.returncode == 0 else 'failed'
+        except Exception as e:
+            result.status = 'error'
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            result.end = time.time()
+
+        with scheduler.console_lock:
+            self._finished += 1
+            finished = self._finished
+        self._print(host, 'Finished: {} ({}/{} hosts done).'.format(result.error or result.status, finished,
+                                                                     len(self.hosts)))
+        return result.status != 'ok'
+
+    def run(self):
+        if not exists(expanduser(log_dir)):
+            os.makedirs(expanduser(log_dir))
+
+        schedule = scheduler.Scheduler(limits={'ssh': self.jobs})
+        for host in self.hosts:
+            schedule.add(host.spec, self.provision, host, manager='ssh')
+        try:
+            schedule.run()
+        finally:
+            self.pool.close_all()
+        return [self.results[host.spec] for host in self.hosts]
+
+
+def report(results):
+    width = max([len(result.host.name) for result in results] + [4])
+    print('\n{:<{width}}  {:<7} {:>4} {:>9}  {}'.format('host', 'status', 'exit', 'time', 'failures', width=width))
+    for result in results:
+        duration = '{:.1f}s'.format(result.duration) if result.duration is not None else '-'
+        returncode = result.returncode if result.returncode is not None else '-'
+        details = result.error or '; '.join(result.failures)
+        print('{:<{width}}  {:<7} {:>4} {:>9}  {}'.format(result.host.name, result.status, returncode, duration,
+                                                         details, width=width))
+
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    print('\n{} host(s): {}'.format(len(results), ', '.join('{} {}'.format(count, status)
+                                                            for status, count in sorted(counts.items()))))
+
+
+def main():
+    # Everything after '--' belongs to panda.py.
+    argv = sys.argv[1:]
+    panda_args = []
+    if '--' in argv:
+        panda_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description='Run panda.py on many agents at once.',
+                                     usage='%(prog)s [options] inventory -- PANDA_ARGS...')
+    parser.add_argument('inventory', help='File listing one [user@]host[:port] per line.')
+    parser.add_argument('-j', '--jobs', help='Number of hosts to provision at the same time (default: 8).', type=int,
+                        default=8, required=False)
+    parser.add_argument('--accept-new-host-keys', help='Trust hosts missing from known_hosts and add them.',
+                        action='store_true', required=False)
+    parser.add_argument('-v', '--verbose', help='Show all output of every host, not just its progress.',
+                        action='store_true', required=False)
+    args = parser.parse_args(argv)
+
+    if not panda_args:
+        parser.error('No panda.py arguments given, e.g. fleet.py hosts.txt -- -a')
+
+    try:
+        hosts = load_inventory(args.inventory)
+    except (IOError, ValueError) as e:
+        print('ERROR: {}'.format(e))
+        return 1
+    if not hosts:
+        print('ERROR: No hosts in {}'.format(args.inventory))
+        return 1
+
+    fleet = Fleet(hosts, panda_args, args.jobs, args.accept_new_host_keys, args.verbose)
+    results = fleet.run()
+    report(results)
+    return 0 if all(result.status == 'ok' for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Incremental checkouts of a single branch, backed by a local bare mirror.
+
+The mirror (one per remote, under ~/.cache/git-mirrors) is the only thing that talks to the remote, and it only ever
+fetches the one branch, so refreshing it transfers just the objects that are new since the last run. Working trees
+are cloned from the mirror (see agent_update.py, which keeps one per commit), which hard-links its objects rather than
+copying or borrowing them, so they stay intact whatever later fetches and gc do to the mirror.
+
+Three modes are supported:
+
+    mirror    full history of the branch in the mirror (the default)
+    shallow   the mirror starts with only the last shallow_depth commits; later fetches extend it
+    partial   no mirror: a blobless partial clone straight from the remote (needs git 2.19 on both ends)
+"""
+import re
+
+from os.path import expanduser, isdir, join
+
+MIRROR = 'mirror'
+SHALLOW = 'shallow'
+PARTIAL = 'partial'
+
+modes = [MIRROR, SHALLOW, PARTIAL]
+
+mirror_root = '~/.cache/git-mirrors'
+
+# Commits fetched into a new shallow mirror.
+shallow_depth = 50
+
+
+def mirror_path(url):
+    # 'https://example.kilnhg.com/Code/panda.git' -> ~/.cache/git-mirrors/example.kilnhg.com_Code_panda.git
+    name = re.sub(r'[^\w.-]+', '_', url.split('://', 1)[-1]).strip('_')
+    if not name.endswith('.git'):
+        name += '.git'
+    return join(expanduser(mirror_root), name)
+
+
+def is_repository(path):
+    return isdir(join(path, '.git'))
+
+
+def branch_refspec(branch, remote_tracking=False):
+    target = 'refs/remotes/origin/{}' if remote_tracking else 'refs/heads/{}'
+    return '+refs/heads/{}:{}'.format(branch, target.format(branch))
+
+
+def mirror_steps(url, branch, mode=MIRROR):
+    # git commands (without the leading 'git') that create or refresh the mirror of url's branch.
+    mirror = mirror_path(url)
+    fetch = ['-C', mirror, 'fetch', '--no-tags', 'origin', branch_refspec(branch)]
+    if isdir(mirror):
+        return [['-C', mirror, 'remote', 'set-url', 'origin', url], fetch]
+    if mode == SHALLOW:
+        fetch.append('--depth={}'.format(shallow_depth))
+    return [['init', '--bare', '--quiet', mirror], ['-C', mirror, 'remote', 'add', 'origin', url], fetch]
+
+
+def clone_steps(url, commit, path):
+    # git commands that check commit out of the mirror of url into a new working tree at path. Not --shared: a tree
+    # borrowing the mirror's objects breaks once a forced fetch and gc drop them. The clone's origin is the mirror;
+    # point it back at the real remote so the tree looks like a normal clone.
+    return [['clone', '--quiet', '--no-checkout', mirror_path(url), path],
+            ['-C', path, 'remote', 'set-url', 'origin', url],
+            ['-C', path, 'checkout', '--quiet', '--detach', commit]]
+
+
+def partial_steps(url, branch, path):
+    """Returns the git commands (without the leading 'git') that bring path to the tip of url's branch with a blobless
+    partial clone, updated in place, in order.
+
+    Raises ValueError when path exists but isn't a git working tree.
+    """
+    path = expanduser(path)
+    if isdir(path) and not is_repository(path):
+        raise ValueError('{} exists but is not a git repository'.format(path))
+
+    if not isdir(path):
+        return [['clone', '--filter=blob:none', '--branch', branch, '--single-branch', url, path]]
+    return [['-C', path, 'fetch', '--no-tags', 'origin', branch_refspec(branch, True)],
+            ['-C', path, 'checkout', '--quiet', branch],
+            ['-C', path, 'merge', '--ff-only', '--quiet', 'origin/{}'.format(branch)]]
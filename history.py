@@ -0,0 +1,181 @@
+"""Durations of past provisioning steps, used to schedule the longest work first and to estimate time left.
+
+Every scheduler task that completes records how long it took, and every install command records its time against
+the packages it installed (a batch is split between its packages in proportion to their estimates). Durations are
+kept as moving averages in ~/.dev_history.json or ~/.panda_history.json.
+
+A step that has never run is estimated from its packages: their own history if they have been installed before,
+otherwise a per-manager default, raised for Homebrew formulas whose download is already in Homebrew's cache by the
+time it takes to unpack a file that size.
+"""
+import json
+import os
+import threading
+
+from glob import glob
+from os.path import basename, expanduser, getsize
+
+import batching
+
+# History file for this run, or None when history is off.
+path = None
+
+# Weight of the newest duration in the moving average.
+alpha = 0.3
+
+# Seconds per package when there is no history for it.
+manager_defaults = {
+    'brew': 45.0,
+    'pip': 8.0,
+    'gem': 8.0,
+    'android': 120.0,
+    'git': 20.0
+}
+
+# Seconds for a task that installs nothing identifiable (taps, checks, configuration).
+default_estimate = 5.0
+
+homebrew_cache_dirs = ['~/Library/Caches/Homebrew', '~/Library/Caches/Homebrew/downloads']
+
+# Rate at which Homebrew unpacks and pours a download, in bytes per second.
+unpack_rate = 20 * 1024 * 1024
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def load(history_path):
+    global path
+    path = expanduser(history_path)
+    _entries.clear()
+    try:
+        with open(path) as f:
+            _entries.update(json.load(f))
+    except (IOError, ValueError):
+        pass
+
+
+def save():
+    if path is None:
+        return
+    with _lock:
+        data = json.dumps(_entries, indent=2, sort_keys=True)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def _record(key, seconds):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _entries[key] = {'mean': seconds, 'runs': 1}
+        else:
+            entry['mean'] = alpha * seconds + (1 - alpha) * entry['mean']
+            entry['runs'] += 1
+
+
+def _known(key):
+    with _lock:
+        entry = _entries.get(key)
+        return entry['mean'] if entry else None
+
+
+def runs():
+    # Number of recorded durations, for telling the operator what an estimate is based on.
+    with _lock:
+        return sum(entry['runs'] for entry in _entries.values())
+
+
+def _downloaded_size(name):
+    size = 0
+    for directory in homebrew_cache_dirs:
+        for candidate in glob(os.path.join(expanduser(directory), '*{}-*'.format(name))):
+            if basename(candidate).split('--')[-1].startswith(name):
+                try:
+                    size = max(size, getsize(candidate))
+                except OSError:
+                    pass
+    return size
+
+
+def package_estimate(manager, name):
+    known = _known('{}:{}'.format(manager, name))
+    if known is not None:
+        return known
+    estimate = manager_defaults.get(manager, default_estimate)
+    if manager == 'brew':
+        estimate += float(_downloaded_size(name)) / unpack_rate
+    return estimate
+
+
+def _package_names(entries):
+    names = []
+    for entry in entries:
+        try:
+            args = batching.entry_args(entry)
+        except TypeError:
+            continue
+        names.extend(batching.package_name(arg) for arg in args if not arg.startswith('-'))
+    return names
+
+
+def task_estimate(task):
+    known = _known('task:' + task.name)
+    if known is not None:
+        return known
+    inputs = task.inputs if isinstance(task.inputs, (list, tuple)) else ()
+    if task.manager in ('brew', 'pip', 'gem') and inputs and all(isinstance(entry, (basestring, list))
+                                                                  for entry in inputs):
+        return sum(package_estimate(task.manager, name) for name in _package_names(inputs)) or default_estimate
+    return manager_defaults.get(task.manager, default_estimate)
+
+
+def task_finished(task, seconds):
+    if path is not None:
+        _record('task:' + task.name, seconds)
+
+
+def install_durations(args, seconds):
+    # [(manager, package, seconds)] for an install command: a batch is split between its packages in proportion to
+    # what each was expected to take. Empty for anything that isn't a brew, pip or gem install.
+    if len(args) < 3 or args[1] != 'install':
+        return []
+    manager = basename(args[0])
+    if manager not in ('brew', 'pip', 'gem'):
+        return []
+    names = []
+    skip = False
+    for arg in args[2:]:
+        if skip:
+            skip = False
+        elif arg in ('-v', '--version', '--source'):
+            skip = True
+        elif not arg.startswith('-'):
+            names.append(batching.package_name(arg))
+    estimates = [package_estimate(manager, name) for name in names]
+    total = sum(estimates)
+    return [(manager, name, seconds * estimate / total if total else seconds / len(names))
+            for name, estimate in zip(names, estimates)]
+
+
+def command_finished(args, seconds, returncode):
+    # Install commands are charged to their packages. Failed commands say little about how long an install takes and
+    # are left out.
+    if path is None or returncode != 0:
+        return
+    for manager, name, share in install_durations(args, seconds):
+        _record('{}:{}'.format(manager, name), share)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    if seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
@@ -0,0 +1,160 @@
+"""Installed-package inventory used to skip packages that are already satisfied."""
+import re
+import threading
+
+from distutils.version import LooseVersion
+
+import engine
+
+from batching import entry_args, package_name
+
+# Set to False (--force) to hand every requested package to its manager regardless of what is installed.
+enabled = True
+
+# One query per manager, listing everything it has installed.
+inventory_commands = {
+    'brew': ['brew', 'list', '--versions'],
+    'pip': ['pip', 'freeze'],
+    'gem': ['gem', 'list', '--local']
+}
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def parse_brew(output):
+    # 'git 2.3.0 2.3.1' -> {'git': ['2.3.0', '2.3.1']}
+    installed = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if fields:
+            installed[package_name(fields[0])] = fields[1:]
+    return installed
+
+
+def parse_pip(output):
+    # 'pycrypto==2.6' -> {'pycrypto': ['2.6']}. Editable checkouts ('-e git+...') are skipped.
+    installed = {}
+    for line in output.splitlines():
+        if '==' in line and not line.startswith('-'):
+            name, version = line.strip().split('==', 1)
+            installed[package_name(name)] = [version]
+    return installed
+
+
+def parse_gem(output):
+    # 'json (1.8.1, default: 1.7.7)' -> {'json': ['1.8.1', '1.7.7']}
+    installed = {}
+    for line in output.splitlines():
+        match = re.match(r'^(\S+) \((.*)\)$', line.strip())
+        if match:
+            versions = [v.strip().replace('default: ', '') for v in match.group(2).split(',')]
+            installed[package_name(match.group(1))] = [v.split()[0] for v in versions if v]
+    return installed
+
+
+parsers = {
+    'brew': parse_brew,
+    'pip': parse_pip,
+    'gem': parse_gem
+}
+
+
+def snapshot(manager):
+    # Queried on first use and kept for the rest of the run. None means the inventory is unknown, in which case
+    # nothing is skipped.
+    with _lock:
+        if manager not in _snapshots:
+            installed = None
+            try:
+                result = engine.run(inventory_commands[manager], capture=True, echo=False)
+                if result.returncode == 0:
+                    installed = parsers[manager](result.output)
+            except (KeyError, OSError):
+                pass
+            _snapshots[manager] = installed
+        return _snapshots[manager]
+
+
+def seed(manager, installed):
+    # Supplies the inventory from elsewhere (drift.py reads it from the filesystem) instead of querying the manager.
+    with _lock:
+        _snapshots[manager] = installed
+
+
+def version_matches(version, spec):
+    # spec is a pip style constraint list such as '==2.6' or '>=2.0,<3'.
+    operators = [
+        ('==', lambda a, b: a == b),
+        ('!=', lambda a, b: a != b),
+        ('>=', lambda a, b: a >= b),
+        ('<=', lambda a, b: a <= b),
+        ('>', lambda a, b: a > b),
+        ('<', lambda a, b: a < b)
+    ]
+    for constraint in spec.split(','):
+        constraint = constraint.strip()
+        if not constraint:
+            continue
+        for operator, compare in operators:
+            if constraint.startswith(operator):
+                if not compare(LooseVersion(version), LooseVersion(constraint[len(operator):].strip())):
+                    return False
+                break
+        else:
+            if version != constraint:
+                return False
+    return True
+
+
+def is_satisfied(installed, name, spec):
+    versions = installed.get(package_name(name))
+    if not versions:
+        return False
+    return not spec or any(version_matches(version, spec) for version in versions)
+
+
+def requirement_spec(requirement):
+    # 'pycrypto==2.6' -> ('pycrypto', '==2.6'), 'boto' -> ('boto', '')
+    match = re.match(r'^([^<>=!~\s]+)\s*(.*)$', requirement)
+    return match.group(1), match.group(2)
+
+
+def entry_missing(manager, installed, entry):
+    # Returns the part of entry that still needs installing, or None when it is fully satisfied.
+    args = entry_args(entry)
+    if manager == 'pip':
+        if any(arg.startswith('-') for arg in args):
+            options_satisfied = all(is_satisfied(installed, *requirement_spec(arg))
+                                    for arg in args if not arg.startswith('-'))
+            return None if options_satisfied else entry
+        missing = [arg for arg in args if not is_satisfied(installed, *requirement_spec(arg))]
+        return missing or None
+
+    # brew and gem: 'name [options]', where gem pins a version with '-v 0.19.2' or '--version 0.19.2'.
+    spec = ''
+    for flag in ('-v', '--version'):
+        if flag in args[:-1]:
+            spec = '==' + args[args.index(flag) + 1]
+    return None if is_satisfied(installed, args[0], spec) else entry
+
+
+def missing(manager, entries):
+    # Filters entries down to what the manager's inventory says is not installed yet.
+    if not enabled or not entries:
+        return list(entries)
+
+    installed = snapshot(manager)
+    if installed is None:
+        return list(entries)
+
+    remaining = []
+    for entry in entries:
+        needed = entry_missing(manager, installed, entry)
+        if needed is not None:
+            remaining.append(needed)
+
+    skipped = len(entries) - len(remaining)
+    if skipped:
+        print('Skipping {} already installed {} package(s).'.format(skipped, manager))
+    return remaining
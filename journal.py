@@ -0,0 +1,81 @@
+"""On-disk journal of completed provisioning steps so an interrupted run can resume where it stopped."""
+import hashlib
+import json
+import os
+import threading
+
+from os.path import dirname, exists
+
+# Journal file in use for this run. None disables journaling.
+path = None
+
+_steps = {}
+_lock = threading.Lock()
+
+
+def inputs_hash(inputs):
+    try:
+        data = json.dumps(inputs, sort_keys=True)
+    except TypeError:
+        data = repr(inputs)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def load(journal_path, from_scratch=False):
+    # A journal that can't be read (missing, or from a crash before the first rename) is treated as empty.
+    global path
+    path = journal_path
+    _steps.clear()
+
+    if from_scratch:
+        discard()
+        return
+
+    try:
+        with open(path) as f:
+            _steps.update(json.load(f))
+    except (IOError, ValueError):
+        pass
+
+    if _steps:
+        print('Resuming from {}: {} step(s) already completed. Use --from-scratch to start over.'.format(
+            path, len(_steps)))
+
+
+def is_complete(step, inputs):
+    with _lock:
+        return path is not None and _steps.get(step) == inputs_hash(inputs)
+
+
+def record(step, inputs):
+    with _lock:
+        if path is None:
+            return
+        _steps[step] = inputs_hash(inputs)
+        _save()
+
+
+def _save():
+    # Write to a temporary file and rename it over the journal so a crash mid-write leaves the previous version intact.
+    directory = dirname(path)
+    if directory and not exists(directory):
+        os.makedirs(directory)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(_steps, f, sort_keys=True, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+
+def discard():
+    with _lock:
+        _steps.clear()
+        if path is not None and exists(path):
+            os.remove(path)
+
+
+def finish():
+    # Called once every step has completed; the next run starts fresh.
+    discard()
@@ -0,0 +1,164 @@
+"""Declarative package manifest shared by dev.py and panda.py, compiled into a deduplicated plan.
+
+manifest.json lists what each profile installs:
+
+    {"profiles": {"agent": {"taps": [...], "brew": ["xcodeproj -v 0.19.2", ...], "pip": [["paramiko"], ...],
+                            "gem": [...]}, ...}}
+
+Brew and gem entries are strings, pip entries are argument lists, as the install helpers take them. Compiling the
+manifest for a set of profiles merges them in order: a package several profiles ask for is installed once, by the
+first of them. The compiled plan is cached with the hash of the manifest and the profiles it was compiled for, and
+marked converged after a run that completed without failures, so running the same manifest again on a machine that is
+already set up can stop straight away.
+"""
+import hashlib
+import json
+import os
+
+from os.path import abspath, dirname, expanduser, join
+
+from batching import entry_args, package_name
+
+default_path = join(dirname(abspath(__file__)), 'manifest.json')
+
+# Managers in the order a profile's steps run.
+managers = ['taps', 'brew', 'pip', 'gem']
+
+# Bumped whenever compile_plan() changes, so plans cached by an older version are recompiled.
+plan_version = 1
+
+
+class Plan(object):
+    def __init__(self, digest, profiles, steps, converged=False):
+        self.digest = digest
+        self.profiles = profiles
+        # [{'profile': ..., 'manager': ..., 'entries': [...]}] in the order they should run.
+        self.steps = steps
+        self.converged = converged
+
+    def entries(self, profile, manager):
+        for step in self.steps:
+            if step['profile'] == profile and step['manager'] == manager:
+                return step['entries']
+        return []
+
+    def to_json(self):
+        return {'digest': self.digest, 'profiles': self.profiles, 'steps': self.steps, 'converged': self.converged}
+
+
+def load(path):
+    # Returns the parsed manifest and the raw bytes it was parsed from.
+    with open(expanduser(path)) as f:
+        data = f.read()
+    try:
+        manifest = json.loads(data)
+    except ValueError as e:
+        raise ValueError('{} is not valid JSON: {}'.format(path, e))
+    validate(manifest, path)
+    return manifest, data
+
+
+def validate(manifest, path):
+    profiles = manifest.get('profiles') if isinstance(manifest, dict) else None
+    if not isinstance(profiles, dict):
+        raise ValueError('{}: expected an object with a "profiles" object'.format(path))
+    for profile, support in profiles.items():
+        for manager, entries in support.items():
+            if manager not in managers:
+                raise ValueError('{}: unknown manager "{}" in profile {}'.format(path, manager, profile))
+            for entry in entries:
+                valid = isinstance(entry, list) if manager == 'pip' else isinstance(entry, basestring)
+                if not valid:
+                    raise ValueError('{}: {} entries in profile {} must be {}, got {}'.format(
+                        path, manager, profile, 'argument lists' if manager == 'pip' else 'strings', entry))
+
+
+def digest(data, profiles):
+    return hashlib.sha1('{}\0{}\0{}'.format(plan_version, json.dumps(profiles), data)).hexdigest()
+
+
+def compile_plan(manifest, profiles):
+    # Merges the profiles in order into one list of steps, dropping packages an earlier step already installs.
+    steps = []
+    seen = dict((manager, {}) for manager in managers)
+    for profile in profiles:
+        support = manifest['profiles'].get(profile, {})
+        for manager in managers:
+            entries = []
+            for entry in support.get(manager, []):
+                entry = _dedupe(manager, entry, seen[manager], profile)
+                if entry:
+                    entries.append(entry)
+            if entries:
+                steps.append({'profile': profile, 'manager': manager, 'entries': entries})
+    return steps
+
+
+def _dedupe(manager, entry, seen, profile):
+    # Returns the part of entry not already in the plan, or None. seen maps package names to (entry, profile).
+    if manager == 'taps':
+        key = entry.lower()
+        if key in seen:
+            return None
+        seen[key] = (entry, profile)
+        return entry
+
+    args = entry_args(entry)
+    if manager == 'pip' and not any(arg.startswith('-') for arg in args):
+        # Plain requirement lists can be split, so only the new requirements are kept.
+        needed = [arg for arg in args if not _seen(seen, package_name(arg), arg, profile)]
+        return needed or None
+
+    # Entries with options ('xcodeproj -v 0.19.2', ['-e', 'git+...']) are kept or dropped whole.
+    key = ' '.join(args) if manager == 'pip' else package_name(args[0])
+    return None if _seen(seen, key, entry, profile) else entry
+
+
+def _seen(seen, name, entry, profile):
+    if name not in seen:
+        seen[name] = (entry, profile)
+        return False
+    first, first_profile = seen[name]
+    if [arg.lower() for arg in entry_args(first)] != [arg.lower() for arg in entry_args(entry)]:
+        print('WARNING: {} asks for {}, but {} already installs {}; ignoring it.'.format(
+            profile, ' '.join(entry_args(entry)), first_profile, ' '.join(entry_args(first))))
+    return True
+
+
+def _read_cache(cache_path):
+    try:
+        with open(expanduser(cache_path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_cache(cache_path, plan):
+    path = expanduser(cache_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(plan.to_json(), f, indent=2)
+    os.rename(temp_path, path)
+
+
+def load_plan(manifest_path, profiles, cache_path):
+    """Returns the plan for profiles, reusing the cached one when the manifest hasn't changed since it was compiled.
+
+    Raises IOError or ValueError when the manifest can't be read.
+    """
+    manifest, data = load(manifest_path)
+    plan_digest = digest(data, profiles)
+
+    cached = _read_cache(cache_path)
+    if cached and cached.get('digest') == plan_digest:
+        return Plan(plan_digest, profiles, cached['steps'], cached.get('converged', False))
+
+    plan = Plan(plan_digest, profiles, compile_plan(manifest, profiles))
+    _write_cache(cache_path, plan)
+    return plan
+
+
+def mark_converged(plan, cache_path):
+    # Called after a run of the plan finished without failures.
+    plan.converged = True
+    _write_cache(cache_path, plan)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""Prometheus metrics for provisioning runs, written to a node-exporter textfile directory.
+
+dev.py and panda.py (with --metrics-dir) write <script>.prom at the end of every run, and agent_update.py writes
+agent_update.prom, each replaced in one rename so the collector never reads half a file:
+
+    panda_run_duration_seconds{script}                      wall time of the last run
+    panda_run_success{script}                               1 when the last run succeeded
+    panda_last_run_timestamp_seconds{script}
+    panda_last_success_timestamp_seconds{script}
+    panda_runs_total{script,result}                         counters, kept across runs in ~/.<script>_metrics.json
+    panda_profile_duration_seconds{script,profile}          first task start to last task end, per profile
+    panda_task_duration_seconds{script,profile,manager,task}
+    panda_task_failures_total{script,profile,manager}
+    panda_package_install_seconds{script,manager,package}   install time of each package in the last run
+    panda_artifact_cache_{hits,misses}_total{script}        when the artifact cache is in use
+    panda_artifact_cache_hit_ratio{script}
+    panda_agent_update_last_success_timestamp_seconds       time() minus this is the time since ~/panda was updated
+    panda_agent_update_consecutive_failures
+
+Machines without a node exporter can serve the same directory themselves:
+
+    python metrics.py serve --dir DIR --port 9101
+"""
+import BaseHTTPServer
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from os.path import expanduser, isdir, join
+
+import artifact_cache
+import history
+
+# Textfile directory for this run, or None when metrics are off.
+directory = None
+
+script = None
+
+_start = None
+_tasks = []
+_packages = {}
+_lock = threading.Lock()
+
+
+def configure(metrics_dir, script_name):
+    global directory, script, _start
+    directory = expanduser(metrics_dir)
+    script = script_name
+    _start = time.time()
+
+
+def task_finished(task, start, end):
+    if directory is None:
+        return
+    with _lock:
+        _tasks.append((task.name, task.profile, task.manager, task.status, start, end))
+
+
+def command_finished(args, seconds, returncode):
+    if directory is None or returncode != 0:
+        return
+    with _lock:
+        for manager, name, share in history.install_durations(args, seconds):
+            _packages[(manager, name)] = _packages.get((manager, name), 0) + share
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_family(name, kind, help, samples):
+    # samples: [(labels dict, value)], written in label order so the file is stable from run to run.
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+    for labels, value in samples:
+        label_text = ','.join('{}="{}"'.format(key, _escape(labels[key])) for key in sorted(labels))
+        lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def write(metrics_dir, name, families):
+    # families: [(name, kind, help, samples)]. Families without samples are left out.
+    metrics_dir = expanduser(metrics_dir)
+    if not isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+    text = ''.join(format_family(*family) for family in families if family[3])
+    temp_path = join(metrics_dir, '.{}.prom.{}'.format(name, os.getpid()))
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.rename(temp_path, join(metrics_dir, name + '.prom'))
+
+
+def _load_counters(counters_path):
+    try:
+        with open(counters_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_counters(counters_path, counters):
+    temp_path = counters_path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(counters, f)
+        os.rename(temp_path, counters_path)
+    except (IOError, OSError):
+        pass
+
+
+def export(succeeded):
+    # Writes <script>.prom for the run that is ending.
+    if directory is None:
+        return
+    now = time.time()
+    labels = {'script': script}
+
+    counters_path = expanduser('~/.{}_metrics.json'.format(script))
+    counters = _load_counters(counters_path)
+    runs = counters.setdefault('runs', {})
+    result = 'success' if succeeded else 'failure'
+    runs[result] = runs.get(result, 0) + 1
+    if succeeded:
+        counters['last_success'] = now
+    failures = counters.setdefault('failures', {})
+
+    with _lock:
+        # dev.py's tasks belong to no profile but its own.
+        tasks = [(name, profile or script, manager or 'none', status, start, end)
+                 for name, profile, manager, status, start, end in _tasks]
+        packages = dict(_packages)
+
+    spans = {}
+    for name, profile, manager, status, start, end in tasks:
+        first, last = spans.get(profile, (start, end))
+        spans[profile] = (min(first, start), max(last, end))
+        if status == 'failed':
+            key = '{}/{}'.format(profile, manager)
+            failures[key] = failures.get(key, 0) + 1
+    _save_counters(counters_path, counters)
+
+    families = [
+        ('panda_run_duration_seconds', 'gauge', 'Wall time of the last provisioning run.', [(labels, now - _start)]),
+        ('panda_run_success', 'gauge', '1 if the last provisioning run succeeded, 0 if it failed.',
+         [(labels, 1 if succeeded else 0)]),
+        ('panda_last_run_timestamp_seconds', 'gauge', 'When the last provisioning run ended.', [(labels, now)]),
+        ('panda_last_success_timestamp_seconds', 'gauge', 'When the last successful provisioning run ended.',
+         [(labels, counters['last_success'])] if 'last_success' in counters else []),
+        ('panda_runs_total', 'counter', 'Provisioning runs by result.',
+         [(dict(labels, result=key), runs[key]) for key in sorted(runs)]),
+        ('panda_profile_duration_seconds', 'gauge', 'Time from the first to the last task of each profile.',
+         [(dict(labels, profile=profile), spans[profile][1] - spans[profile][0]) for profile in sorted(spans)]),
+        ('panda_task_duration_seconds', 'gauge', 'Duration of each task in the last run.',
+         [(dict(labels, profile=profile, manager=manager, task=name), end - start)
+          for name, profile, manager, status, start, end in sorted(tasks)]),
+        ('panda_task_failures_total', 'counter', 'Failed tasks by profile and package manager.',
+         [(dict(labels, profile=key.split('/')[0], manager=key.split('/')[1]), failures[key])
+          for key in sorted(failures)]),
+        ('panda_package_install_seconds', 'gauge', 'Install time of each package in the last run.',
+         [(dict(labels, manager=manager, package=name), packages[(manager, name)])
+          for manager, name in sorted(packages)])
+    ]
+
+    cache_stats = artifact_cache.stats()
+    if cache_stats:
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        families += [
+            ('panda_artifact_cache_hits_total', 'counter', 'Downloads served from the artifact cache.',
+             [(labels, cache_stats['hits'])]),
+            ('panda_artifact_cache_misses_total', 'counter', 'Downloads the artifact cache fetched upstream.',
+             [(labels, cache_stats['misses'])]),
+            ('panda_artifact_cache_hit_ratio', 'gauge', 'Share of downloads served from the artifact cache.',
+             [(labels, float(cache_stats['hits']) / lookups)] if lookups else [])
+        ]
+
+    try:
+        write(directory, script, families)
+    except (IOError, OSError) as e:
+        print('WARNING: Could not write metrics to {}: {}'.format(directory, e))
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            return self.send_error(404)
+        body = ''
+        for name in sorted(os.listdir(self.server.directory)):
+            if name.endswith('.prom') and not name.startswith('.'):
+                try:
+                    with open(join(self.server.directory, name)) as f:
+                        body += f.read()
+                except IOError:
+                    pass
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the provisioning metrics of this machine over HTTP.')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('-d', '--dir', help='Textfile directory the scripts write to.', required=True)
+    parser.add_argument('-p', '--port', help='Port to listen on (default: 9101).', type=int, default=9101,
+                        required=False)
+    args = parser.parse_args()
+
+    server = BaseHTTPServer.HTTPServer(('', args.port), MetricsHandler)
+    server.directory = expanduser(args.dir)
+    print('Serving metrics from {} on port {}...'.format(server.directory, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,52 +1,36 @@
 #!/usr/bin/env python
 import argparse
 import ConfigParser
-import subprocess
+import json
 import sys
 
-from os import chdir, getcwd, mkdir
-from os.path import expanduser, isdir, join
+import agent_update
+import artifact_cache
+import batching
+import build_gc
+import downloads
+import drift
+import engine
+import gitsync
+import history
+import inventory
+import journal
+import manifest
+import metrics
+import policy
+import preflight
+import renderer
+import retries
+import runner
+import scheduler
+import sdk_catalog
+import snapshot
+import tracing
+
+from os import mkdir
+from os.path import abspath, basename, dirname, exists, expanduser, isdir, join
 from socket import gethostname
 
-agent_support = {
-    'brew': [
-        'androidndk-9c-android',
-        'androidndk-9d-android',
-        'androidndk-10d-android',
-        'xcode-6.1.1-mac',
-        'xcode-6.2-mac',
-        'unity-4.6.3f1-mac',
-        'unity-4.6.3p3-mac',
-        'unity-5.0.0f4-mac'
-    ],
-    'gem': [
-        'xcodeproj -v 0.19.2'
-    ],
-    'pip': [
-        ['paramiko',
-         'requests'
-        ]
-    ]
-}
-
-bamboo_support = {
-    'brew': [
-    ],
-    'gem': [
-    ],
-    'pip': [
-    ]
-}
-
-web_support = {
-    'brew': [
-    ],
-    'gem': [
-    ],
-    'pip': [
-    ]
-}
-
 gitconfig = '''
 [credential "https://backflipstudios.kilnhg.com"]
 username = {}
@@ -78,26 +62,14 @@ export PANDA_HOME={}/panda
 alias la="ls -la"
 '''
 
-update_agent = '''
-#/bin/sh
-cd ~/panda
-git pull origin agent
+# Kept for anything that still runs ~/update_agent.sh; the work is done by agent_update.py.
+update_agent = '''#!/bin/sh
+exec {python} {script}{options} "$@"
 '''
 
-clean_build_dir = '''
-#/bin/sh
-BUILD_DIR=~/bamboo-agent-home/xml-data/build-dir
-
-echo "Clearing build dir: ${BUILD_DIR}"
-
-cd $BUILD_DIR
-pwd
-rm -fr ./*
-
-echo "Bamboo build dir clean completed."
-'''
-
-clean_build_dir_plist= '''
+# Runs build_gc.py from wherever panda.py was run, every ten minutes. A run with enough free disk space returns right
+# away; the collector itself decides when to evict.
+build_gc_plist = '''
 <?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
 <plist version="1.0">
@@ -107,15 +79,24 @@ clean_build_dir_plist= '''
 
         <key>ProgramArguments</key>
         <array>
-            <string>/Users/bamboo/clear_build_dir.sh</string>
+            <string>{python}</string>
+            <string>{script}</string>
         </array>
 
-        <key>StartCalendarInterval</key>
-        <dict>
-                <key>Minute</key><integer>0</integer>
-                <key>Hour</key><integer>4</integer>
-                <key>WeekDay</key><integer>6</integer>
-        </dict>
+        <key>StartInterval</key>
+        <integer>600</integer>
+
+        <key>Nice</key>
+        <integer>10</integer>
+
+        <key>LowPriorityIO</key>
+        <true/>
+
+        <key>StandardOutPath</key>
+        <string>{log}</string>
+
+        <key>StandardErrorPath</key>
+        <string>{log}</string>
     </dict>
 </plist>
 '''
@@ -207,28 +188,16 @@ emacsconfig = '''
 def communicate(args):
     result = None
     try:
-        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        output, error = process.communicate()
-        if process.returncode == 0:
-            result = output.strip()
+        run = engine.run(args, capture=True, echo=False)
+        if run.returncode == 0:
+            result = run.output.strip()
     except Exception:
         pass
     return result
 
 
 def call(args):
-    ret = subprocess.call(args)
-    return ret
-
-
-def ask_or_exit(ret):
-    while True:
-        choice = raw_input('Continue? (y/n): ')
-        if choice == 'y' or choice == 'Y':
-            break
-        elif choice == 'n' or choice == 'N':
-            print('Aborting.')
-            sys.exit(ret)
+    return engine.run(args).returncode
 
 
 def install_call(args, fail_on_error, quiet=False):
@@ -237,25 +206,65 @@ def install_call(args, fail_on_error, quiet=False):
         print('\nERROR: Failed to install package: {}'.format(args))
         if fail_on_error:
             sys.exit(ret)
-        elif not quiet:
-            ask_or_exit(ret)
-    
+        ret = policy.handle_failure(args, ret, lambda: call(args), prompt=not quiet)
+    return ret
+
 
 def brew_install(package_name, fail_on_error, quiet=False):
-    install_call(["brew", "install"] + package_name.split(), fail_on_error, quiet)
+    return install_call(["brew", "install"] + package_name.split(), fail_on_error, quiet)
 
 
 def pip_install(package_props, fail_on_error, quiet=False):
-    install_call(["pip", "install"] + package_props, fail_on_error, quiet)
+    return install_call(["pip", "install"] + package_props, fail_on_error, quiet)
 
 
 def gem_install(package_name, fail_on_error, quiet=False):
-    install_call(["gem", "install"] + package_name.split(), fail_on_error, quiet)
+    return install_call(["gem", "install"] + package_name.split() + artifact_cache.manager_args("gem"), fail_on_error,
+                        quiet)
+
+
+def brew_install_all(package_names, fail_on_error, quiet=False):
+    package_names = inventory.missing('brew', package_names)
+    return batching.batch_install('brew', package_names, brew_install, fail_on_error, quiet)
 
 
-def write_config(path, content):
-    with open(expanduser(path), 'w') as f:
-        f.write(content)
+def pip_install_all(package_props_list, fail_on_error, quiet=False):
+    package_props_list = inventory.missing('pip', package_props_list)
+    return batching.batch_install('pip', package_props_list, pip_install, fail_on_error, quiet)
+
+
+def gem_install_all(package_names, fail_on_error, quiet=False):
+    package_names = inventory.missing('gem', package_names)
+    return batching.batch_install('gem', package_names, gem_install, fail_on_error, quiet)
+
+
+def install_android_components(components, fail_on_error, quiet=False):
+    # The SDK manager asks once per license; answering once per component covers them all.
+    args = ['android', 'update', 'sdk', '-u', '-a', '-t', ','.join(components)] + artifact_cache.manager_args('android')
+    ret = engine.run(args, input='y\n' * len(components)).returncode
+    if ret != 0:
+        print('\nERROR: Failed to install Android SDK components: {}'.format(', '.join(components)))
+        if fail_on_error:
+            sys.exit(ret)
+        ret = policy.handle_failure(args, ret, lambda: engine.run(args, input='y\n' * len(components)).returncode,
+                                    prompt=not quiet)
+    return ret
+
+
+def write_config(path, content, mode=None):
+    # Staged until renderer.commit(); files whose content hasn't changed are left alone.
+    renderer.render(path, content, mode)
+
+
+# The files written by each configuration option, so --verify can write the drifted ones again without the option.
+config_files = {
+    'environment': ['~/.profile'],
+    'kiln': ['~/.hgrc', '~/.gitconfig', '~/.git-credentials'],
+    'github': ['~/.backflipbrew'],
+    'emacs': ['~/.emacs'],
+    'agent': ['~/Library/LaunchAgents/com.atlassian.bamboo.plist',
+              '~/Library/LaunchAgents/com.backflipstudios.cleanbuilddir.plist', '~/update_agent.sh']
+}
 
 
 def write_profile_config():
@@ -278,7 +287,7 @@ def write_kiln_config(config_parser):
     if kiln_access_token is not None and len(kiln_access_token) > 0:
         write_config('~/.hgrc', hgconfig.format(kiln_access_token))
         write_config('~/.gitconfig', gitconfig.format(kiln_access_token))
-        write_config('~/.git-credentials', gitcredentials.format(kiln_access_token, 'anypassword'))
+        write_config('~/.git-credentials', gitcredentials.format(kiln_access_token, 'anypassword'), 0o600)
 
 
 def write_github_config(config_parser):
@@ -288,7 +297,7 @@ def write_github_config(config_parser):
         github_access_token = raw_input('Github Access Token: ')
 
     if github_access_token is not None and len(github_access_token) > 0:
-        write_config('~/.backflipbrew', backflipbrewconfig.format(github_access_token))
+        write_config('~/.backflipbrew', backflipbrewconfig.format(github_access_token), 0o600)
    
 
 def write_plists():
@@ -298,23 +307,94 @@ def write_plists():
         mkdir(expanduser(launchagent_path))
 
     write_config(join(launchagent_path, 'com.atlassian.bamboo.plist'), bamboo_plist)
-    write_config(join(launchagent_path, 'com.backflipstudios.cleanbuilddir.plist'), clean_build_dir_plist)
+    # Same label as the weekly clear_build_dir.sh job it replaces, so reloading the agent swaps one for the other.
+    write_config(join(launchagent_path, 'com.backflipstudios.cleanbuilddir.plist'),
+                 build_gc_plist.format(python=sys.executable, script=join(dirname(abspath(__file__)), 'build_gc.py'),
+                                       log=expanduser('~/Library/Logs/build_gc.log')))
 
 
-def write_shell_scripts():
+def write_shell_scripts(metrics_dir=None):
     print('Installing support scripts to ~/...')
-    write_config(join('~', 'update_agent.sh'), update_agent)
-    write_config(join('~', 'clear_build_dir.sh'), clean_build_dir)
+    options = ' --metrics-dir {}'.format(expanduser(metrics_dir)) if metrics_dir else ''
+    write_config(join('~', 'update_agent.sh'),
+                 update_agent.format(python=sys.executable, script=join(dirname(abspath(__file__)), 'agent_update.py'),
+                                     options=options), 0o755)
 
 
-def clone_panda_repo():
-    print('Cloning the panda repository...')
-    current_dir = getcwd()
-    chdir(expanduser('~'))
-    install_call(['git', 'clone', 'https://backflipstudios.kilnhg.com/Code/Repositories/Group/panda.git'], False)
-    chdir('panda')
-    install_call(['git', 'checkout', 'agent'], False)
-    chdir(current_dir)
+# LaunchAgents whose reload was put off because the agent was busy.
+pending_reloads_path = '~/.panda_pending_reloads.json'
+
+
+def agent_busy(path):
+    # Unloading the Bamboo agent kills the build it is running, so it waits until no process is working in a
+    # workspace.
+    return basename(path) == 'com.atlassian.bamboo.plist' and bool(build_gc.busy_workspaces(
+        expanduser(build_gc.default_build_dir)))
+
+
+def reload_launch_agents(changes):
+    # launchd keeps running the old definition of an agent that is already loaded until it is reloaded. New agents
+    # are picked up at the next login as before. Reloads put off while a build was running are tried again by the
+    # next run.
+    try:
+        with open(expanduser(pending_reloads_path)) as f:
+            paths = json.load(f)
+    except (IOError, ValueError):
+        paths = []
+    paths += [change.path for change in changes if change.path.endswith('.plist') and not change.created]
+
+    deferred = []
+    for path in sorted(set(paths)):
+        if not exists(path):
+            continue
+        if agent_busy(path):
+            print('Not reloading launch agent {} while a build is running; the next run will.'.format(path))
+            deferred.append(path)
+            continue
+        print('Reloading launch agent {}...'.format(path))
+        call(['launchctl', 'unload', path])
+        call(['launchctl', 'load', path])
+
+    if deferred or paths:
+        with open(expanduser(pending_reloads_path), 'w') as f:
+            json.dump(deferred, f)
+
+
+def clone_panda_repo(mode=gitsync.MIRROR):
+    # Runs alongside other installs, so address the checkout explicitly rather than changing the process-wide cwd.
+    url, branch, path = agent_update.default_url, agent_update.default_branch, agent_update.default_path
+    if mode != gitsync.PARTIAL:
+        # A versioned tree behind a symlink, swapped atomically, the same way update_agent.sh keeps it current.
+        return agent_update.update(url, branch, path, mode, force=True,
+                                   run=lambda args: install_call(['git'] + args, False))
+
+    # Partial clones are fetched straight from the remote and updated in place.
+    try:
+        steps = gitsync.partial_steps(url, branch, path)
+    except ValueError as e:
+        print('ERROR: {}'.format(e))
+        return 1
+    print('Updating the panda repository...' if gitsync.is_repository(expanduser(path)) else
+          'Cloning the panda repository...')
+    for args in steps:
+        ret = install_call(['git'] + args, False)
+        if ret != 0:
+            return ret
+
+
+def schedule_support(schedule, profile, plan, quiet, deps=(), prefetch=False):
+    # Packages another selected profile already installs have been merged out of the plan. With prefetch, the brew
+    # formulas' archives are downloaded first (see downloads.py) while pip and gem get on with their installs.
+    for manager, install_all in [('brew', brew_install_all), ('pip', pip_install_all), ('gem', gem_install_all)]:
+        entries = plan.entries(profile, manager)
+        if not entries:
+            continue
+        manager_deps = list(deps)
+        if manager == 'brew' and prefetch:
+            manager_deps.append(schedule.add('{}:download'.format(profile), downloads.prefetch_formulas, entries,
+                                             manager='download', deps=deps, profile=profile))
+        schedule.add('{}:{}'.format(profile, manager), install_all, entries, False, quiet, manager=manager,
+                     deps=manager_deps, inputs=entries, profile=profile)
 
 
 def accept_unity_license():
@@ -340,8 +420,73 @@ def main():
     parser.add_argument('-g', '--github', help='Configure to use Github Access Tokens for Homebrew', action='store_true', required=False)
     parser.add_argument('-q', '--quiet', help='Quiet mode. Suppresses error messages from most failed installations.',
                         action='store_true', required=False)
+    parser.add_argument('--no-batch', help='Install packages one at a time instead of one batch per package manager.',
+                        action='store_true', required=False)
+    parser.add_argument('-f', '--force', help='Install packages even if they are already installed.',
+                        action='store_true', required=False)
+    parser.add_argument('--from-scratch', help='Ignore the journal of a previous interrupted run and redo every step.',
+                        action='store_true', required=False)
+    parser.add_argument('--cache', help='Route downloads through a local artifact cache kept in this directory.',
+                        required=False)
+    parser.add_argument('--cache-url', help='Route downloads through a shared artifact cache server.', required=False)
+    parser.add_argument('--cache-size', help='Maximum size of the local artifact cache, e.g. 50G.',
+                        type=artifact_cache.parse_size, default=artifact_cache.default_max_size, required=False)
+    parser.add_argument('--timeout', help='Terminate any single command that runs for longer than this many seconds.',
+                        type=int, required=False)
+    parser.add_argument('--deadline', help='Terminate the run if it takes longer than this many seconds in total.',
+                        type=int, required=False)
+    parser.add_argument('--on-failure', help='What to do when a step fails (default: prompt, or continue with -q).',
+                        choices=policy.policies, required=False)
+    parser.add_argument('--policy', help='Failure policy for a profile and/or package manager, e.g. brew=retry or '
+                        'agent.*=continue. May be repeated.', type=policy.parse_rule, action='append', default=[],
+                        required=False)
+    parser.add_argument('--trace',
+                        help='Append a timing trace of the run to this file (default: ~/.panda_trace.jsonl).',
+                        default='~/.panda_trace.jsonl', required=False)
+    parser.add_argument('--no-trace', help='Do not record a timing trace.', action='store_true', required=False)
+    parser.add_argument('--clone', help='How to fetch the panda repository: through a local mirror (default), a '
+                        'shallow mirror for fresh agents, or a blobless partial clone.', choices=gitsync.modes,
+                        default=gitsync.MIRROR, required=False)
+    parser.add_argument('--download-jobs', help='Connections used to download large Homebrew archives for the agent '
+                        'profile (default: 4, 0 to leave the downloads to brew).', type=int, default=downloads.jobs,
+                        required=False)
+    parser.add_argument('--verify', help='Compare what is installed with the baseline of the last successful run, '
+                        'without running the package managers, and install only what has drifted.',
+                        action='store_true', required=False)
+    parser.add_argument('--snapshot-restore', help='Restore this golden-image snapshot before installing, so only the '
+                        'packages that differ from it are installed.', metavar='NAME', required=False)
+    parser.add_argument('--snapshot-save', help='After a successful run, save what is installed as a snapshot with '
+                        'this name.', metavar='NAME', required=False)
+    parser.add_argument('--snapshot-dir', help='Where snapshots are kept (default: {}).'.format(snapshot.default_dir),
+                        default=snapshot.default_dir, required=False)
+    parser.add_argument('--retries', help='Extra attempts for network commands that fail with a timeout or a '
+                        'connection error (default: 3, 0 for none).', type=int, default=retries.attempts,
+                        required=False)
+    parser.add_argument('--history', help='Durations of past runs, used to start the longest work first and '
+                        'estimate time left (default: ~/.panda_history.json).', default='~/.panda_history.json',
+                        required=False)
+    parser.add_argument('--metrics-dir', help='Write Prometheus metrics for the run (and for update_agent.sh with -a) '
+                        'to this node-exporter textfile directory.', required=False)
+    parser.add_argument('--manifest', help='Package manifest to install from (default: manifest.json next to this '
+                        'script).', default=manifest.default_path, required=False)
     args = parser.parse_args()
 
+    runner.configure_log('~/.panda.log')
+    runner.command_timeout = args.timeout
+    runner.set_deadline(args.deadline)
+    retries.attempts = args.retries
+    if not args.no_trace:
+        tracing.configure(args.trace, 'panda')
+    history.load(args.history)
+    if args.metrics_dir:
+        metrics.configure(args.metrics_dir, 'panda')
+    policy.configure(args.on_failure or (policy.CONTINUE if args.quiet else None), args.policy)
+
+    batching.enabled = not args.no_batch
+    inventory.enabled = not args.force
+    artifact_cache.configure(args.cache, args.cache_url, args.cache_size)
+    downloads.jobs = args.download_jobs
+
     config = ConfigParser.SafeConfigParser()
     try:
         with open(expanduser('/.tokens')) as f:
@@ -353,61 +498,141 @@ def main():
         parser.print_help()
         return 1
 
-    if args.environment:
+    profiles = [profile for profile in ('emacs', 'agent', 'bamboo', 'web') if getattr(args, profile)]
+    try:
+        plan = manifest.load_plan(args.manifest, profiles, '~/.panda_plan.json')
+    except (IOError, ValueError) as e:
+        print('ERROR: Could not load the manifest: {}'.format(e))
+        return 1
+
+    probes = []
+    if profiles:
+        probes.append(preflight.Probe('homebrew', ['brew', '--version'],
+                                      help='Homebrew was not found. Please install homebrew first.'))
+        probes.append(preflight.Probe('path', check=preflight.check_path_order,
+                                      help='/usr/bin occurs before /usr/local/bin. Put /usr/local/bin first in PATH.'))
+    if args.agent:
+        probes.append(preflight.tool_probe('git', help='git was not found. Install the Xcode command line tools.'))
+    if probes and not preflight.run(probes):
+        return 1
+
+    journal.load(expanduser('~/.panda_journal'), args.from_scratch)
+
+    # --verify looks at what is actually installed before anything is written, so that drifted configuration files
+    # are written again below even when their option wasn't given.
+    drifted = None
+    if args.verify:
+        baseline = drift.load_baseline(drift.default_baseline_path)
+        if baseline is None or baseline['digest'] != plan.digest:
+            print('No baseline for this manifest yet; checking every package.')
+        else:
+            state, drifted = drift.check(baseline)
+            drift.report(drifted)
+    redo = set(item.name for item in drifted or [] if item.kind == 'configs')
+    sections = set(section for section, paths in config_files.items()
+                   if getattr(args, section) or any(expanduser(path) in redo for path in paths))
+
+    if 'environment' in sections:
         print('Installing basic environment profile...')
         write_profile_config()
 
-    if args.kiln:
+    if 'kiln' in sections:
         print('Setting up SCM for Kiln...')
         write_kiln_config(config)
 
-    if args.github:
+    if 'github' in sections:
         print('Setting Github for Homebrew...')
         write_github_config(config)
 
-    if args.emacs:
-        print('Installing basic emacs setup...')
-        brew_install('emacs', False)
+    if 'emacs' in sections:
         write_config('~/.emacs', emacsconfig)
 
-    if args.agent:
-        clone_panda_repo()
+    if 'agent' in sections:
         write_plists()
-        write_shell_scripts()
+        write_shell_scripts(args.metrics_dir)
+
+    changes = renderer.commit()
+    renderer.report(changes)
+    reload_launch_agents(changes)
+
+    if args.snapshot_restore:
+        if snapshot.restore(args.snapshot_restore, plan, args.snapshot_dir) != 0:
+            return 1
+        if drifted is not None:
+            state, drifted = drift.check(baseline)
+
+    # Drifted configuration files have been put back by the renderer, and drifted SDK packages the SDK manager can name
+    # are installed again below. Anything else keeps its place in the baseline, so the next run reports it again.
+    install_plan = plan
+    components = []
+    unrepaired = []
+    if drifted is not None:
+        if not drifted:
+            metrics.export(True)
+            return 0
+        drift.seed_inventory(state)
+        install_plan = drift.restrict(plan, drifted)
+        sdk_path = sdk_catalog.get_android_sdk_path()
+        for item in drifted:
+            component = drift.sdk_filter(sdk_path, item.name) if item.kind == 'android' else None
+            if component:
+                components.append(component)
+            elif item.kind == 'android' or (item.kind == 'configs' and item.name not in renderer.rendered):
+                unrepaired.append(item)
+        for item in unrepaired:
+            print('WARNING: Can\'t put back {} {}; it stays drifted.'.format(item.kind, item.name))
+
+    # The configuration files above are cheap to check and may hold new tokens, so only the installs are skipped.
+    elif plan.converged and not args.force and not args.from_scratch:
+        print('Nothing to install: the manifest hasn\'t changed since the last successful run. Use -f to check anyway.')
+        metrics.export(True)
+        return snapshot.capture(args.snapshot_save, plan, args.snapshot_dir) if args.snapshot_save else 0
+
+    schedule = scheduler.Scheduler()
+
+    if args.emacs and install_plan.entries('emacs', 'brew'):
+        print('Installing basic emacs setup...')
+        schedule.add('emacs:brew', brew_install_all, install_plan.entries('emacs', 'brew'), False, manager='brew',
+                     profile='emacs')
 
+    if args.agent:
         print('Installing Xcode support...')
-        for brew_package in agent_support['brew']:
-            brew_install(brew_package, False, args.quiet)
-
-        for pip_package in agent_support['pip']:
-            pip_install(pip_package, False, args.quiet)
-
-        for gem_package in agent_support['gem']:
-            gem_install(gem_package, False, args.quiet)
+        if install_plan is plan:
+            schedule.add('agent:clone', clone_panda_repo, args.clone, manager='git', profile='agent')
+        schedule_support(schedule, 'agent', install_plan, args.quiet, prefetch=args.download_jobs > 0)
 
     if args.bamboo:
         print('Installing Xcode support...')
-        for brew_package in bamboo_support['brew']:
-            brew_install(brew_package, False, args.quiet)
-
-        for pip_package in bamboo_support['pip']:
-            pip_install(pip_package, False, args.quiet)
-
-        for gem_package in bamboo_support['gem']:
-            gem_install(gem_package, False, args.quiet)
+        schedule_support(schedule, 'bamboo', install_plan, args.quiet)
 
     if args.web:
         print('Installing Xcode support...')
-        for brew_package in web_support['brew']:
-            brew_install(brew_package, False, args.quiet)
+        schedule_support(schedule, 'web', install_plan, args.quiet)
 
-        for pip_package in web_support['pip']:
-            pip_install(pip_package, False, args.quiet)
+    if components:
+        schedule.add('android:update', install_android_components, components, False, args.quiet, manager='android')
 
-        for gem_package in web_support['gem']:
-            gem_install(gem_package, False, args.quiet)
+    # Only a run that got to the end can count as a success; SystemExit, Ctrl-C and errors leave this unset.
+    completed = False
+    try:
+        schedule.run()
+        completed = True
+    finally:
+        artifact_cache.report()
+        retries.report()
+        failed = policy.report()
+        tracing.finish()
+        history.save()
+        metrics.export(completed and not failed)
+
+    if failed:
+        return 1
 
-    return 0
+    # Steps skipped at the prompt are tried again by the next run, rather than recorded as the state to keep.
+    if not policy.skipped():
+        manifest.mark_converged(plan, '~/.panda_plan.json')
+        drift.save_baseline(drift.default_baseline_path, plan, renderer.rendered, unrepaired)
+    return snapshot.capture(args.snapshot_save, plan, args.snapshot_dir) if args.snapshot_save else 0
 
 if __name__ == '__main__':
     sys.exit(main())
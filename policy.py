@@ -0,0 +1,168 @@
+"""Failure policies for provisioning steps, replacing the blocking ask_or_exit() prompt.
+
+A policy decides what happens when a command fails:
+
+    fail-fast   stop the run
+    continue    record the failure and carry on
+    retry       run the command again up to retry_count times, then carry on
+    prompt      ask the operator whether to continue (the original behaviour)
+
+Policies are chosen per profile and per package manager. Failures that don't stop the run are collected and printed
+by report() at the end. Failures the operator chose to continue past at the prompt are reported as skipped and don't
+make the run fail, but they still keep it from being recorded as converged, so the next run tries them again.
+"""
+import argparse
+import sys
+import threading
+
+from os.path import basename
+
+import scheduler
+
+FAIL_FAST = 'fail-fast'
+CONTINUE = 'continue'
+RETRY = 'retry'
+PROMPT = 'prompt'
+
+policies = [FAIL_FAST, CONTINUE, RETRY, PROMPT]
+
+default_policy = PROMPT
+
+# Number of extra attempts made by the retry policy.
+retry_count = 2
+
+# (profile, manager) -> policy. None matches any profile or manager.
+_rules = {}
+
+_failures = []
+_recovered = []
+_skipped = []
+_lock = threading.Lock()
+
+
+class Failure(object):
+    def __init__(self, profile, manager, args, ret, attempts):
+        self.profile = profile
+        self.manager = manager
+        self.args = args
+        self.ret = ret
+        self.attempts = attempts
+
+    def __str__(self):
+        where = '/'.join(part for part in (self.profile, self.manager) if part)
+        return '[{}] {} (exit {}, {} attempt(s))'.format(where, ' '.join(self.args), self.ret, self.attempts)
+
+
+def set_policy(policy, profile=None, manager=None):
+    _rules[(profile, manager)] = policy
+
+
+def parse_rule(spec):
+    # '[PROFILE.]MANAGER=POLICY', where either part may be '*': 'brew=retry', 'agent.*=continue', 'agent.gem=fail-fast'
+    try:
+        key, policy = spec.split('=', 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected [PROFILE.]MANAGER=POLICY, got {}'.format(spec))
+    if policy not in policies:
+        raise argparse.ArgumentTypeError('Unknown policy {}, expected one of {}'.format(policy, ', '.join(policies)))
+    profile, manager = key.split('.', 1) if '.' in key else (None, key)
+    return (None if profile == '*' else profile), (None if manager == '*' else manager), policy
+
+
+def configure(default=None, rules=()):
+    global default_policy
+    if default is not None:
+        default_policy = default
+    for profile, manager, policy in rules:
+        set_policy(policy, profile, manager)
+
+
+def policy_for(profile, manager):
+    for key in ((profile, manager), (profile, None), (None, manager)):
+        if key in _rules:
+            return _rules[key]
+    return default_policy
+
+
+def ask_or_exit(ret):
+    with scheduler.console_lock:
+        while True:
+            choice = raw_input('Continue? (y/n): ')
+            if choice == 'y' or choice == 'Y':
+                break
+            elif choice == 'n' or choice == 'N':
+                print('Aborting.')
+                sys.exit(ret)
+
+
+def handle_failure(args, ret, retry=None, prompt=True):
+    """Applies the policy for the current step to a failed command and returns the exit code to carry on with.
+
+    retry is a callable that runs the command again and returns its exit code. Exits for fail-fast, and for prompt
+    when the operator declines to continue. prompt=False (quiet mode) turns the prompt policy into continue.
+    """
+    task = getattr(scheduler.current, 'task', None)
+    profile = task.profile if task else None
+    manager = task.manager if task and task.manager else basename(args[0])
+    policy = policy_for(profile, manager)
+
+    attempts = 1
+    if policy == RETRY and retry is not None:
+        while ret != 0 and attempts <= retry_count:
+            print('Retrying ({}/{}): {}'.format(attempts, retry_count, ' '.join(args)))
+            ret = retry()
+            attempts += 1
+        if ret == 0:
+            with _lock:
+                _recovered.append(Failure(profile, manager, args, ret, attempts))
+            return 0
+
+    failure = Failure(profile, manager, args, ret, attempts)
+    with _lock:
+        _failures.append(failure)
+
+    if policy == FAIL_FAST:
+        print('Aborting.')
+        sys.exit(ret)
+    elif policy == PROMPT and prompt:
+        ask_or_exit(ret)
+        # The operator accepted it.
+        with _lock:
+            _failures.remove(failure)
+            _skipped.append(failure)
+
+    return ret
+
+
+def failures():
+    with _lock:
+        return list(_failures)
+
+
+def skipped():
+    with _lock:
+        return list(_skipped)
+
+
+def report():
+    # Prints the failures deferred during the run and returns how many there were, leaving out those the operator
+    # accepted.
+    with _lock:
+        recovered = list(_recovered)
+        accepted = list(_skipped)
+        failed = list(_failures)
+
+    for failure in recovered:
+        print('RECOVERED {}'.format(failure))
+
+    if accepted:
+        print('\n{} failed step(s) skipped at the operator\'s request:'.format(len(accepted)))
+        for failure in accepted:
+            print('  SKIPPED {}'.format(failure))
+
+    if failed:
+        print('\n{} step(s) failed:'.format(len(failed)))
+        for failure in failed:
+            print('  FAILED {}'.format(failure))
+
+    return len(failed)
@@ -0,0 +1,157 @@
+"""Prerequisite checks run before any provisioning work, shared by dev.py and panda.py.
+
+Each Probe either runs a command (Xcode's clang, Homebrew, java) or answers a question in-process (is the tool on
+PATH, does /usr/local/bin come before /usr/bin). Commands run concurrently, and a command that passed is remembered
+in ~/.preflight_cache.json against the path, size and modification time of its binary (plus any other files it
+depends on), so it isn't run again until the tool is reinstalled or upgraded. The results are printed as one table.
+"""
+import hashlib
+import json
+import os
+
+from os.path import expanduser, isfile, realpath
+
+import engine
+
+default_cache_path = '~/.preflight_cache.json'
+
+
+class Probe(object):
+    def __init__(self, name, args=None, check=None, help=None, watch=()):
+        # args: command to run, which passes when it exits 0. check: callable returning (ok, detail) instead.
+        # help: what to tell the operator when the probe fails. watch: other files whose change invalidates the cache.
+        self.name = name
+        self.args = args
+        self.check = check
+        self.help = help
+        self.watch = list(watch)
+
+
+class Result(object):
+    def __init__(self, probe, ok, detail, cached=False):
+        self.probe = probe
+        self.ok = ok
+        self.detail = detail
+        self.cached = cached
+
+
+def which(name, path=None):
+    # The first executable called name on PATH, like which(1) but without spawning it.
+    for directory in (path if path is not None else os.environ.get('PATH', '')).split(os.pathsep):
+        candidate = os.path.join(directory, name)
+        if directory and isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def check_path_order(path=None):
+    # Homebrew's tools must shadow the system ones.
+    path = path if path is not None else os.environ.get('PATH', '')
+    entries = [entry.rstrip('/') for entry in path.split(os.pathsep)]
+    if '/usr/bin' in entries and '/usr/local/bin' in entries:
+        if entries.index('/usr/local/bin') > entries.index('/usr/bin'):
+            return False, '/usr/bin comes before /usr/local/bin'
+    return True, '/usr/local/bin first' if '/usr/local/bin' in entries else '/usr/local/bin not on PATH'
+
+
+def tool_probe(name, help=None):
+    # Passes when name is on PATH.
+    def check():
+        found = which(name)
+        return (True, found) if found else (False, '{} not found on PATH'.format(name))
+    return Probe(name, check=check, help=help)
+
+
+def _fingerprint(probe, binary):
+    parts = [probe.args]
+    for path in [binary] + probe.watch:
+        try:
+            stat = os.stat(path)
+            parts.append([realpath(path), stat.st_size, stat.st_mtime])
+        except OSError:
+            parts.append([path, None, None])
+    return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+
+def _load_cache(cache_path):
+    try:
+        with open(expanduser(cache_path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_cache(cache_path, cache):
+    path = expanduser(cache_path)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def _first_line(text):
+    lines = [line.strip() for line in (text or '').splitlines() if line.strip()]
+    return lines[0] if lines else ''
+
+
+def evaluate(probes, cache_path=default_cache_path):
+    # Returns a Result per probe, in order. Commands not answered by the cache all run at once.
+    cache = _load_cache(cache_path) if cache_path else {}
+    results = [None] * len(probes)
+    pending = []
+
+    for i, probe in enumerate(probes):
+        if probe.check is not None:
+            ok, detail = probe.check()
+            results[i] = Result(probe, ok, detail)
+            continue
+
+        binary = which(probe.args[0])
+        if binary is None:
+            results[i] = Result(probe, False, '{} not found on PATH'.format(probe.args[0]))
+            continue
+
+        key = _fingerprint(probe, binary)
+        if key in cache:
+            results[i] = Result(probe, True, cache[key], cached=True)
+            continue
+        pending.append((i, key, engine.submit(probe.args, capture=True, echo=False)))
+
+    for i, key, future in pending:
+        probe = probes[i]
+        try:
+            result = future.result()
+        except OSError as e:
+            results[i] = Result(probe, False, str(e))
+            continue
+        # Some tools (java -version) answer on stderr, which only reaches the tail.
+        detail = _first_line(result.output) or _first_line(result.tail_text)
+        results[i] = Result(probe, result.returncode == 0, detail)
+        if result.returncode == 0:
+            cache[key] = detail
+
+    if cache_path and pending:
+        _save_cache(cache_path, cache)
+    return results
+
+
+def report(results):
+    width = max([len(result.probe.name) for result in results] + [5])
+    print('Preflight checks:')
+    for result in results:
+        print('  {:<{width}}  {}  {}{}'.format(result.probe.name, 'ok  ' if result.ok else 'FAIL', result.detail,
+                                               ' (cached)' if result.cached else '', width=width))
+
+    for result in results:
+        if not result.ok and result.probe.help:
+            print('\nERROR: {}'.format(result.probe.help))
+
+
+def run(probes, cache_path=default_cache_path):
+    # Evaluates and reports the probes; returns True when all of them passed.
+    results = evaluate(probes, cache_path)
+    report(results)
+    return all(result.ok for result in results)
@@ -0,0 +1,113 @@
+"""Writes generated configuration files only when their content changes.
+
+render() compares the new content with what is on disk and stages a temporary file next to each file that differs.
+commit() then syncs the staged files in one pass, renames each over its target and syncs the directories, so a reader
+(git, hg, launchd) sees either the old file or the new one, never a truncated one. It returns what changed so
+dependent actions, like reloading a LaunchAgent, only run when they have to.
+
+A target that is a symlink (a dotfile kept in a dotfiles repository, say) is written through: the file it points to is
+replaced and the link is left alone.
+"""
+import os
+
+from collections import namedtuple
+from os.path import basename, dirname, exists, expanduser, join, realpath
+
+# created is True for a file that didn't exist before.
+Change = namedtuple('Change', ['path', 'created'])
+
+# (path, real path, temp path, open temp file, created) for each file render() staged.
+_pending = []
+
+# Every path passed to render() in this run, changed or not.
+rendered = []
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def render(path, content, mode=None):
+    """Stages content for path if it differs from the file on disk and returns whether it does.
+
+    mode sets the file's permissions; by default a replaced file keeps its own and a new one gets the umask default.
+    """
+    path = expanduser(path)
+    rendered.append(path)
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    # The rename has to replace the file a symlink points to, not the link.
+    real_path = realpath(path)
+    existing = _read(real_path)
+    if existing == content and (mode is None or os.stat(real_path).st_mode & 0o7777 == mode):
+        return False
+
+    if mode is None and existing is not None:
+        mode = os.stat(real_path).st_mode & 0o7777
+
+    directory = dirname(real_path)
+    if directory and not exists(directory):
+        os.makedirs(directory)
+
+    temp_path = join(directory, '.{}.{}.tmp'.format(basename(real_path), os.getpid()))
+    f = open(temp_path, 'wb')
+    if mode is not None:
+        os.chmod(temp_path, mode)
+    f.write(content)
+    f.flush()
+    _pending.append((path, real_path, temp_path, f, existing is None))
+    return True
+
+
+def commit():
+    # Makes every staged file durable and swaps them into place. Returns the Changes in the order they were rendered.
+    staged = list(_pending)
+    del _pending[:]
+
+    for _, _, _, f, _ in staged:
+        os.fsync(f.fileno())
+        f.close()
+
+    changes = []
+    directories = set()
+    for path, real_path, temp_path, _, created in staged:
+        os.rename(temp_path, real_path)
+        directories.add(dirname(real_path) or '.')
+        changes.append(Change(path, created))
+
+    # The renames themselves are only durable once their directories are synced.
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    return changes
+
+
+def discard():
+    # Drops staged files without touching their targets.
+    for _, _, temp_path, f, _ in _pending:
+        f.close()
+        if exists(temp_path):
+            os.remove(temp_path)
+    del _pending[:]
+
+
+def report(changes):
+    if not changes:
+        print('Configuration files are up to date.')
+        return
+    for change in changes:
+        print('{} {}'.format('Created' if change.created else 'Updated', change.path))
@@ -0,0 +1,227 @@
+"""Retries of commands that fail for transient reasons, and a circuit breaker per upstream source.
+
+Commands that talk to the network (brew install/update/tap, pip install, gem install, android update, git
+clone/fetch) are run through run() by the engine. When one fails, its exit code and output decide whether the
+failure is transient (a timeout, a refused or reset connection, DNS, a 5xx from the server) or permanent (an unknown
+formula, a version that doesn't exist, a build error). Transient failures are retried up to `attempts` more times,
+waiting base_delay * 2^n seconds (capped at max_delay, with jitter so agents don't retry in lockstep).
+
+Each command is attributed to the upstream source it depends on: the host of a URL among its arguments, otherwise its
+package manager's index. Once breaker_threshold commands in a row have failed transiently against a source, its
+breaker opens and further commands for it fail straight away, instead of each waiting out its own timeouts, until
+breaker_cooldown has passed and one command is let through to try again.
+
+report() prints the retries, the time spent waiting and the breakers that opened, with the rest of the run summary.
+"""
+import os
+import random
+import re
+import threading
+import time
+
+from os.path import basename
+from urlparse import urlparse
+
+import runner
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Extra attempts after a transient failure (--retries). 0 turns retrying off.
+attempts = 3
+
+base_delay = 2.0
+max_delay = 60.0
+
+# Consecutive transient failures that open a source's breaker, and seconds it stays open.
+breaker_threshold = 3
+breaker_cooldown = 300.0
+
+# Exit code of a command refused by an open breaker (EX_TEMPFAIL).
+CIRCUIT_OPEN_EXIT_CODE = 75
+
+# Subcommands that reach the network, per tool. Nothing else is retried or attributed to a source.
+network_commands = {
+    'brew': ['install', 'reinstall', 'upgrade', 'update', 'tap', 'fetch'],
+    'pip': ['install', 'download'],
+    'gem': ['install', 'update', 'fetch'],
+    'android': ['update', 'list'],
+    'git': ['clone', 'fetch', 'pull', 'ls-remote']
+}
+
+default_sources = {
+    'brew': 'homebrew',
+    'pip': 'pypi.org',
+    'gem': 'rubygems.org',
+    'android': 'dl.google.com',
+    'git': 'git'
+}
+
+transient_patterns = [re.compile(pattern, re.I) for pattern in [
+    # Only a network operation timing out; a test or build step that times out is a real failure.
+    r'(?:connection|connect|operation|read|request|socket|ssl handshake|resolving)[^\n]{0,20}timed? ?out',
+    r'Timeout was reached|ReadTimeoutError|ConnectTimeoutError|socket\.timeout',
+    r'connection (?:refused|reset|aborted|closed)',
+    r'could not resolve host',
+    r'temporary failure in name resolution',
+    r'name or service not known',
+    r'network is unreachable',
+    r'failed to connect',
+    r'curl: \((?:6|7|18|28|35|52|56)\)',
+    r'(?:http|status|error)[^\n]{0,20}\b(?:502|503|504)\b',
+    r'bad gateway|service unavailable',
+    r'max retries exceeded',
+    r'remote end hung up|early eof',
+    r'Errno::(?:ECONNRESET|ETIMEDOUT|ECONNREFUSED)',
+    r'Gem::RemoteFetcher::(?:FetchError|UnknownHostError)',
+    r'failed to fetch url'
+]]
+
+transient_exit_codes = [runner.TIMEOUT_EXIT_CODE, CIRCUIT_OPEN_EXIT_CODE]
+
+_lock = threading.Lock()
+_breakers = {}
+_stats = {}
+
+
+class Breaker(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self, now):
+        # Closed: always. Open: not until the cooldown has passed, then one command at a time.
+        if self.opened_at is None:
+            return True
+        if now - self.opened_at < breaker_cooldown or self.trial:
+            return False
+        self.trial = True
+        return True
+
+    def record(self, ok, now):
+        # Returns True when this failure opened the breaker.
+        self.trial = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return False
+        self.failures += 1
+        if self.failures >= breaker_threshold:
+            opened = self.opened_at is None
+            self.opened_at = now
+            return opened
+        return False
+
+
+def _subcommand(args):
+    tool = basename(args[0])
+    return next((arg for arg in args[1:] if arg in network_commands.get(tool, [])), None)
+
+
+def source(args):
+    # The upstream a network command depends on, or None for anything else.
+    tool = basename(args[0])
+    subcommand = _subcommand(args)
+    if subcommand is None:
+        return None
+    for arg in args[1:]:
+        match = re.match(r'^(?:\w+://(?:[^@/]+@)?|[\w.-]+@)([\w.-]+)', arg)
+        if match and ('://' in arg or ':' in arg):
+            return match.group(1)
+    if tool == 'brew' and subcommand in ('update', 'tap'):
+        return 'github.com'
+    if tool == 'pip':
+        index = next((args[i + 1] for i, arg in enumerate(args[:-1]) if arg in ('-i', '--index-url')), None)
+        index = index or os.environ.get('PIP_INDEX_URL')
+        if index:
+            return urlparse(index).hostname
+    if tool == 'android' and '--proxy-host' in args[:-1]:
+        return args[args.index('--proxy-host') + 1]
+    return default_sources.get(tool, tool)
+
+
+def classify(result):
+    if result.timed_out or result.returncode in transient_exit_codes:
+        return TRANSIENT
+    text = (result.output or '')[-64 * 1024:] + result.tail_text
+    return TRANSIENT if any(pattern.search(text) for pattern in transient_patterns) else PERMANENT
+
+
+def delay(retry):
+    return min(max_delay, base_delay * 2 ** retry) * random.uniform(0.5, 1.0)
+
+
+def _stat(name):
+    return _stats.setdefault(name, {'retries': 0, 'recovered': 0, 'waited': 0.0, 'opened': 0, 'refused': 0})
+
+
+def run(args, execute, capture=False):
+    """Runs execute() (which returns a runner.Result for args) until it succeeds, fails permanently or runs out of
+    attempts, and returns the last Result.
+    """
+    name = source(args)
+    if name is None:
+        return execute()
+
+    retry = 0
+    while True:
+        with _lock:
+            breaker = _breakers.setdefault(name, Breaker())
+            now = time.time()
+            allowed = breaker.allow(now)
+            if not allowed:
+                _stat(name)['refused'] += 1
+                # Another thread may close the breaker as soon as the lock is released.
+                remaining = max(0, breaker.opened_at + breaker_cooldown - now)
+        if not allowed:
+            message = 'Not running {}: {} is failing, trying it again in {:.0f}s.'.format(' '.join(args), name,
+                                                                                         remaining)
+            runner.logger.error('ERROR: {}'.format(message))
+            return runner.Result(CIRCUIT_OPEN_EXIT_CODE, '' if capture else None, [message + '\n'], False, 0)
+
+        result = execute()
+        ok = result.returncode == 0
+        transient = not ok and classify(result) == TRANSIENT
+        with _lock:
+            opened = breaker.record(not transient, time.time())
+            stats = _stat(name)
+            if opened:
+                stats['opened'] += 1
+            if ok and retry:
+                stats['recovered'] += 1
+            is_open = breaker.opened_at is not None
+        if opened:
+            runner.logger.error('ERROR: {} failed {} times in a row; failing its commands for the next {:.0f}s.'.format(
+                name, breaker_threshold, breaker_cooldown))
+        # Once the source's breaker is open there is no point waiting for it here.
+        if not transient or retry >= attempts or is_open:
+            return result
+
+        wait = delay(retry)
+        if runner.deadline is not None and time.time() + wait >= runner.deadline:
+            return result
+        retry += 1
+        runner.logger.info('Transient failure, retrying in {:.0f}s ({}/{}): {}'.format(wait, retry, attempts,
+                                                                                     ' '.join(args)))
+        with _lock:
+            stats['retries'] += 1
+            stats['waited'] += wait
+        time.sleep(wait)
+
+
+def stats():
+    with _lock:
+        return dict((name, dict(values)) for name, values in _stats.items())
+
+
+def report():
+    summary = stats()
+    if not any(values['retries'] or values['refused'] or values['opened'] for values in summary.values()):
+        return
+    print('\nRetries by source:')
+    for name in sorted(summary):
+        values = summary[name]
+        print('  {:<24} {} retr{} ({} recovered, {:.0f}s waiting), breaker opened {} time(s), {} command(s) '
+              'refused'.format(name, values['retries'], 'y' if values['retries'] == 1 else 'ies', values['recovered'],
+                               values['waited'], values['opened'], values['refused']))
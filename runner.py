@@ -0,0 +1,192 @@
+"""Streaming subprocess runner shared by dev.py and panda.py.
+
+Output is echoed line by line to the console and to a rotating log while only a bounded tail is kept in memory for
+error reporting. Every command runs in its own process group so that a command which exceeds its timeout, or the
+overall deadline, can be terminated together with everything it spawned.
+"""
+import logging
+import logging.handlers
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from collections import deque
+from os.path import basename, expanduser
+
+import history
+import metrics
+import tracing
+
+# Seconds a single command may run for, and the absolute time (time.time()) by which the whole run must be done.
+# None means no limit.
+command_timeout = None
+deadline = None
+
+# Number of output lines kept in memory per command.
+tail_lines = 200
+
+# Seconds between SIGTERM and SIGKILL when a command is terminated.
+kill_grace = 10
+
+# Exit code reported for a command that was terminated for running too long, as timeout(1) does.
+TIMEOUT_EXIT_CODE = 124
+
+# Read size for output lines, so a progress bar redrawn with carriage returns can't grow a line without bound.
+max_line_length = 64 * 1024
+
+# Messages meant for the operator, mirrored into the log.
+logger = logging.getLogger('provision')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+logger.propagate = False
+
+# Command output, written to the log only (it is echoed to the console separately).
+output_logger = logging.getLogger('provision.output')
+output_logger.setLevel(logging.INFO)
+output_logger.addHandler(logging.NullHandler())
+output_logger.propagate = False
+
+_processes = set()
+_processes_lock = threading.Lock()
+_console_lock = threading.Lock()
+
+
+def configure_log(path, max_bytes=10 * 1024 * 1024, backup_count=5):
+    handler = logging.handlers.RotatingFileHandler(expanduser(path), maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    output_logger.addHandler(handler)
+
+
+def set_deadline(seconds):
+    global deadline
+    deadline = time.time() + seconds if seconds else None
+
+
+class Result(object):
+    def __init__(self, returncode, output, tail, timed_out, output_bytes):
+        self.returncode = returncode
+        # Complete stdout when the command was run with capture=True, otherwise None.
+        self.output = output
+        # The last tail_lines lines of output (stderr only when capturing).
+        self.tail = tail
+        self.timed_out = timed_out
+        # Total size of the output, including what was dropped from the tail.
+        self.output_bytes = output_bytes
+
+    @property
+    def tail_text(self):
+        return ''.join(self.tail)
+
+
+def _remaining(timeout):
+    limits = [limit for limit in (timeout, command_timeout) if limit is not None]
+    if deadline is not None:
+        limits.append(deadline - time.time())
+    return min(limits) if limits else None
+
+
+def _pump(pipe, prefix, echo, tail, captured, counter):
+    for line in iter(lambda: pipe.readline(max_line_length), b''):
+        counter[0] += len(line)
+        if captured is not None:
+            captured.append(line)
+            continue
+        tail.append(line)
+        output_logger.info('%s%s', prefix, line.rstrip('\n'))
+        if echo:
+            with _console_lock:
+                sys.stdout.write(prefix + line)
+                sys.stdout.flush()
+    pipe.close()
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+    end = time.time() + kill_grace
+    while process.poll() is None and time.time() < end:
+        time.sleep(0.1)
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def terminate_all():
+    # Used when the whole run is being torn down (Ctrl-C, a fatal error in another task).
+    with _processes_lock:
+        processes = list(_processes)
+    for process in processes:
+        _kill(process)
+
+
+def run(args, input=None, cwd=None, timeout=None, capture=False, echo=True, tail=None):
+    """Runs args to completion and returns a Result.
+
+    With capture=True stdout is collected in full (for commands whose output is data, like 'android list sdk') and
+    only stderr is streamed; otherwise stdout and stderr are streamed together.
+    """
+    prefix = '[{}] '.format(basename(args[0]))
+    output_logger.info('$ %s', ' '.join(args))
+    start = time.time()
+
+    process = subprocess.Popen(args, cwd=cwd, stdin=subprocess.PIPE if input is not None else None,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE if capture else subprocess.STDOUT,
+                               preexec_fn=os.setsid, close_fds=True)
+    with _processes_lock:
+        _processes.add(process)
+
+    lines = deque(maxlen=tail or tail_lines)
+    captured = [] if capture else None
+    counter = [0]
+    readers = [threading.Thread(target=_pump, args=(process.stdout, prefix, echo, lines, captured, counter))]
+    if capture:
+        readers.append(threading.Thread(target=_pump, args=(process.stderr, prefix, echo, lines, None, counter)))
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    timed_out = False
+    try:
+        if input is not None:
+            try:
+                process.stdin.write(input)
+                process.stdin.close()
+            except IOError:
+                pass
+
+        remaining = _remaining(timeout)
+        end = time.time() + remaining if remaining is not None else None
+        if end is None:
+            process.wait()
+        while process.poll() is None:
+            if time.time() >= end:
+                timed_out = True
+                logger.error('ERROR: Timed out, terminating: {}'.format(' '.join(args)))
+                _kill(process)
+                break
+            time.sleep(0.05)
+    except BaseException:
+        _kill(process)
+        raise
+    finally:
+        process.wait()
+        for reader in readers:
+            reader.join()
+        with _processes_lock:
+            _processes.discard(process)
+
+    returncode = TIMEOUT_EXIT_CODE if timed_out else process.returncode
+    end = time.time()
+    tracing.command_finished(args, start, end, returncode, counter[0], timed_out)
+    history.command_finished(args, end - start, returncode)
+    metrics.command_finished(args, end - start, returncode)
+    output = ''.join(captured) if capture else None
+    return Result(returncode, output, list(lines), timed_out, counter[0])
@@ -0,0 +1,272 @@
+"""Dependency-aware parallel task scheduler shared by dev.py and panda.py."""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+
+import engine
+import history
+import journal
+import metrics
+import tracing
+
+# Maximum number of tasks allowed to run at the same time for each package manager. Homebrew, pip and gem all lock
+# shared state (the Cellar, site-packages, the gem directory) so each of them installs one package at a time; the win
+# comes from letting different managers run side by side while the others wait on the network.
+manager_limits = {
+    'brew': 1,
+    'pip': 1,
+    'gem': 1,
+    'android': 1,
+    'git': 2
+}
+
+# Limit used for tasks whose manager is not listed above.
+default_limit = 1
+
+# Held while a task talks to the operator so that concurrent failures don't interleave their prompts.
+console_lock = threading.RLock()
+
+# current.task is the Task running on this thread, for code that needs to know which step it is part of.
+current = threading.local()
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class PriorityGate(object):
+    # A semaphore that hands free slots to the waiter with the highest priority rather than the first to arrive.
+    def __init__(self, slots):
+        self.slots = slots
+        self._waiting = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority):
+        with self._condition:
+            entry = (-priority, next(self._order))
+            heapq.heappush(self._waiting, entry)
+            while self.slots == 0 or self._waiting[0] != entry:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self.slots -= 1
+            # Another slot may still be free for the next waiter in line.
+            self._condition.notify_all()
+
+    def release(self):
+        with self._condition:
+            self.slots += 1
+            self._condition.notify_all()
+
+
+class Task(object):
+    def __init__(self, name, func, args, manager, deps, inputs, profile):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.manager = manager
+        self.profile = profile
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.status = None
+        self.result = None
+        self.done = threading.Event()
+        # Expected duration, and that plus the longest chain of tasks waiting on this one. Tasks with the longest
+        # chain go first when several want the same manager.
+        self.estimate = 0.0
+        self.priority = 0.0
+        self.start = None
+
+
+class Scheduler(object):
+    def __init__(self, limits=None):
+        self.limits = dict(manager_limits)
+        if limits:
+            self.limits.update(limits)
+        self.tasks = OrderedDict()
+        self._error = None
+        self._error_lock = threading.Lock()
+
+    def add(self, name, func, *args, **kwargs):
+        # Returns the task name so callers can collect it into the deps of later tasks. The journal keys a completed
+        # task on its inputs, which default to its arguments.
+        if name in self.tasks:
+            raise ValueError('Duplicate task: {}'.format(name))
+        self.tasks[name] = Task(name, func, args, kwargs.get('manager'), kwargs.get('deps', ()),
+                                kwargs.get('inputs', args), kwargs.get('profile'))
+        return name
+
+    def run(self):
+        self._validate()
+        self._estimate()
+
+        if history.path is not None and history.runs():
+            print('Estimated time: {}.'.format(history.format_duration(self.time_left())))
+
+        semaphores = {}
+        for task in self.tasks.values():
+            if task.manager not in semaphores:
+                semaphores[task.manager] = PriorityGate(self.limits.get(task.manager, default_limit))
+
+        threads = []
+        for task in self.tasks.values():
+            thread = threading.Thread(target=self._run_task, args=(task, semaphores[task.manager]), name=task.name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Join with a timeout so the main thread stays responsive to Ctrl-C.
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            # Commands run in their own process groups, so they don't see the terminal's SIGINT.
+            engine.cancel()
+            raise
+
+        if self._error is not None:
+            raise self._error
+
+        if all(task.status == OK and not task.result for task in self.tasks.values()):
+            journal.finish()
+
+        return self.tasks
+
+    def _validate(self):
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError('Task {} depends on unknown task {}'.format(task.name, dep))
+
+        visiting = set()
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError('Dependency cycle detected at task {}'.format(name))
+            visiting.add(name)
+            for dep in self.tasks[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.tasks:
+            visit(name)
+
+    def _estimate(self):
+        dependents = dict((name, []) for name in self.tasks)
+        for task in self.tasks.values():
+            task.estimate = history.task_estimate(task)
+            for dep in task.deps:
+                dependents[dep].append(task)
+
+        def priority(task):
+            if not task.priority:
+                task.priority = task.estimate + max([priority(dependent) for dependent in dependents[task.name]] +
+                                                    [0])
+            return task.priority
+
+        for task in self.tasks.values():
+            priority(task)
+
+    def time_left(self):
+        # The longer of the remaining critical path and the busiest manager's remaining work.
+        now = time.time()
+        remaining = {}
+        for task in self.tasks.values():
+            if task.done.is_set():
+                remaining[task.name] = 0.0
+            elif task.start is not None:
+                remaining[task.name] = max(task.estimate - (now - task.start), 0.1 * task.estimate)
+            else:
+                remaining[task.name] = task.estimate
+
+        paths = {}
+
+        def path(task):
+            if task.name not in paths:
+                paths[task.name] = remaining[task.name] + max([path(self.tasks[dep]) for dep in task.deps] + [0])
+            return paths[task.name]
+
+        load = {}
+        for task in self.tasks.values():
+            load[task.manager] = load.get(task.manager, 0) + remaining[task.name]
+        busiest = max([work / self.limits.get(manager, default_limit) for manager, work in load.items()] + [0])
+        return max([path(task) for task in self.tasks.values()] + [busiest])
+
+    def _blocked(self, task):
+        return self._error is not None or any(self.tasks[dep].status != OK for dep in task.deps)
+
+    def _run_task(self, task, semaphore):
+        start = None
+        try:
+            for dep in task.deps:
+                self.tasks[dep].done.wait()
+
+            if self._blocked(task):
+                task.status = SKIPPED
+                return
+
+            if journal.is_complete(task.name, task.inputs):
+                with console_lock:
+                    print('Skipping {}, completed by a previous run.'.format(task.name))
+                task.status = OK
+                return
+
+            semaphore.acquire(task.priority)
+            try:
+                if self._error is not None:
+                    task.status = SKIPPED
+                    return
+                current.task = task
+                start = task.start = time.time()
+                task.result = task.func(*task.args)
+                task.status = OK
+            finally:
+                semaphore.release()
+
+            # A task that returns something (a non-zero exit code, a list of failed packages) finished with errors
+            # the operator chose to continue past; leave it out of the journal so the next run tries it again.
+            if not task.result:
+                journal.record(task.name, task.inputs)
+        except BaseException as e:
+            # Anything escaping a task (including the sys.exit() of a fatal install) stops the whole run. Commands
+            # still running are cancelled, everything else is skipped and the first error is re-raised by run().
+            # A task whose command was cancelled that way didn't fail itself; it is skipped like the ones that never
+            # started.
+            task.status = SKIPPED if isinstance(e, engine.Cancelled) else FAILED
+            if not isinstance(e, (SystemExit, engine.Cancelled)):
+                with console_lock:
+                    traceback.print_exc()
+            with self._error_lock:
+                first = self._error is None
+                if first:
+                    self._error = e
+            if first:
+                # Stop the commands other tasks are running rather than waiting for them to finish.
+                engine.cancel()
+        finally:
+            if start is not None:
+                tracing.task_finished(task, start, time.time())
+                metrics.task_finished(task, start, time.time())
+                if task.status == OK:
+                    history.task_finished(task, time.time() - start)
+            task.done.set()
+            if start is not None and history.path is not None:
+                self._progress(task, time.time() - start)
+
+    def _progress(self, task, seconds):
+        done = sum(1 for t in self.tasks.values() if t.done.is_set())
+        if done == len(self.tasks):
+            return
+        with console_lock:
+            print('[{}/{}] {} took {}; about {} left.'.format(done, len(self.tasks), task.name,
+                                                             history.format_duration(seconds),
+                                                             history.format_duration(self.time_left())))
@@ -0,0 +1,179 @@
+"""Indexed catalog of the packages offered by the Android SDK manager, cached on disk between runs."""
+import hashlib
+import json
+import os
+import re
+import time
+
+from collections import OrderedDict
+from os.path import dirname, expanduser, isfile, join, realpath
+
+# Where the parsed listing is kept and how long it is trusted before 'android list sdk' is asked again.
+catalog_path = '~/.android/sdk_catalog.json'
+catalog_ttl = 24 * 60 * 60
+
+# Package types as reported by 'android list sdk -e'.
+TOOL = 'Tool'
+PLATFORM_TOOL = 'PlatformTool'
+BUILD_TOOL = 'BuildTool'
+PLATFORM = 'Platform'
+ADDON = 'Addon'
+EXTRA = 'Extra'
+
+
+def version_key(version):
+    # '21.1.2' -> ((21, 1, 2), 1, ()). A preview or release candidate ('23.0.0 rc1') sorts below its release.
+    numbers, suffix = re.match(r'^([\d.]*)(.*)$', (version or '').strip()).groups()
+    parts = re.findall(r'\d+|[^\W\d_]+', suffix.lower())
+    return (tuple(int(part) for part in numbers.split('.') if part), 0 if parts else 1,
+            tuple((1, int(part)) if part.isdigit() else (0, part) for part in parts))
+
+
+def is_release(package):
+    # build-tools-23.0.0-preview is listed with the plain revision 23.0.0 by some versions of the SDK manager.
+    return (package.revision is not None and re.match(r'^\d+(\.\d+)*$', package.revision) is not None and
+            not package.id.endswith('-preview'))
+
+
+class Package(object):
+    def __init__(self, id, type=None, revision=None, api_level=None, vendor=None, description=None):
+        self.id = id
+        self.type = type
+        self.revision = revision
+        self.api_level = api_level
+        self.vendor = vendor
+        self.description = description
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class Catalog(object):
+    def __init__(self, packages):
+        self.packages = OrderedDict((package.id, package) for package in packages)
+        self.by_type = {}
+        for package in packages:
+            self.by_type.setdefault(package.type, []).append(package)
+
+    def get(self, package_id):
+        return self.packages.get(package_id)
+
+    def of_type(self, package_type, prefix=''):
+        return [p for p in self.by_type.get(package_type, []) if p.id.startswith(prefix)]
+
+    def latest_platform_api(self):
+        return max(p.api_level for p in self.of_type(PLATFORM) if p.api_level is not None)
+
+    def latest_build_tools(self):
+        releases = [p for p in self.of_type(BUILD_TOOL) if is_release(p)]
+        return max(releases, key=lambda p: version_key(p.revision))
+
+    def latest_addon(self, prefix):
+        return max(self.of_type(ADDON, prefix), key=lambda p: (p.api_level, version_key(p.revision)))
+
+
+def parse_section(section):
+    match = re.search(r'^id: \d+ or "([^"]+)"', section, re.M)
+    if match is None:
+        return None
+    package = Package(match.group(1))
+
+    fields = dict((key.strip().lower(), value.strip())
+                  for key, value in re.findall(r'^\s*(\w[\w ]*?):\s*(.*)$', section, re.M))
+    package.type = fields.get('type')
+    package.description = fields.get('desc') or fields.get('description') or fields.get('title')
+
+    # Release candidates and previews keep their suffix, written as in source.properties: '23.0.0 rc1'.
+    revision = re.search(r'revision:?\s+([\w.-]+(?:[ \t]+(?:rc|preview)[ \t]*\d*)?)', section, re.I)
+    if revision:
+        package.revision = ' '.join(revision.group(1).rstrip('.,').split())
+    if package.revision is None and package.id.startswith('build-tools-'):
+        package.revision = package.id[len('build-tools-'):]
+
+    api_level = fields.get('api level')
+    if api_level is None:
+        # android-22, addon-google_apis-google-19, sys-img-x86-android-19
+        match = re.search(r'-(\d+)$', package.id)
+        if match and (package.type in (PLATFORM, ADDON) or package.id.startswith('sys-img-')):
+            api_level = match.group(1)
+    if api_level is not None and api_level.isdigit():
+        package.api_level = int(api_level)
+
+    package.vendor = fields.get('vendor')
+    if package.vendor is None:
+        match = re.search(r'^\s*Desc: By (.+)$', section, re.M)
+        if match:
+            package.vendor = match.group(1).strip()
+        elif package.type in (ADDON, EXTRA):
+            # addon-<name>-<vendor>-<api level>, extra-<vendor>-<path>
+            parts = package.id.split('-')
+            package.vendor = parts[-2] if package.type == ADDON else parts[1]
+
+    return package
+
+
+def parse(listing):
+    packages = []
+    for section in re.split(r'^-{3,}\s*$', listing, flags=re.M):
+        package = parse_section(section)
+        if package is not None:
+            packages.append(package)
+    return Catalog(packages)
+
+
+def load(list_sdk_packages, source_key=''):
+    # Returns the catalog, refreshing it from list_sdk_packages() when the cached copy is older than catalog_ttl or
+    # was built from different repository settings (source_key).
+    path = expanduser(catalog_path)
+    source_hash = hashlib.sha1(source_key.encode('utf-8')).hexdigest()
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['source'] == source_hash and time.time() - cached['time'] < catalog_ttl:
+            return Catalog([Package.from_dict(p) for p in cached['packages']])
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    catalog = parse(list_sdk_packages())
+
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({'time': time.time(), 'source': source_hash,
+                       'packages': [p.to_dict() for p in catalog.packages.values()]}, f)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass
+
+    return catalog
+
+
+def get_android_sdk_path():
+    for variable in ('ANDROID_HOME', 'ANDROID_SDK_ROOT'):
+        if os.environ.get(variable):
+            return os.environ[variable]
+
+    # Homebrew links bin/android into /usr/local/bin; the SDK is the directory above the real script.
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        android = join(directory, 'android')
+        if isfile(android):
+            return dirname(dirname(realpath(android)))
+
+    return '/usr/local/opt/android-sdk'
+
+
+def read_source_properties(path):
+    properties = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if '=' in line and not line.startswith('#'):
+                    key, value = line.split('=', 1)
+                    properties[key.strip()] = value.strip().replace('\\:', ':')
+    except IOError:
+        pass
+    return properties
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""Golden-image snapshots of a provisioned agent, restored onto new machines.
+
+Every agent ends up with the same Homebrew kegs, site-packages, gems and Android SDK, so replaying each install on a
+new machine is wasted time. A snapshot records those trees as a list of directories, symlinks and files, and each file
+is stored once under its sha256 in the snapshot directory, however many snapshots or paths contain it:
+
+    python panda.py -a --snapshot-save agent       # after a successful run, capture what it installed
+    python panda.py -a --snapshot-restore agent    # on a new machine: restore, then install only what differs
+    python snapshot.py list
+    python snapshot.py delete NAME                 # and drop the files no other snapshot uses
+
+Stored files are kept read-only. Files that were read-only on the captured machine as well are restored as hard links
+to the stored copies when the snapshot directory is on the same volume, so that part of a restore is mostly metadata;
+nothing can write into them without first making them writable, which changes the stored copy's mode and stops it
+from being linked again. Every other file is copied: pip rewriting a RECORD, brew postinstall, gem pristine or an
+editor would otherwise write straight into the snapshot and corrupt every later restore.
+
+The trees are found the same way on both machines (brew --prefix, the python and gem on PATH, ANDROID_HOME), so a
+snapshot doesn't depend on the user name or home directory.
+
+Configuration files are not captured: panda.py renders them on every run anyway, and some of them hold credentials
+that must not be copied to other machines.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import socket
+import stat
+import sys
+import time
+
+from collections import OrderedDict
+from os.path import exists, expanduser, isdir, islink, join, lexists, relpath
+
+import engine
+
+default_dir = '~/.panda-snapshots'
+
+# Hashes of captured files by path, size, modification time and inode, so capturing a machine again only reads the
+# files that have changed since.
+hash_cache_path = '~/.panda_snapshot_hashes.json'
+
+# Parts of the Homebrew prefix that hold what brew installed: kegs, their links, and the taps.
+brew_dirs = ['Cellar', 'opt', 'bin', 'sbin', 'lib', 'include', 'share', 'etc', 'Library/Taps', 'Homebrew/Library/Taps']
+
+
+def _query(args):
+    try:
+        result = engine.run(args, capture=True, echo=False)
+    except OSError:
+        return None
+    return result.output.strip() if result.returncode == 0 and result.output.strip() else None
+
+
+def roots():
+    # Trees captured and restored, by a name that means the same thing on every machine.
+    found = OrderedDict()
+    prefix = _query(['brew', '--prefix'])
+    if prefix:
+        for name in brew_dirs:
+            if isdir(join(prefix, name)):
+                found['brew/' + name] = join(prefix, name)
+    site_packages = _query(['python', '-c', 'from distutils.sysconfig import get_python_lib; print(get_python_lib())'])
+    if site_packages and isdir(site_packages):
+        found['site-packages'] = site_packages
+    gem_dir = _query(['gem', 'environment', 'gemdir'])
+    if gem_dir and isdir(gem_dir):
+        found['gems'] = gem_dir
+    android_home = os.environ.get('ANDROID_HOME')
+    if android_home and isdir(android_home) and not (prefix and os.path.realpath(android_home).startswith(prefix)):
+        found['android-sdk'] = android_home
+    return found
+
+
+class Store(object):
+    def __init__(self, directory=default_dir):
+        self.root = expanduser(directory)
+        self.objects = join(self.root, 'objects')
+        self.snapshots = join(self.root, 'snapshots')
+        for path in (self.objects, self.snapshots):
+            if not isdir(path):
+                os.makedirs(path)
+
+    def object_path(self, digest, mode):
+        # Hard links share their permissions, so files that differ only in mode are stored separately. The stored copy
+        # itself is always read-only.
+        return join(self.objects, digest[:2], '{}-{:o}'.format(digest, stat.S_IMODE(mode)))
+
+    def snapshot_path(self, name):
+        return join(self.snapshots, name + '.json.gz')
+
+    def add(self, path, mode, digest):
+        # Stores the file unless it already is; returns the bytes added.
+        target = self.object_path(digest, mode)
+        if exists(target):
+            return 0
+        if not isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        temp_path = '{}.{}.tmp'.format(target, os.getpid())
+        shutil.copy2(path, temp_path)
+        os.chmod(temp_path, stat.S_IMODE(mode) & ~0o222)
+        os.rename(temp_path, target)
+        return os.lstat(target).st_size
+
+    def names(self):
+        return sorted(name[:-len('.json.gz')] for name in os.listdir(self.snapshots) if name.endswith('.json.gz'))
+
+    def load(self, name):
+        with gzip.open(self.snapshot_path(name)) as f:
+            return json.load(f)
+
+    def save(self, name, snapshot):
+        temp_path = self.snapshot_path(name) + '.tmp'
+        with gzip.open(temp_path, 'wb') as f:
+            json.dump(snapshot, f)
+        os.rename(temp_path, self.snapshot_path(name))
+
+    def collect(self):
+        # Removes stored files that no snapshot refers to; returns (files, bytes) removed.
+        referenced = set()
+        for name in self.names():
+            for tree in self.load(name)['roots'].values():
+                for entry in tree['entries']:
+                    if entry[0] == 'f':
+                        referenced.add(os.path.basename(self.object_path(entry[3], entry[2])))
+        removed = [0, 0]
+        for directory, _, files in os.walk(self.objects):
+            for name in files:
+                if name not in referenced:
+                    path = join(directory, name)
+                    removed[1] += os.lstat(path).st_size
+                    os.remove(path)
+                    removed[0] += 1
+        return tuple(removed)
+
+
+def _load_hashes():
+    try:
+        with open(expanduser(hash_cache_path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_hashes(hashes):
+    path = expanduser(hash_cache_path)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(hashes, f)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def file_digest(path, st, hashes):
+    key = [st.st_size, st.st_mtime, st.st_ino]
+    cached = hashes.get(path)
+    if cached and cached[:3] == key:
+        return cached[3]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    hashes[path] = key + [sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def scan(store, root, hashes):
+    # Entries of one tree, parents before children: ['d', path, mode], ['l', path, target] or
+    # ['f', path, mode, sha256, size], with paths relative to the root. Returns (entries, bytes newly stored).
+    entries = []
+    added = 0
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = join(directory, name)
+            rel = relpath(path, root)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries.append(['l', rel, os.readlink(path)])
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append(['d', rel, stat.S_IMODE(st.st_mode)])
+            elif stat.S_ISREG(st.st_mode):
+                digest = file_digest(path, st, hashes)
+                added += store.add(path, st.st_mode, digest)
+                entries.append(['f', rel, stat.S_IMODE(st.st_mode), digest, st.st_size])
+        # Symlinked directories are recorded as links above and not followed.
+        dirs[:] = [name for name in dirs if not islink(join(directory, name))]
+    return entries, added
+
+
+def capture(name, plan, directory=default_dir):
+    """Records the provisioned trees of this machine as snapshot name; returns 0, or 1 when there was nothing to do."""
+    start = time.time()
+    store = Store(directory)
+    hashes = _load_hashes()
+    trees = roots()
+    if not trees:
+        print('ERROR: Found nothing to snapshot: Homebrew, python and gem are all missing.')
+        return 1
+
+    snapshot = {'name': name, 'created': time.time(), 'host': socket.gethostname(), 'profiles': plan.profiles,
+                'digest': plan.digest, 'roots': {}}
+    files = 0
+    size = 0
+    added = 0
+    for key, root in trees.items():
+        print('Capturing {} ({})...'.format(key, root))
+        entries, new_bytes = scan(store, root, hashes)
+        snapshot['roots'][key] = {'path': root, 'entries': entries}
+        files += sum(1 for entry in entries if entry[0] == 'f')
+        size += sum(entry[4] for entry in entries if entry[0] == 'f')
+        added += new_bytes
+    store.save(name, snapshot)
+    _save_hashes(hashes)
+    print('Saved snapshot {}: {} files, {} MB ({} MB new) in {:.0f}s.'.format(name, files, size // 1024 ** 2,
+                                                                             added // 1024 ** 2, time.time() - start))
+    return 0
+
+
+def _linkable(source, mode):
+    # Only read-only files are shared with the store, and only while the stored copy is still read-only: a writable
+    # one was stored before objects were made read-only, or has been made writable through a link since.
+    return not mode & 0o222 and not os.lstat(source).st_mode & 0o222
+
+
+def _place(source, target, mode, use_links):
+    # Puts a stored file at target, replacing whatever is there in one rename. Returns whether links still work.
+    temp_path = '{}.snapshot-{}.tmp'.format(target, os.getpid())
+    if use_links and _linkable(source, mode):
+        try:
+            os.link(source, temp_path)
+            os.rename(temp_path, target)
+            return True
+        except OSError:
+            # Most likely a different volume; everything else is copied.
+            if lexists(temp_path):
+                os.remove(temp_path)
+            use_links = False
+    shutil.copy2(source, temp_path)
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, target)
+    return use_links
+
+
+def restore_tree(store, entries, root):
+    # Returns (files placed, files already in place).
+    use_links = True
+    placed = 0
+    unchanged = 0
+    directories = [(root, None)]
+    if not isdir(root):
+        os.makedirs(root)
+    for entry in entries:
+        target = join(root, entry[1])
+        kind = entry[0]
+        if kind == 'd':
+            if lexists(target) and not isdir(target):
+                os.remove(target)
+            if not isdir(target):
+                os.makedirs(target)
+            os.chmod(target, entry[2] | stat.S_IWUSR)
+            # Read-only directories get their real mode once their contents are in place.
+            directories.append((target, entry[2]))
+        elif kind == 'l':
+            if islink(target) and os.readlink(target) == entry[2]:
+                continue
+            if isdir(target) and not islink(target):
+                print('WARNING: Not replacing directory {} with a link to {}.'.format(target, entry[2]))
+                continue
+            if lexists(target):
+                os.remove(target)
+            os.symlink(entry[2], target)
+        else:
+            source = store.object_path(entry[3], entry[2])
+            if (lexists(target) and not islink(target) and os.lstat(target).st_ino == os.lstat(source).st_ino and
+                    _linkable(source, entry[2])):
+                unchanged += 1
+                continue
+            if isdir(target) and not islink(target):
+                print('WARNING: Not replacing directory {} with a file.'.format(target))
+                continue
+            use_links = _place(source, target, entry[2], use_links)
+            placed += 1
+    for directory, mode in reversed(directories):
+        if mode is not None:
+            os.chmod(directory, mode)
+    return placed, unchanged
+
+
+def restore(name, plan, directory=default_dir):
+    """Restores snapshot name onto this machine; returns 0, or 1 when it can't be restored."""
+    start = time.time()
+    store = Store(directory)
+    if name not in store.names():
+        print('ERROR: No snapshot named {} in {}.'.format(name, store.root))
+        return 1
+    snapshot = store.load(name)
+    missing = [profile for profile in plan.profiles if profile not in snapshot['profiles']]
+    if missing:
+        print('WARNING: Snapshot {} does not cover {}; those are installed from scratch.'.format(name,
+                                                                                             ', '.join(missing)))
+    elif snapshot['digest'] != plan.digest:
+        print('Snapshot {} was taken from a different manifest; the packages that differ are installed after '
+              'the restore.'.format(name))
+
+    local = roots()
+    placed = 0
+    unchanged = 0
+    for key, tree in sorted(snapshot['roots'].items()):
+        root = local.get(key, tree['path'])
+        print('Restoring {} to {}...'.format(key, root))
+        counts = restore_tree(store, tree['entries'], root)
+        placed += counts[0]
+        unchanged += counts[1]
+    print('Restored snapshot {} (from {}): {} files placed, {} already in place, in {:.0f}s.'.format(
+        name, snapshot['host'], placed, unchanged, time.time() - start))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the golden-image snapshots taken by panda.py.')
+    parser.add_argument('command', choices=['list', 'delete', 'gc'])
+    parser.add_argument('name', nargs='?', help='Snapshot to delete.')
+    parser.add_argument('-d', '--dir', help='Snapshot directory (default: {}).'.format(default_dir),
+                        default=default_dir, required=False)
+    args = parser.parse_args()
+
+    store = Store(args.dir)
+    if args.command == 'list':
+        for name in store.names():
+            snapshot = store.load(name)
+            files = [entry for tree in snapshot['roots'].values() for entry in tree['entries'] if entry[0] == 'f']
+            print('{:<20} {}  {:<20} {:>6} MB  {}'.format(
+                name, time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot['created'])), snapshot['host'],
+                sum(entry[4] for entry in files) // 1024 ** 2, ', '.join(snapshot['profiles'])))
+        return 0
+
+    if args.command == 'delete':
+        if not args.name or args.name not in store.names():
+            parser.error('delete needs the name of an existing snapshot')
+        os.remove(store.snapshot_path(args.name))
+
+    files, size = store.collect()
+    print('Removed {} stored files ({} MB) no snapshot uses.'.format(files, size // 1024 ** 2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
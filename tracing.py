@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Timing trace of provisioning runs, written as JSON lines, and a report over it.
+
+Every command run through the runner and every scheduler task is appended to the trace file as one event:
+
+    {"event": "command", "run": ..., "args": [...], "task": ..., "manager": ..., "profile": ...,
+     "start": ..., "end": ..., "exit": ..., "bytes": ...}
+    {"event": "task", "run": ..., "name": ..., "manager": ..., "profile": ..., "deps": [...],
+     "start": ..., "end": ..., "status": ...}
+    {"event": "run", "run": ..., "script": ..., "argv": [...], "start": ..., "end": ...}
+
+'python tracing.py report' prints the slowest steps, the critical path through the task graph and the time spent
+in each package manager.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from os.path import basename, exists, expanduser, getsize
+
+import scheduler
+
+# Trace file for this run, or None when tracing is off.
+path = None
+
+# The trace is rotated to <path>.1 once it grows past this size.
+max_size = 10 * 1024 * 1024
+
+run_id = None
+
+_run = None
+_lock = threading.Lock()
+
+
+def configure(trace_path, script):
+    global path, run_id, _run
+    path = expanduser(trace_path)
+    if exists(path) and getsize(path) > max_size:
+        os.rename(path, path + '.1')
+    run_id = '{}-{}'.format(int(time.time()), os.getpid())
+    _run = {'event': 'run', 'script': script, 'argv': sys.argv[1:], 'start': time.time()}
+
+
+def finish():
+    if _run is not None:
+        _run['end'] = time.time()
+        record(_run)
+
+
+def record(event):
+    if path is None:
+        return
+    event = dict(event, run=run_id)
+    line = json.dumps(event) + '\n'
+    with _lock:
+        with open(path, 'a') as f:
+            f.write(line)
+
+
+def command_finished(args, start, end, returncode, output_bytes, timed_out):
+    task = getattr(scheduler.current, 'task', None)
+    record({
+        'event': 'command',
+        'args': args,
+        'task': task.name if task else None,
+        'manager': task.manager if task and task.manager else basename(args[0]),
+        'profile': task.profile if task else None,
+        'start': start,
+        'end': end,
+        'exit': returncode,
+        'bytes': output_bytes,
+        'timed_out': timed_out
+    })
+
+
+def task_finished(task, start, end):
+    record({
+        'event': 'task',
+        'name': task.name,
+        'manager': task.manager,
+        'profile': task.profile,
+        'deps': task.deps,
+        'start': start,
+        'end': end,
+        'status': task.status
+    })
+
+
+def load(trace_path, run=None):
+    # Events of one run (the most recent one by default).
+    events = []
+    with open(expanduser(trace_path)) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    if run is None:
+        runs = [event['run'] for event in events if event.get('event') == 'run']
+        run = runs[-1] if runs else (events[-1]['run'] if events else None)
+    return [event for event in events if event.get('run') == run]
+
+
+def critical_path(tasks):
+    # Walks back from the last task to finish, at each step following the dependency that finished last (the one
+    # that actually held the task up).
+    by_name = dict((task['name'], task) for task in tasks)
+    if not by_name:
+        return []
+    step = max(by_name.values(), key=lambda task: task['end'])
+    chain = [step]
+    while True:
+        deps = [by_name[dep] for dep in step.get('deps', []) if dep in by_name]
+        if not deps:
+            break
+        step = max(deps, key=lambda task: task['end'])
+        chain.append(step)
+    return list(reversed(chain))
+
+
+def report(events, top=10):
+    commands = [event for event in events if event.get('event') == 'command']
+    tasks = [event for event in events if event.get('event') == 'task']
+    runs = [event for event in events if event.get('event') == 'run']
+
+    if runs:
+        run = runs[-1]
+        print('Run {} ({} {}): {:.1f}s'.format(run['run'], run['script'], ' '.join(run['argv']),
+                                               run['end'] - run['start']))
+
+    print('\nSlowest steps:')
+    for event in sorted(commands, key=lambda e: e['end'] - e['start'], reverse=True)[:top]:
+        print('  {:8.1f}s  exit {:<3} {:>10} bytes  {}'.format(event['end'] - event['start'], event['exit'],
+                                                               event['bytes'], ' '.join(event['args'])))
+
+    chain = critical_path(tasks)
+    if chain:
+        print('\nCritical path ({:.1f}s):'.format(chain[-1]['end'] - chain[0]['start']))
+        for task in chain:
+            print('  {:8.1f}s  {}'.format(task['end'] - task['start'], task['name']))
+
+    totals = {}
+    for event in commands:
+        manager = event.get('manager') or '-'
+        totals[manager] = totals.get(manager, 0) + event['end'] - event['start']
+    print('\nTime per manager:')
+    for manager, total in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+        print('  {:8.1f}s  {}'.format(total, manager))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report on the timing trace of a provisioning run.')
+    parser.add_argument('command', choices=['report'])
+    parser.add_argument('-f', '--file', help='Trace file', default='~/.dev_trace.jsonl', required=False)
+    parser.add_argument('-r', '--run', help='Run id to report on (default: the most recent run)', required=False)
+    parser.add_argument('-n', '--top', help='Number of slowest steps to show', type=int, default=10, required=False)
+    args = parser.parse_args()
+
+    try:
+        events = load(args.file, args.run)
+    except IOError as e:
+        print('ERROR: {}'.format(e))
+        return 1
+
+    report(events, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())